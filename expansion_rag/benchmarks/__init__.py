@@ -0,0 +1 @@
+"""Offline benchmarks and load tests for the RAG API."""
@@ -0,0 +1,230 @@
+"""Offline micro-benchmarks for the core RAG pipeline.
+
+Runs against a local fake OpenAI server and writes machine-readable JSON, so
+results can be compared across commits:
+
+    python -m benchmarks.bench_core --output bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from .fake_openai import DEFAULT_DIMENSIONS, FakeOpenAIServer
+
+BUNDLED_DOCUMENTS_DIR = Path(__file__).resolve().parent.parent / "src" / "api" / "data" / "documents"
+CHUNKS_PER_SYNTHETIC_DOCUMENT = 50
+
+
+def summarize_latencies(samples: List[float]) -> Dict[str, float]:
+    """Latency statistics in milliseconds."""
+    values = np.array(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+    }
+
+
+def timed(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def bench_pdf_extraction(pdf_paths: List[Path]) -> Tuple[Dict, List[str]]:
+    """Pages per second of process_pdf_with_retry on real PDFs."""
+    import pdfplumber
+    from api.core.document_processor import process_pdf_with_retry
+
+    texts, pages, elapsed = [], 0, 0.0
+    per_document = []
+    for path in pdf_paths:
+        with pdfplumber.open(path) as pdf:
+            page_count = len(pdf.pages)
+        start = time.perf_counter()
+        text = process_pdf_with_retry(path)
+        duration = time.perf_counter() - start
+        texts.append(text or "")
+        pages += page_count
+        elapsed += duration
+        per_document.append({"file": path.name, "pages": page_count, "seconds": duration})
+
+    return {
+        "documents": len(pdf_paths),
+        "pages": pages,
+        "seconds": elapsed,
+        "pages_per_second": pages / elapsed if elapsed else 0.0,
+        "per_document": per_document,
+    }, texts
+
+
+def bench_chunk_text(texts: List[str], repeats: int) -> Dict:
+    """Tokens per second of chunk_text."""
+    from api.core.embeddings import chunk_text, get_encoding
+
+    tokens = sum(len(get_encoding().encode(text)) for text in texts)
+    samples = [timed(lambda: [chunk_text(text) for text in texts]) for _ in range(repeats)]
+    best = min(samples)
+    return {
+        "tokens": tokens,
+        "repeats": repeats,
+        "best_seconds": best,
+        "tokens_per_second": tokens / best if best else 0.0,
+    }
+
+
+def bench_ingestion(texts: List[str]) -> Dict:
+    """Chunks per second of create_document_embeddings (chunking, embedding calls, index writes)."""
+    from api.core.embeddings import create_document_embeddings
+
+    chunks, elapsed = 0, 0.0
+    for i, text in enumerate(texts):
+        start = time.perf_counter()
+        result = create_document_embeddings(str(uuid.uuid4()), text, {"filename": f"benchmark-{i}.pdf"})
+        elapsed += time.perf_counter() - start
+        chunks += result.get("chunks", 0)
+    return {
+        "documents": len(texts),
+        "chunks": chunks,
+        "seconds": elapsed,
+        "chunks_per_second": chunks / elapsed if elapsed else 0.0,
+    }
+
+
+def write_synthetic_corpus(directory: Path, chunk_count: int, dimensions: int, rng: np.random.Generator) -> None:
+    """Write per-document index and metadata files with random vectors."""
+    import faiss
+
+    directory.mkdir(parents=True, exist_ok=True)
+    for start in range(0, chunk_count, CHUNKS_PER_SYNTHETIC_DOCUMENT):
+        count = min(CHUNKS_PER_SYNTHETIC_DOCUMENT, chunk_count - start)
+        document_id = str(uuid.uuid4())
+        vectors = rng.standard_normal((count, dimensions)).astype(np.float32)
+        index = faiss.IndexFlatL2(dimensions)
+        index.add(vectors)
+        faiss.write_index(index, str(directory / f"{document_id}.index"))
+        with open(directory / f"{document_id}.json", "w") as f:
+            json.dump({
+                "document_id": document_id,
+                "chunks": [
+                    {"chunk_id": f"{document_id}_{i}", "text": f"synthetic chunk {start + i}", "embedding_index": i}
+                    for i in range(count)
+                ],
+                "metadata": {"filename": f"synthetic-{start // CHUNKS_PER_SYNTHETIC_DOCUMENT}.pdf"}
+            }, f)
+
+
+def bench_search(root: Path, corpus_sizes: List[int], top_ks: List[int], queries: int, dimensions: int) -> List[Dict]:
+    """search_all_documents latency as a function of corpus size and top_k."""
+    from api.core import embeddings
+    from api.core.index import get_corpus_index
+
+    rng = np.random.default_rng(0)
+    results = []
+    for size in corpus_sizes:
+        directory = root / f"search-{size}"
+        write_synthetic_corpus(directory, size, dimensions, rng)
+        embeddings.EMBEDDINGS_DIR = directory
+
+        load_seconds = timed(lambda: get_corpus_index(directory))
+        corpus = get_corpus_index(directory)
+        query_vectors = rng.standard_normal((queries, dimensions)).astype(np.float32)
+
+        for top_k in top_ks:
+            end_to_end = [
+                timed(lambda i=i: embeddings.search_all_documents(f"benchmark query {size} {top_k} {i}", top_k))
+                for i in range(queries)
+            ]
+            index_only = [timed(lambda i=i: corpus.search(query_vectors[i:i + 1], top_k)) for i in range(queries)]
+            results.append({
+                "corpus_chunks": size,
+                "top_k": top_k,
+                "load_seconds": load_seconds,
+                "search_all_documents": summarize_latencies(end_to_end),
+                "index_search": summarize_latencies(index_only),
+            })
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks for the RAG pipeline")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--documents-dir", type=Path, default=BUNDLED_DOCUMENTS_DIR)
+    parser.add_argument("--max-pdfs", type=int, default=3, help="Number of bundled PDFs to extract and ingest")
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--top-k", type=int, nargs="+", default=[3, 10, 50])
+    parser.add_argument("--queries", type=int, default=50, help="Queries per search measurement")
+    parser.add_argument("--chunk-repeats", type=int, default=3)
+    parser.add_argument("--dimensions", type=int, default=DEFAULT_DIMENSIONS)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(dimensions=args.dimensions).start()
+    workdir = Path(tempfile.mkdtemp(prefix="rag-bench-"))
+
+    # Configure before importing the api package, which reads settings at import time
+    os.environ.update({
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": server.base_url,
+        "EMBEDDING_BACKEND": "openai",
+        "COMPLETION_BACKEND": "openai",
+        "EMBEDDINGS_DIR": str(workdir / "ingest"),
+        "DOCUMENTS_DIR": str(args.documents_dir),
+    })
+    logging.getLogger("api").setLevel(logging.WARNING)
+
+    try:
+        pdf_paths = sorted(args.documents_dir.glob("*.pdf"))[:args.max_pdfs]
+        pdf_results, texts = bench_pdf_extraction(pdf_paths)
+
+        report = {
+            "metadata": {
+                "commit": git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "dimensions": args.dimensions,
+            },
+            "results": {
+                "pdf_extraction": pdf_results,
+                "chunk_text": bench_chunk_text(texts, args.chunk_repeats),
+                "ingestion": bench_ingestion(texts),
+                "search": bench_search(workdir, args.corpus_sizes, args.top_k, args.queries, args.dimensions),
+                "fake_api_requests": server.request_count,
+            },
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""Retrieval quality versus speed of candidate index configurations.
+
+Searches the stored vectors of the current index generation (or a synthetic
+corpus) with every candidate FAISS configuration and compares the results to
+exact IndexFlatL2 neighbours, the search the API runs today. No embedding API
+calls are made: queries are stored vectors with a little noise, or come from
+a labelled query file.
+
+    python -m benchmarks.eval_retrieval --configs Flat HNSW32 "IVF{nlist},Flat|nprobe=16" "Flat@512"
+
+Configurations are faiss.index_factory strings. "{nlist}" is replaced by
+about 4*sqrt(corpus size); "|name=value,..." sets search parameters (e.g.
+nprobe, efSearch); "@<dims>" first shortens the vectors to that many
+dimensions and renormalizes them, as the text-embedding-3 models do when
+asked for fewer dimensions; configurations that would not shorten the
+corpus vectors are skipped.
+
+A labelled query file has one JSON object per line: the query as
+"chunk_id" (its stored vector) or "vector", and optionally
+"relevant_chunk_ids" to also score the results against the labels.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .bench_core import git_commit, summarize_latencies
+
+DEFAULT_CONFIGS = [
+    "Flat",
+    "HNSW32|efSearch=64",
+    "IVF{nlist},Flat|nprobe=8",
+    "IVF{nlist},Flat|nprobe=32",
+    "IVF{nlist},SQ8|nprobe=32",
+    "IVF{nlist},PQ{pq_m}|nprobe=32",
+    "Flat@512",
+    "Flat@256",
+]
+
+
+def load_stored_vectors(embeddings_dir: Optional[Path]) -> Tuple[np.ndarray, List[str]]:
+    """Vectors and chunk ids of the current generation, in segment order."""
+    if embeddings_dir is not None:
+        os.environ["EMBEDDINGS_DIR"] = str(embeddings_dir)
+    from api.core.embeddings import current_generation
+    from api.core.index import get_corpus_index
+
+    corpus = get_corpus_index(current_generation().path)
+    if corpus.size == 0:
+        raise SystemExit("The corpus is empty; ingest documents first or use --synthetic-chunks")
+    vectors = np.vstack([np.asarray(segment.vectors, dtype=np.float32) for segment in corpus.segments])
+    chunk_ids = [chunk_id for segment in corpus.segments for chunk_id in segment.chunks.chunk_ids]
+    return vectors, chunk_ids
+
+
+def synthetic_vectors(count: int, dimensions: int, rng: np.random.Generator) -> Tuple[np.ndarray, List[str]]:
+    """Clustered unit vectors, closer to real embeddings than uniform noise."""
+    centers = rng.standard_normal((max(count // 100, 1), dimensions)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), count)] + 0.3 * rng.standard_normal((count, dimensions))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32), [f"synthetic_{i}" for i in range(count)]
+
+
+def load_queries(
+    path: Optional[Path],
+    vectors: np.ndarray,
+    chunk_ids: List[str],
+    count: int,
+    noise: float,
+    rng: np.random.Generator
+) -> Tuple[np.ndarray, Optional[List[List[str]]]]:
+    """Query vectors and, for a labelled file, the relevant chunk ids of each query."""
+    if path is None:
+        # Stored vectors nudged off their own position, so a query is not trivially its own neighbour
+        rows = rng.choice(len(vectors), size=min(count, len(vectors)), replace=False)
+        scale = noise * float(np.linalg.norm(vectors[rows], axis=1).mean()) / np.sqrt(vectors.shape[1])
+        queries = vectors[rows] + scale * rng.standard_normal((len(rows), vectors.shape[1])).astype(np.float32)
+        return queries.astype(np.float32), None
+
+    rows_by_id = {chunk_id: row for row, chunk_id in enumerate(chunk_ids)}
+    queries, labels = [], []
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if "vector" in item:
+                queries.append(np.asarray(item["vector"], dtype=np.float32))
+            elif item.get("chunk_id") in rows_by_id:
+                queries.append(vectors[rows_by_id[item["chunk_id"]]])
+            else:
+                logging.warning(f"Skipping query on line {line_number}: no vector and no known chunk_id")
+                continue
+            labels.append(item.get("relevant_chunk_ids") or [])
+    if not queries:
+        raise SystemExit(f"No usable queries in {path}")
+    return np.vstack(queries), labels if any(labels) else None
+
+
+def shorten(vectors: np.ndarray, dimensions: int) -> np.ndarray:
+    """Keep the first dimensions and renormalize (text-embedding-3 shortening)."""
+    shortened = np.ascontiguousarray(vectors[:, :dimensions])
+    norms = np.linalg.norm(shortened, axis=1, keepdims=True)
+    return (shortened / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def parse_config(config: str, size: int, dimensions: int) -> Tuple[str, str, Optional[int]]:
+    """
+    Split a configuration into factory string, search parameters and shortened dimension.
+
+    Raises ValueError if "@<dims>" would not shorten vectors of the given dimension.
+    """
+    factory, _, parameters = config.partition("|")
+    shortened = None
+    if "@" in factory:
+        factory, _, value = factory.partition("@")
+        shortened = int(value)
+        if not 0 < shortened < dimensions:
+            raise ValueError(f"@{shortened} does not shorten vectors of dimension {dimensions}")
+        dimensions = shortened
+    nlist = max(int(4 * np.sqrt(size)), 1)
+    # PQ needs a sub-quantizer count dividing the dimension
+    pq_m = next(m for m in (64, 48, 32, 24, 16, 8, 4, 2, 1) if dimensions % m == 0)
+    return factory.format(nlist=nlist, pq_m=pq_m), parameters, shortened
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Ground truth: the search the API runs today (exact squared L2)."""
+    import faiss
+
+    _, indices = faiss.knn(queries, vectors, k)
+    return indices
+
+
+def score(indices: np.ndarray, truth: np.ndarray, k: int) -> Dict[str, float]:
+    """recall@k against the exact top k and MRR of the exact nearest neighbour."""
+    recalls, reciprocal_ranks = [], []
+    for found, expected in zip(indices[:, :k], truth[:, :k]):
+        recalls.append(len(set(found.tolist()) & set(expected.tolist())) / k)
+        hits = np.flatnonzero(found == expected[0])
+        reciprocal_ranks.append(1.0 / (hits[0] + 1) if len(hits) else 0.0)
+    return {f"recall@{k}": float(np.mean(recalls)), "mrr": float(np.mean(reciprocal_ranks))}
+
+
+def score_labels(indices: np.ndarray, chunk_ids: List[str], labels: List[List[str]], k: int) -> Dict[str, float]:
+    """recall@k and MRR against the relevant chunks of a labelled query file."""
+    recalls, reciprocal_ranks = [], []
+    for found, relevant in zip(indices[:, :k], labels):
+        if not relevant:
+            continue
+        found_ids = [chunk_ids[row] for row in found if row >= 0]
+        recalls.append(len(set(found_ids) & set(relevant)) / len(relevant))
+        rank = next((i for i, chunk_id in enumerate(found_ids) if chunk_id in relevant), None)
+        reciprocal_ranks.append(1.0 / (rank + 1) if rank is not None else 0.0)
+    return {f"label_recall@{k}": float(np.mean(recalls)), "label_mrr": float(np.mean(reciprocal_ranks))}
+
+
+def evaluate(
+    config: str,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    truth: np.ndarray,
+    chunk_ids: List[str],
+    labels: Optional[List[List[str]]],
+    k: int,
+    train_size: int,
+    latency_queries: int,
+    rng: np.random.Generator
+) -> Dict:
+    import faiss
+
+    factory, parameters, shortened = parse_config(config, len(vectors), vectors.shape[1])
+    if shortened is not None:
+        vectors, queries = shorten(vectors, shortened), shorten(queries, shortened)
+
+    start = time.perf_counter()
+    index = faiss.index_factory(vectors.shape[1], factory)
+    if not index.is_trained:
+        sample = vectors[rng.choice(len(vectors), size=min(train_size, len(vectors)), replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    build_seconds = time.perf_counter() - start
+    if parameters:
+        faiss.ParameterSpace().set_index_parameters(index, parameters)
+
+    start = time.perf_counter()
+    _, indices = index.search(queries, k)
+    batch_seconds = time.perf_counter() - start
+    # Single-query latency, as the API searches one query (or a few) at a time
+    latencies = []
+    for query in queries[:latency_queries]:
+        start = time.perf_counter()
+        index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+
+    result = {
+        "config": config,
+        "factory": factory,
+        "parameters": parameters,
+        "dimensions": vectors.shape[1],
+        **score(indices, truth, k),
+        "latency": summarize_latencies(latencies),
+        "queries_per_second": len(queries) / batch_seconds if batch_seconds else 0.0,
+        "index_bytes": int(faiss.serialize_index(index).nbytes),
+        "build_seconds": build_seconds,
+    }
+    if labels is not None:
+        result.update(score_labels(indices, chunk_ids, labels, k))
+    return result
+
+
+def format_table(results: List[Dict], k: int) -> str:
+    columns = [
+        ("config", lambda r: r["config"]),
+        ("dims", lambda r: str(r["dimensions"])),
+        (f"recall@{k}", lambda r: f"{r[f'recall@{k}']:.3f}"),
+        ("MRR", lambda r: f"{r['mrr']:.3f}"),
+        ("p50 ms", lambda r: f"{r['latency']['p50_ms']:.3f}"),
+        ("p95 ms", lambda r: f"{r['latency']['p95_ms']:.3f}"),
+        ("QPS", lambda r: f"{r['queries_per_second']:.0f}"),
+        ("MiB", lambda r: f"{r['index_bytes'] / 2 ** 20:.1f}"),
+        ("build s", lambda r: f"{r['build_seconds']:.2f}"),
+    ]
+    if any(f"label_recall@{k}" in r for r in results):
+        columns[4:4] = [
+            (f"label R@{k}", lambda r: f"{r.get(f'label_recall@{k}', 0.0):.3f}"),
+            ("label MRR", lambda r: f"{r.get('label_mrr', 0.0):.3f}"),
+        ]
+    rows = [[name for name, _ in columns]] + [[cell(r) for _, cell in columns] for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    lines = [" | ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows]
+    lines.insert(1, "-+-".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare recall, latency and memory of FAISS index configurations")
+    parser.add_argument("--embeddings-dir", type=Path, help="Defaults to EMBEDDINGS_DIR")
+    parser.add_argument("--synthetic-chunks", type=int, default=0, help="Use a synthetic corpus of this size instead")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Dimension of the synthetic corpus")
+    parser.add_argument("--query-file", type=Path, help="Labelled queries (JSONL); default: sampled stored vectors")
+    parser.add_argument("--queries", type=int, default=500, help="Sampled queries")
+    parser.add_argument("--noise", type=float, default=0.1, help="Relative noise added to sampled queries")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--configs", nargs="+", default=DEFAULT_CONFIGS)
+    parser.add_argument("--train-size", type=int, default=50000, help="Vectors used to train IVF/PQ indexes")
+    parser.add_argument("--latency-queries", type=int, default=200, help="Queries timed one at a time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    logging.getLogger("api").setLevel(logging.WARNING)
+    rng = np.random.default_rng(args.seed)
+    if args.synthetic_chunks:
+        vectors, chunk_ids = synthetic_vectors(args.synthetic_chunks, args.dimensions, rng)
+    else:
+        vectors, chunk_ids = load_stored_vectors(args.embeddings_dir)
+    queries, labels = load_queries(args.query_file, vectors, chunk_ids, args.queries, args.noise, rng)
+    k = min(args.top_k, len(vectors))
+    truth = exact_neighbours(vectors, queries, k)
+
+    results = []
+    for config in args.configs:
+        try:
+            results.append(evaluate(
+                config, vectors, queries, truth, chunk_ids, labels, k, args.train_size, args.latency_queries, rng
+            ))
+        except Exception as e:
+            print(f"Skipping {config}: {e}", file=sys.stderr)
+
+    print(f"{len(vectors)} vectors of dimension {vectors.shape[1]}, {len(queries)} queries, k={k}\n")
+    print(format_table(results, k))
+    if args.output:
+        report = {
+            "metadata": {
+                "commit": git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "corpus_vectors": len(vectors),
+                "dimensions": int(vectors.shape[1]),
+                "queries": len(queries),
+                "top_k": k,
+                "labelled": labels is not None,
+            },
+            "results": results,
+        }
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Local stand-in for the OpenAI API used by the benchmarks.
+
+Serves /v1/embeddings and /v1/chat/completions with deterministic responses,
+so the real client code (shared HTTP pool, retries, parsing) is exercised
+without network access or cost. Response latency can follow a configurable
+distribution to mimic the real API, e.g.
+
+    python -m benchmarks.fake_openai --completion-latency lognormal:800,0.5
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import numpy as np
+
+DEFAULT_DIMENSIONS = 1536
+
+
+class LatencyModel:
+    """
+    Response latency distribution, parsed from a spec string.
+
+    Supported specs (milliseconds): "none", "fixed:MS", "uniform:LOW,HIGH",
+    "normal:MEAN,STDDEV" and "lognormal:MEDIAN,SIGMA".
+    """
+
+    def __init__(self, spec: str = "none"):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p]
+        if kind not in ("none", "fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        """Draw one latency in seconds."""
+        if self.kind == "fixed":
+            ms = self.params[0]
+        elif self.kind == "uniform":
+            ms = random.uniform(self.params[0], self.params[1])
+        elif self.kind == "normal":
+            ms = random.gauss(self.params[0], self.params[1])
+        elif self.kind == "lognormal":
+            ms = random.lognormvariate(np.log(self.params[0]), self.params[1])
+        else:
+            ms = 0.0
+        return max(ms, 0.0) / 1000
+
+
+def fake_embedding(text: str, dimensions: int = DEFAULT_DIMENSIONS) -> List[float]:
+    """Deterministic unit vector derived from the text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    vector /= np.linalg.norm(vector)
+    return vector.tolist()
+
+
+def fake_completion(messages: List[dict]) -> str:
+    """Canned completion; expansion prompts get a numbered list of queries."""
+    last = messages[-1]["content"] if messages else ""
+    if last.startswith("Original query:"):
+        query = last.split("'")[1] if "'" in last else last
+        return "\n".join(f"{i}. {query} {suffix}" for i, suffix in enumerate(["scope", "Anforderungen", "deadline"], 1))
+    return f"This is a benchmark answer to: {last[:200]}"
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """Threaded HTTP server answering like the OpenAI API."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        dimensions: int = DEFAULT_DIMENSIONS,
+        embedding_latency: str = "none",
+        completion_latency: str = "none"
+    ):
+        super().__init__((host, port), FakeOpenAIHandler)
+        self.dimensions = dimensions
+        self.embedding_latency = LatencyModel(embedding_latency)
+        self.completion_latency = LatencyModel(completion_latency)
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count_request(self) -> None:
+        with self._count_lock:
+            self.request_count += 1
+
+    def start(self) -> "FakeOpenAIServer":
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    server: FakeOpenAIServer
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without TCP_NODELAY every keep-alive
+    # response waits for a delayed ACK (~40 ms) and that dominates measured latencies
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload: dict, status: int = 200) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        self.server.count_request()
+
+        if self.path.endswith("/embeddings"):
+            inputs = request.get("input", [])
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            dimensions = request.get("dimensions") or self.server.dimensions
+            tokens = sum(len(text.split()) for text in inputs)
+            time.sleep(self.server.embedding_latency.sample())
+            self._send_json({
+                "object": "list",
+                "model": request.get("model", "fake-embedding"),
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": fake_embedding(text, dimensions)}
+                    for i, text in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+            })
+            return
+
+        if self.path.endswith("/chat/completions"):
+            messages = request.get("messages", [])
+            content = fake_completion(messages)
+            prompt_tokens = sum(len(m.get("content", "").split()) for m in messages)
+            completion_tokens = len(content.split())
+            time.sleep(self.server.completion_latency.sample())
+            self._send_json({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "fake-model"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop"
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens
+                }
+            })
+            return
+
+        self._send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--dimensions", type=int, default=DEFAULT_DIMENSIONS)
+    parser.add_argument("--embedding-latency", default="none", help="e.g. lognormal:150,0.4")
+    parser.add_argument("--completion-latency", default="none", help="e.g. lognormal:800,0.5")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        args.host, args.port, args.dimensions, args.embedding_latency, args.completion_latency
+    )
+    print(f"Fake OpenAI API listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
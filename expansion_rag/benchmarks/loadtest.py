@@ -0,0 +1,329 @@
+"""HTTP load test simulating concurrent users against the API and a fake LLM server.
+
+Starts the fake OpenAI server and the FastAPI app in-process, replays
+multi-turn chat sessions mixed with /qa and upload traffic, and reports
+throughput and latency percentiles per endpoint, plus how long the app's event
+loop was blocked:
+
+    python -m benchmarks.loadtest --chat-users 20 --qa-users 5 --upload-users 1 \\
+        --duration 60 --completion-latency lognormal:800,0.5
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from .bench_core import git_commit, summarize_latencies
+from .fake_openai import DEFAULT_DIMENSIONS, FakeOpenAIServer
+
+QUESTIONS = [
+    "Which companies fall under the scope of the CSRD?",
+    "What are the double materiality requirements in ESRS 1?",
+    "How does the EU Taxonomy define a substantially contributing activity?",
+    "What does the GHG Protocol say about Scope 3 category 1 emissions?",
+    "When do the first CSRD reports have to be published?",
+    "Welche Angaben verlangt ESRS E1 zum Klimaschutz?",
+    "What are the minimum safeguards under the Taxonomy Regulation?",
+    "How should land use change emissions be reported for agriculture?",
+]
+FOLLOW_UPS = [
+    "Can you give more detail on that?",
+    "Which article is that in?",
+    "How does this apply to SMEs?",
+    "What are the deadlines?",
+    "Was bedeutet das konkret für uns?",
+]
+SEED_WORDS = (
+    "sustainability reporting directive undertakings disclosure taxonomy regulation climate mitigation "
+    "adaptation emissions scope value chain materiality assurance standards delegated act article "
+    "Nachhaltigkeit Berichterstattung Unternehmen Offenlegung Klimaschutz"
+).split()
+
+
+class EndpointStats:
+    """Latencies and errors recorded per endpoint."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, endpoint: str, seconds: float, ok: bool) -> None:
+        if ok:
+            self.latencies[endpoint].append(seconds)
+        else:
+            self.errors[endpoint] += 1
+
+    def report(self, duration: float) -> Dict[str, Dict]:
+        report = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            samples = self.latencies[endpoint]
+            report[endpoint] = {
+                "requests": len(samples) + self.errors[endpoint],
+                "errors": self.errors[endpoint],
+                "throughput_rps": len(samples) / duration if duration else 0.0,
+                **(summarize_latencies(samples) if samples else {}),
+            }
+        return report
+
+
+class LoopLagProbe:
+    """Measures how late the event loop wakes up a sleeping task, i.e. how long it was blocked."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags: List[float] = []
+        self._stopped = False
+
+    async def run(self) -> None:
+        while not self._stopped:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(time.perf_counter() - start - self.interval, 0.0))
+
+    def stop(self) -> None:
+        self._stopped = True
+
+    def report(self, duration: float) -> Dict[str, float]:
+        if not self.lags:
+            return {}
+        lags = np.array(self.lags)
+        return {
+            "samples": len(lags),
+            "blocked_seconds": float(lags.sum()),
+            "blocked_fraction": float(lags.sum() / duration) if duration else 0.0,
+            "p50_lag_ms": float(np.percentile(lags, 50) * 1000),
+            "p99_lag_ms": float(np.percentile(lags, 99) * 1000),
+            "max_lag_ms": float(lags.max() * 1000),
+        }
+
+
+class AppServer:
+    """Runs the FastAPI app with uvicorn on its own event loop in a background thread."""
+
+    def __init__(self, port: int):
+        import uvicorn
+
+        config = uvicorn.Config("api.app:app", host="127.0.0.1", port=port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.loop = asyncio.new_event_loop()
+        self.url = f"http://127.0.0.1:{port}"
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.server.serve())
+
+    def start(self, timeout: float = 30.0) -> "AppServer":
+        self._thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("API server did not start")
+            time.sleep(0.05)
+        return self
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self._thread.join(timeout=10)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(SEED_WORDS) for _ in range(words))
+
+
+async def timed_request(client: httpx.AsyncClient, stats: EndpointStats, endpoint: str, method: str, url: str, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+        ok = response.status_code < 400
+    except httpx.HTTPError:
+        response, ok = None, False
+    stats.record(endpoint, time.perf_counter() - start, ok)
+    return response if ok else None
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float = 120.0) -> None:
+    """Wait until the API reports it has warmed up."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/ready")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("API did not become ready")
+
+
+async def chat_user(client, stats, deadline, args, rng) -> None:
+    """Replays multi-turn chat sessions with think time between turns."""
+    while time.monotonic() < deadline:
+        session_id = None
+        turns = rng.randint(args.min_turns, args.max_turns)
+        for turn in range(turns):
+            if time.monotonic() >= deadline:
+                return
+            message = rng.choice(QUESTIONS) if turn == 0 else rng.choice(FOLLOW_UPS)
+            payload = {"message": message, "top_k": args.top_k}
+            if session_id:
+                payload["session_id"] = session_id
+            response = await timed_request(client, stats, "/chat/process", "POST", "/chat/process", json=payload)
+            if response is None:
+                break
+            session_id = response.json().get("session_id")
+            await asyncio.sleep(rng.uniform(0, args.think_time))
+
+
+async def qa_user(client, stats, deadline, args, rng) -> None:
+    """Asks independent questions."""
+    while time.monotonic() < deadline:
+        payload = {"query": rng.choice(QUESTIONS), "top_k": args.top_k}
+        await timed_request(client, stats, "/qa", "POST", "/qa", json=payload)
+        await asyncio.sleep(rng.uniform(0, args.think_time))
+
+
+async def upload_user(client, stats, deadline, args, rng) -> None:
+    """Uploads small text documents."""
+    while time.monotonic() < deadline:
+        content = seed_text(rng, args.upload_words).encode()
+        files = {"file": (f"loadtest-{rng.randrange(10 ** 9)}.txt", io.BytesIO(content), "text/plain")}
+        await timed_request(client, stats, "/documents/upload", "POST", "/documents/upload", files=files)
+        await asyncio.sleep(rng.uniform(0, args.think_time * 5))
+
+
+async def run_load(base_url: str, args, probe_loop: Optional[asyncio.AbstractEventLoop]) -> Dict:
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.chat_users + args.qa_users + args.upload_users + 4)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.request_timeout, limits=limits) as client:
+        await wait_ready(client)
+
+        # Seed a small corpus so retrieval has something to search
+        seed_stats = EndpointStats()
+        for i in range(args.seed_documents):
+            await timed_request(
+                client, seed_stats, "/documents/text", "POST", "/documents/text",
+                json={"content": seed_text(rng, args.seed_words), "filename": f"seed-{i}.txt"}
+            )
+
+        probe = LoopLagProbe()
+        probe_future = asyncio.run_coroutine_threadsafe(probe.run(), probe_loop) if probe_loop else None
+
+        stats = EndpointStats()
+        start = time.monotonic()
+        deadline = start + args.duration
+        users = (
+            [chat_user(client, stats, deadline, args, random.Random(rng.random())) for _ in range(args.chat_users)]
+            + [qa_user(client, stats, deadline, args, random.Random(rng.random())) for _ in range(args.qa_users)]
+            + [upload_user(client, stats, deadline, args, random.Random(rng.random())) for _ in range(args.upload_users)]
+        )
+        await asyncio.gather(*users)
+        duration = time.monotonic() - start
+
+        probe.stop()
+        if probe_future:
+            await asyncio.wrap_future(probe_future)
+
+    return {
+        "duration_seconds": duration,
+        "endpoints": stats.report(duration),
+        "event_loop": probe.report(duration) if probe_loop else None,
+        "seed": seed_stats.report(duration),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the RAG API against a fake LLM server")
+    parser.add_argument("--target-url", help="Test an already running API instead of starting one in-process")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of measured load")
+    parser.add_argument("--chat-users", type=int, default=10)
+    parser.add_argument("--qa-users", type=int, default=2)
+    parser.add_argument("--upload-users", type=int, default=1)
+    parser.add_argument("--min-turns", type=int, default=2)
+    parser.add_argument("--max-turns", type=int, default=6)
+    parser.add_argument("--think-time", type=float, default=1.0, help="Maximum seconds between requests of a user")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--seed-documents", type=int, default=10)
+    parser.add_argument("--seed-words", type=int, default=3000)
+    parser.add_argument("--upload-words", type=int, default=1000)
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--embedding-latency", default="lognormal:150,0.4")
+    parser.add_argument("--completion-latency", default="lognormal:800,0.5")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake_api = None
+    app_server = None
+    workdir = None
+    try:
+        if args.target_url:
+            base_url, probe_loop = args.target_url, None
+        else:
+            fake_api = FakeOpenAIServer(
+                dimensions=DEFAULT_DIMENSIONS,
+                embedding_latency=args.embedding_latency,
+                completion_latency=args.completion_latency
+            ).start()
+            workdir = Path(tempfile.mkdtemp(prefix="rag-loadtest-"))
+            # Configure before the app is imported, it reads settings at import time
+            os.environ.update({
+                "OPENAI_API_KEY": "loadtest",
+                "OPENAI_BASE_URL": fake_api.base_url,
+                "EMBEDDING_BACKEND": "openai",
+                "COMPLETION_BACKEND": "openai",
+                "EMBEDDINGS_DIR": str(workdir / "embeddings"),
+                "DOCUMENTS_DIR": str(workdir / "documents"),
+            })
+            logging.getLogger("api").setLevel(logging.WARNING)
+            app_server = AppServer(free_port()).start()
+            base_url, probe_loop = app_server.url, app_server.loop
+
+        results = asyncio.run(run_load(base_url, args, probe_loop))
+    finally:
+        if app_server:
+            app_server.stop()
+        if fake_api:
+            fake_api.stop()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "metadata": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": sys.version.split()[0],
+            "target": args.target_url or "in-process",
+            "config": {k: v for k, v in vars(args).items() if k not in ("output",)},
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,17 @@
 """RAG API package."""
-from .app import start
+import time
+
+from dotenv import load_dotenv
+
+# Reference point for the startup timings reported by the app
+IMPORT_STARTED = time.perf_counter()
+
+# Load environment variables once, before any module reads its settings
+load_dotenv()
 
 
 def main() -> None:
     """Run the RAG API application."""
+    from .app import start
+
     start()
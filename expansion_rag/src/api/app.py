@@ -1,20 +1,30 @@
 """FastAPI application for RAG API."""
 import os
-from dotenv import load_dotenv
-
-# Load environment variables first
-load_dotenv()
-
-# Check for required environment variables
-if not os.getenv("OPENAI_API_KEY"):
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
-
+import asyncio
+import math
+import time
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
 from contextlib import asynccontextmanager
 
-from .routers import documents, qa, chat
+from .core.embeddings import current_generation
+from .core.index import Compactor
+from .core.metrics import HTTP_REQUEST_DURATION, render_metrics
+from .core.routing import ROUTING_STATS
+from .core.scheduler import QuotaExceededError
+from .core.sessions import SESSION_STORE
+from .core.startup import readiness, warm_up
+from .core.usage import PROCESS_USAGE
+from .routers import documents, qa, chat, chunks
+
+# Responses smaller than this are sent uncompressed
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))
+# Streamed responses whose lines must reach the client as they are produced, and
+# corpus snapshots (mostly incompressible vectors)
+UNCOMPRESSED_PATHS = {"/qa/batch", "/documents/snapshot"}
 
 
 @asynccontextmanager
@@ -22,8 +32,14 @@ async def lifespan(app: FastAPI):
     # Startup: Create necessary directories
     os.makedirs(os.getenv("DOCUMENTS_DIR", "./data/documents"), exist_ok=True)
     os.makedirs(os.getenv("EMBEDDINGS_DIR", "./data/embeddings"), exist_ok=True)
+    # Warm the encoder and corpus index in the background; /ready reports when done
+    warmup = asyncio.create_task(asyncio.to_thread(warm_up))
+    # Merge the small segments written by ingestion into larger ones
+    compactor = Compactor(lambda: current_generation().path).start()
     yield
-    # Shutdown: Nothing to clean up for now
+    # Shutdown: stop background work
+    warmup.cancel()
+    await asyncio.to_thread(compactor.stop)
 
 
 # Create FastAPI app
@@ -31,7 +47,8 @@ app = FastAPI(
     title="RAG API",
     description="A simple Retrieval Augmented Generation API using OpenAI and FAISS",
     version="0.1.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -41,12 +58,56 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+
+class CompressionMiddleware(GZipMiddleware):
+    """Gzip responses for clients that accept it, except streamed NDJSON (gzip would buffer its lines)."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in UNCOMPRESSED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app.add_middleware(CompressionMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    """Observe request latency per route template (not per raw path, to keep label cardinality low)."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=str(status)
+        )
+
+
+@app.exception_handler(QuotaExceededError)
+async def quota_exceeded_handler(request: Request, exc: QuotaExceededError):
+    """Reject calls that do not fit into the upstream quota with 429 and a retry hint."""
+    return JSONResponse(
+        {"detail": str(exc)},
+        status_code=429,
+        headers={"Retry-After": str(max(math.ceil(exc.retry_after), 1))}
+    )
+
+
 # Include routers
 app.include_router(documents.router)
 app.include_router(qa.router)
 app.include_router(chat.router)
+app.include_router(chunks.router)
 
 
 @app.get("/health")
@@ -55,13 +116,46 @@ async def health_check():
     return {"status": "ok", "version": "0.1.0"}
 
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: 200 once the index is loaded and the configuration is complete, 503 before."""
+    return JSONResponse(readiness.to_dict(), status_code=200 if readiness.ready else 503)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics: stage latencies, token usage, cache hit rates and upstream outcomes."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/usage")
+async def usage():
+    """Upstream tokens and cost of this worker since start, and the savings of model routing."""
+    return {"process": PROCESS_USAGE.to_dict(), "routing": ROUTING_STATS.report()}
+
+
 def start():
-    """Run the API using uvicorn."""
+    """
+    Run the API using uvicorn.
+
+    API_WORKERS sets the number of worker processes; they share the corpus
+    segments through memory-mapped files, and chat sessions need a shared
+    store (SESSION_STORE=sqlite). API_RELOAD=true enables auto-reload for
+    development (single process only).
+    """
+    reload = os.getenv("API_RELOAD", "false").lower() in ("1", "true", "yes")
+    workers = None if reload else int(os.getenv("API_WORKERS", "1"))
+    if workers and workers > 1 and SESSION_STORE == "memory":
+        # Each worker would only know its own sessions; others answer 404
+        raise SystemExit(
+            f"API_WORKERS={workers} needs a session store shared between workers: set SESSION_STORE=sqlite"
+        )
     uvicorn.run(
         "api.app:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True
+        host=os.getenv("API_HOST", "0.0.0.0"),
+        port=int(os.getenv("API_PORT", "8000")),
+        reload=reload,
+        workers=workers
     )
 
 
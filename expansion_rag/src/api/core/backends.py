@@ -0,0 +1,171 @@
+"""Pluggable embedding and completion backends."""
+import hashlib
+import os
+import re
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .clients import create_chat_completion, create_embeddings
+
+# Backend used for embeddings: "openai" or "local"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+# Backend used for completions: "openai" or "stub"
+COMPLETION_BACKEND = os.getenv("COMPLETION_BACKEND", "openai")
+# Vector size of the local hashing embedder
+LOCAL_EMBEDDING_DIMENSIONS = int(os.getenv("LOCAL_EMBEDDING_DIMENSIONS", "384"))
+
+
+@dataclass
+class Completion:
+    """Text returned by a completion backend."""
+    text: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class EmbeddingBackend(ABC):
+    """Turns texts into vectors."""
+
+    name: str
+
+    @abstractmethod
+    def embed(self, texts: List[str], model: str, dimensions: Optional[int] = None) -> List[List[float]]:
+        """Embed texts, returning one vector per text in input order (dimensions=None: the model's width)."""
+
+
+class CompletionBackend(ABC):
+    """Generates chat completions."""
+
+    name: str
+
+    @abstractmethod
+    def complete(self, messages: List[Dict[str, str]], model: str, temperature: float = 0.0) -> Completion:
+        """Generate the next assistant message."""
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """Embeddings from the OpenAI API through the shared client."""
+
+    name = "openai"
+
+    def embed(self, texts: List[str], model: str, dimensions: Optional[int] = None) -> List[List[float]]:
+        # text-embedding-3 models return shortened vectors when asked for fewer dimensions
+        if dimensions:
+            return create_embeddings(texts, model, dimensions=dimensions)
+        return create_embeddings(texts, model)
+
+
+class OpenAICompletionBackend(CompletionBackend):
+    """Chat completions from the OpenAI API through the shared client."""
+
+    name = "openai"
+
+    def complete(self, messages: List[Dict[str, str]], model: str, temperature: float = 0.0) -> Completion:
+        response = create_chat_completion(model=model, messages=messages, temperature=temperature)
+        usage = response.usage
+        return Completion(
+            text=response.choices[0].message.content,
+            model=response.model,
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0
+        )
+
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """
+    Deterministic in-process embedder based on hashed character n-grams.
+
+    Texts sharing many n-grams get close vectors, which is enough for offline
+    tests and benchmarks of the retrieval pipeline. The model name is ignored;
+    dimensions overrides the vector size.
+    """
+
+    name = "local"
+
+    def __init__(self, dimensions: int = LOCAL_EMBEDDING_DIMENSIONS, ngram_sizes=(3, 4, 5)):
+        self.dimensions = dimensions
+        self.ngram_sizes = ngram_sizes
+
+    def embed_one(self, text: str, dimensions: Optional[int] = None) -> List[float]:
+        dimensions = dimensions or self.dimensions
+        vector = np.zeros(dimensions, dtype=np.float32)
+        text = " ".join(text.lower().split())
+        for n in self.ngram_sizes:
+            for i in range(max(len(text) - n + 1, 0)):
+                digest = hashlib.blake2b(text[i:i + n].encode(), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                # The hash picks both the dimension and the sign
+                vector[value % dimensions] += 1.0 if (value >> 32) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed(self, texts: List[str], model: str, dimensions: Optional[int] = None) -> List[List[float]]:
+        return [self.embed_one(text, dimensions) for text in texts]
+
+
+class StubCompletionBackend(CompletionBackend):
+    """
+    Canned-response completion backend for offline runs.
+
+    Query expansion requests get a numbered list of variants of the original
+    query; every other request gets a fixed answer quoting the start of the
+    retrieved context, so the output is deterministic.
+    """
+
+    name = "stub"
+
+    def complete(self, messages: List[Dict[str, str]], model: str, temperature: float = 0.0) -> Completion:
+        last = messages[-1]["content"] if messages else ""
+        expansion = re.match(r"Original query: '(.*)'\s+Generate (\d+) alternative queries", last, re.S)
+        if expansion:
+            query, count = expansion.group(1), int(expansion.group(2))
+            suffixes = ["", " requirements", " Anforderungen", " definition", " reporting"]
+            text = "\n".join(f"{i + 1}. {query}{suffixes[i % len(suffixes)]}" for i in range(count))
+        else:
+            context = next(
+                (m["content"] for m in messages if m["role"] == "system" and m["content"].startswith("Context:")),
+                ""
+            )
+            excerpt = " ".join(context.split()[1:60])
+            text = f"Stub answer to: {last}\n\nBased on the provided documents: {excerpt}"
+
+        prompt_tokens = sum(len(m["content"].split()) for m in messages)
+        return Completion(text=text, model=model, prompt_tokens=prompt_tokens, completion_tokens=len(text.split()))
+
+
+_EMBEDDING_BACKENDS = {
+    "openai": OpenAIEmbeddingBackend,
+    "local": HashingEmbeddingBackend,
+}
+_COMPLETION_BACKENDS = {
+    "openai": OpenAICompletionBackend,
+    "stub": StubCompletionBackend,
+}
+
+
+@lru_cache(maxsize=1)
+def get_embedding_backend() -> EmbeddingBackend:
+    """Return the embedding backend selected by EMBEDDING_BACKEND."""
+    if EMBEDDING_BACKEND not in _EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+    return _EMBEDDING_BACKENDS[EMBEDDING_BACKEND]()
+
+
+@lru_cache(maxsize=1)
+def get_completion_backend() -> CompletionBackend:
+    """Return the completion backend selected by COMPLETION_BACKEND."""
+    if COMPLETION_BACKEND not in _COMPLETION_BACKENDS:
+        raise ValueError(f"Unknown COMPLETION_BACKEND: {COMPLETION_BACKEND}")
+    return _COMPLETION_BACKENDS[COMPLETION_BACKEND]()
+
+
+def requires_openai_api_key() -> bool:
+    """Whether any configured backend calls the OpenAI API."""
+    return EMBEDDING_BACKEND == "openai" or COMPLETION_BACKEND == "openai"
@@ -0,0 +1,277 @@
+"""Shared OpenAI client with timeouts, retries, concurrency limits and a circuit breaker."""
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Callable, Iterator, List, Optional, TypeVar
+
+import httpx
+import openai
+from openai import OpenAI
+
+from .metrics import UPSTREAM_REQUESTS, record_tokens
+from .scheduler import QuotaExceededError, estimate_tokens, scheduler
+
+T = TypeVar("T")
+
+# Timeout of a single HTTP attempt
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))
+# Overall deadline of a call, including retries and waiting for a slot
+OPENAI_DEADLINE_SECONDS = float(os.getenv("OPENAI_DEADLINE_SECONDS", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_BACKOFF_BASE_SECONDS = float(os.getenv("OPENAI_BACKOFF_BASE_SECONDS", "0.5"))
+OPENAI_BACKOFF_MAX_SECONDS = float(os.getenv("OPENAI_BACKOFF_MAX_SECONDS", "8"))
+# HTTP connection pool shared by all calls
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "32"))
+# Outstanding calls allowed overall and per kind of traffic
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "32"))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "16"))
+COMPLETION_CONCURRENCY = int(os.getenv("COMPLETION_CONCURRENCY", "16"))
+# Completion tokens assumed for admission when a call sets no max_tokens
+COMPLETION_TOKEN_ESTIMATE = int(os.getenv("COMPLETION_TOKEN_ESTIMATE", "500"))
+# Consecutive failures that open the circuit, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+EMBEDDING = "embedding"
+COMPLETION = "completion"
+
+
+class UpstreamError(Exception):
+    """The upstream API could not be called."""
+
+
+class UpstreamBusyError(UpstreamError):
+    """No concurrency slot became free before the deadline."""
+
+
+class CircuitOpenError(UpstreamError):
+    """The circuit breaker is open after repeated upstream failures."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open trial call."""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return "half-open"
+            return "open"
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_running:
+                raise CircuitOpenError("Upstream API circuit is open after repeated failures")
+            self._trial_running = True
+
+    def release_trial(self) -> None:
+        """Give up a half-open trial that never reached the upstream API."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+_global_slots = threading.BoundedSemaphore(UPSTREAM_CONCURRENCY)
+_kind_slots = {
+    EMBEDDING: threading.BoundedSemaphore(EMBEDDING_CONCURRENCY),
+    COMPLETION: threading.BoundedSemaphore(COMPLETION_CONCURRENCY),
+}
+circuit_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+
+
+@lru_cache(maxsize=1)
+def get_client() -> OpenAI:
+    """Return the process-wide OpenAI client, created on first use."""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable is not set")
+
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=5.0),
+    )
+    # Retries are handled here so they share the deadline and the breaker
+    return OpenAI(api_key=api_key, http_client=http_client, max_retries=0, timeout=OPENAI_TIMEOUT_SECONDS)
+
+
+@contextmanager
+def _slot(kind: str, deadline: float) -> Iterator[None]:
+    """Hold a global and a per-kind concurrency slot until the block exits."""
+    kind_slots = _kind_slots[kind]
+    if not kind_slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+        raise UpstreamBusyError(f"Too many outstanding {kind} calls")
+    try:
+        if not _global_slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            raise UpstreamBusyError("Too many outstanding upstream calls")
+        try:
+            yield
+        finally:
+            _global_slots.release()
+    finally:
+        kind_slots.release()
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _never_sent(error: Exception) -> bool:
+    """Whether a failed attempt never reached the upstream API (no response and no timeout)."""
+    return not isinstance(error, (openai.APIStatusError, openai.APITimeoutError))
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Read a Retry-After hint from a failed response, if there is one."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def call_upstream(
+    kind: str,
+    call: Callable[[float], T],
+    deadline_seconds: float = OPENAI_DEADLINE_SECONDS,
+    tokens: int = 0
+) -> T:
+    """
+    Run an upstream call with quota admission, retries, concurrency limits and
+    the circuit breaker.
+
+    call receives the timeout (seconds) to use for one attempt, which never
+    exceeds the time left until the deadline. tokens is the estimated token
+    usage of one attempt, taken from the tokens-per-minute budget.
+
+    The breaker sees the call as a whole: it is checked once before the first
+    attempt and a failure is recorded only once the retries are exhausted.
+    Rate limiting (429) means the upstream API is up and never counts as a
+    failure.
+    """
+    deadline = time.monotonic() + deadline_seconds
+    attempt = 0
+    try:
+        circuit_breaker.before_call()
+    except CircuitOpenError:
+        UPSTREAM_REQUESTS.inc(kind=kind, outcome="circuit_open")
+        raise
+    while True:
+        admitted = False
+        try:
+            scheduler.acquire(tokens, deadline)
+            admitted = True
+            with _slot(kind, deadline):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise UpstreamBusyError(f"Deadline exceeded waiting for a {kind} slot")
+                result = call(min(OPENAI_TIMEOUT_SECONDS, remaining))
+        except QuotaExceededError:
+            circuit_breaker.release_trial()
+            UPSTREAM_REQUESTS.inc(kind=kind, outcome="rejected")
+            raise
+        except UpstreamBusyError:
+            # Local back pressure, not an upstream failure
+            if admitted:
+                scheduler.refund(tokens)
+            circuit_breaker.release_trial()
+            UPSTREAM_REQUESTS.inc(kind=kind, outcome="busy")
+            raise
+        except Exception as e:
+            if admitted and _never_sent(e):
+                scheduler.refund(tokens)
+            if not _is_retryable(e):
+                # Client errors (4xx) mean the upstream API answered; anything
+                # else never reached it
+                if isinstance(e, openai.APIStatusError):
+                    circuit_breaker.record_success()
+                else:
+                    circuit_breaker.release_trial()
+                UPSTREAM_REQUESTS.inc(kind=kind, outcome="error")
+                raise
+            delay = _retry_after(e) or _backoff(attempt)
+            attempt += 1
+            if attempt > OPENAI_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                if isinstance(e, openai.RateLimitError):
+                    circuit_breaker.record_success()
+                else:
+                    circuit_breaker.record_failure()
+                UPSTREAM_REQUESTS.inc(kind=kind, outcome="error")
+                raise
+            UPSTREAM_REQUESTS.inc(kind=kind, outcome="retry")
+            time.sleep(delay)
+            continue
+        circuit_breaker.record_success()
+        UPSTREAM_REQUESTS.inc(kind=kind, outcome="success")
+        return result
+
+
+def create_embeddings(texts: List[str], model: str, **kwargs: Any) -> List[List[float]]:
+    """Embed a batch of texts, returning vectors in input order."""
+    estimate = sum(estimate_tokens(text) for text in texts)
+    response = call_upstream(
+        EMBEDDING,
+        lambda timeout: get_client().embeddings.create(input=texts, model=model, timeout=timeout, **kwargs),
+        tokens=estimate
+    )
+    if response.usage is not None:
+        scheduler.settle(estimate, response.usage.prompt_tokens)
+        record_tokens("embedding", model, response.usage.prompt_tokens)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def create_chat_completion(**kwargs: Any) -> Any:
+    """Create a chat completion through the shared client."""
+    estimate = sum(estimate_tokens(message.get("content") or "") for message in kwargs.get("messages", []))
+    estimate += kwargs.get("max_tokens") or COMPLETION_TOKEN_ESTIMATE
+    response = call_upstream(
+        COMPLETION,
+        lambda timeout: get_client().chat.completions.create(timeout=timeout, **kwargs),
+        tokens=estimate
+    )
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        scheduler.settle(estimate, usage.total_tokens)
+        record_tokens("prompt", kwargs.get("model"), usage.prompt_tokens)
+        record_tokens("completion", kwargs.get("model"), usage.completion_tokens)
+    return response
+
@@ -0,0 +1,353 @@
+"""Portable corpus snapshots: the whole corpus of a node in one file.
+
+A snapshot is an uncompressed tar of the segments, per-document indexes and
+chunk stores of the current generation and the stored documents with their
+extracted text, followed by snapshot.json listing the embedding, the segments
+and the size and SHA-256 of every file. Export and import stream the archive
+in fixed-size blocks, so neither holds more than one block in memory.
+
+Importing writes the files into a new index generation and switches to it
+once every checksum matched; the segments are published as they are, so the
+node serves queries by mapping them, without parsing documents or calling
+the embedding API:
+
+    python -m src.api.core.corpus_snapshot export corpus.tar
+    python -m src.api.core.corpus_snapshot import corpus.tar
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from pathlib import Path, PurePosixPath
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from .document_processor import DOCUMENTS_DIR
+from .embeddings import EMBEDDINGS_DIR, current_generation
+from .generations import GENERATIONS_DIRNAME, EmbeddingConfig, Generation, create_generation, switch_generation
+from .index import embedded_document_ids, sync_segments
+from .snapshots import SEGMENTS_DIRNAME, compaction_lock, migration_lock, publish_lock, publish_manifest
+
+logger = logging.getLogger(__name__)
+
+FORMAT = "rag-corpus-snapshot"
+FORMAT_VERSION = 1
+SNAPSHOT_MANIFEST = "snapshot.json"
+EMBEDDINGS_PREFIX = "embeddings"
+DOCUMENTS_PREFIX = "documents"
+# Bytes read and written at a time
+COPY_BUFFER = 1024 * 1024
+# Snapshot imported at startup when the current generation has no documents (new replicas)
+CORPUS_SNAPSHOT = os.getenv("CORPUS_SNAPSHOT", "")
+
+
+class SnapshotError(Exception):
+    """A snapshot is invalid or does not match its manifest."""
+
+
+class SnapshotBusyError(SnapshotError):
+    """A migration or another import is replacing the corpus."""
+
+
+def _tar_header(name: str, size: int) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def _stream_file(name: str, f: BinaryIO, files: Dict[str, Dict[str, Any]]) -> Iterator[bytes]:
+    """Yield an open file as a tar member and record its size and checksum."""
+    # Files are replaced by rename, so the open file stays the one measured
+    size = os.fstat(f.fileno()).st_size
+    yield _tar_header(name, size)
+    digest = hashlib.sha256()
+    remaining = size
+    while remaining:
+        data = f.read(min(COPY_BUFFER, remaining))
+        if not data:
+            raise SnapshotError(f"{name} was truncated while exporting")
+        digest.update(data)
+        remaining -= len(data)
+        yield data
+    yield _padding(size)
+    files[name] = {"size": size, "sha256": digest.hexdigest()}
+
+
+def _segment_files(generation: Generation, manifest: Dict[str, Any]) -> List[Tuple[str, Path]]:
+    """Archive names and paths of the files of the published segments."""
+    members: List[Tuple[str, Path]] = []
+    for segment in manifest["segments"]:
+        segment_dir = generation.path / SEGMENTS_DIRNAME / segment["name"]
+        for path in sorted(segment_dir.iterdir()):
+            members.append((f"{EMBEDDINGS_PREFIX}/{SEGMENTS_DIRNAME}/{segment['name']}/{path.name}", path))
+    return members
+
+
+def _document_files(generation: Generation, manifest: Dict[str, Any]) -> List[Tuple[str, Path]]:
+    """Archive names and paths of the per-document indexes and chunks and the stored documents."""
+    members: List[Tuple[str, Path]] = []
+    for segment in manifest["segments"]:
+        for document_id in segment["document_ids"]:
+            for suffix in (".index", ".json"):
+                members.append((f"{EMBEDDINGS_PREFIX}/{document_id}{suffix}", generation.path / f"{document_id}{suffix}"))
+    if DOCUMENTS_DIR.exists():
+        for path in sorted(DOCUMENTS_DIR.rglob("*")):
+            if path.is_file() and not path.name.startswith("."):
+                members.append((f"{DOCUMENTS_PREFIX}/{path.relative_to(DOCUMENTS_DIR).as_posix()}", path))
+    return members
+
+
+def iter_snapshot(generation: Optional[Generation] = None) -> Iterator[bytes]:
+    """
+    Stream a snapshot of a generation (by default the current one) as tar data.
+
+    The segment files are opened before the download starts: a compaction or
+    rebuild may retire them and garbage collection delete them while a slow
+    client reads, but open files stay readable. Uploads continue and are
+    included if they were published before the export started.
+    """
+    generation = generation or current_generation()
+    start = time.perf_counter()
+    files: Dict[str, Dict[str, Any]] = {}
+    with ExitStack() as stack:
+        with compaction_lock(generation.path, blocking=True):
+            manifest = sync_segments(generation.path)
+            segments = [
+                (name, stack.enter_context(open(path, "rb"))) for name, path in _segment_files(generation, manifest)
+            ]
+        for name, f in segments:
+            yield from _stream_file(name, f, files)
+        # Per-document files and documents are never deleted, only replaced by rename
+        for name, path in _document_files(generation, manifest):
+            with open(path, "rb") as f:
+                yield from _stream_file(name, f, files)
+
+    snapshot = {
+        "format": FORMAT,
+        "version": FORMAT_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "generation": generation.name,
+        "embedding": generation.embedding.to_dict(),
+        "documents": manifest["documents"],
+        "chunks": manifest["chunks"],
+        "segments": manifest["segments"],
+        "files": files,
+    }
+    data = json.dumps(snapshot).encode("utf-8")
+    yield _tar_header(SNAPSHOT_MANIFEST, len(data))
+    yield data
+    yield _padding(len(data))
+    # End of archive
+    yield b"\0" * (2 * tarfile.BLOCKSIZE)
+    logger.info(
+        f"Exported snapshot of generation {generation.name}: {manifest['documents']} documents, "
+        f"{manifest['chunks']} chunks, {len(files)} files, "
+        f"{sum(f['size'] for f in files.values()) / 1e6:.1f} MB in {time.perf_counter() - start:.1f}s"
+    )
+
+
+def export_snapshot(path: Path) -> None:
+    """Write a snapshot of the current generation to a file."""
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            for data in iter_snapshot():
+                f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def _member_path(name: str) -> PurePosixPath:
+    """Validate an archive name; only relative paths below the known prefixes are accepted."""
+    path = PurePosixPath(name)
+    if path.is_absolute() or ".." in path.parts or path.parts[0] not in (EMBEDDINGS_PREFIX, DOCUMENTS_PREFIX):
+        raise SnapshotError(f"Unexpected file in snapshot: {name}")
+    return path
+
+
+def _extract(fileobj: BinaryIO, staging: Path) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """Extract a snapshot stream into a directory; returns its manifest and the size and checksum of each file."""
+    snapshot: Optional[Dict[str, Any]] = None
+    received: Dict[str, Dict[str, Any]] = {}
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+            for member in tar:
+                if not member.isfile():
+                    raise SnapshotError(f"Unexpected entry in snapshot: {member.name}")
+                source = tar.extractfile(member)
+                if member.name == SNAPSHOT_MANIFEST:
+                    snapshot = json.loads(source.read())
+                    continue
+
+                target = staging / _member_path(member.name)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                digest = hashlib.sha256()
+                with open(target, "wb") as f:
+                    while data := source.read(COPY_BUFFER):
+                        digest.update(data)
+                        f.write(data)
+                    os.fsync(f.fileno())
+                received[member.name] = {"size": member.size, "sha256": digest.hexdigest()}
+    except tarfile.TarError as e:
+        raise SnapshotError(f"Invalid snapshot archive: {e}")
+
+    if snapshot is None:
+        raise SnapshotError(f"Snapshot has no {SNAPSHOT_MANIFEST}; it is truncated or not a corpus snapshot")
+    if snapshot.get("format") != FORMAT or snapshot.get("version") != FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot format {snapshot.get('format')} version {snapshot.get('version')}")
+    return snapshot, received
+
+
+def _verify(snapshot: Dict[str, Any], received: Dict[str, Dict[str, Any]]) -> None:
+    expected = snapshot["files"]
+    missing = sorted(set(expected) - set(received))
+    unexpected = sorted(set(received) - set(expected))
+    corrupt = sorted(name for name in set(expected) & set(received) if expected[name] != received[name])
+    if missing or unexpected or corrupt:
+        raise SnapshotError(
+            f"Snapshot does not match its manifest: {len(missing)} missing, {len(unexpected)} unexpected, "
+            f"{len(corrupt)} corrupt files (e.g. {(missing + unexpected + corrupt)[0]})"
+        )
+
+
+def _move_documents(source: Path, destination: Path, keep: Optional[Path] = None) -> int:
+    """
+    Move documents and extracted texts from one directory tree to another.
+
+    Files that also exist below keep are left in place, as are hidden files
+    (uploads being written).
+    """
+    count = 0
+    if not source.exists():
+        return count
+    for path in sorted(source.rglob("*")):
+        relative = path.relative_to(source)
+        if not path.is_file() or path.name.startswith(".") or (keep is not None and (keep / relative).exists()):
+            continue
+        target = destination / relative
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(path), str(target))
+        count += 1
+    return count
+
+
+def _import(fileobj: BinaryIO) -> Dict[str, Any]:
+    """Import a snapshot into a new generation and switch to it. Call with migration_lock held."""
+    root = EMBEDDINGS_DIR
+    start = time.perf_counter()
+    name = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    staging = root / GENERATIONS_DIRNAME / f".import-{name}"
+    target = root / GENERATIONS_DIRNAME / name
+    staging.mkdir(parents=True)
+    replaced = staging / "replaced"
+    switched = installed = False
+    try:
+        snapshot, received = _extract(fileobj, staging)
+        _verify(snapshot, received)
+
+        embedding = EmbeddingConfig.from_dict(snapshot["embedding"])
+        (staging / EMBEDDINGS_PREFIX).mkdir(exist_ok=True)
+        os.rename(staging / EMBEDDINGS_PREFIX, target)
+        generation = create_generation(root, name, embedding)
+
+        # The segments are taken over as they are; only the manifest is new
+        covered = {document_id for segment in snapshot["segments"] for document_id in segment["document_ids"]}
+        if covered != embedded_document_ids(generation.path):
+            raise SnapshotError("The segments of the snapshot do not match its documents")
+        with publish_lock(generation.path):
+            publish_manifest(generation.path, snapshot["segments"])
+
+        # Documents the snapshot does not contain would be embedded into the imported generation
+        # by the next query, so they are moved out first and put back if the switch fails. The
+        # snapshot's own documents are installed only once it is served.
+        _move_documents(DOCUMENTS_DIR, replaced, keep=staging / DOCUMENTS_PREFIX)
+        try:
+            switch_generation(root, name)
+        except BaseException:
+            _move_documents(replaced, DOCUMENTS_DIR)
+            raise
+        switched = True
+        documents = _move_documents(staging / DOCUMENTS_PREFIX, DOCUMENTS_DIR)
+        installed = True
+    finally:
+        if switched and not installed:
+            logger.error(f"Generation {name} is served but its documents were not installed; they are in {staging}")
+        else:
+            shutil.rmtree(staging, ignore_errors=True)
+        if not switched:
+            shutil.rmtree(target, ignore_errors=True)
+
+    result = {
+        "generation": name,
+        "source_generation": snapshot["generation"],
+        "embedding": embedding.to_dict(),
+        "documents": snapshot["documents"],
+        "chunks": snapshot["chunks"],
+        "document_files": documents,
+        "bytes": sum(f["size"] for f in received.values()),
+        "seconds": time.perf_counter() - start,
+    }
+    logger.info(
+        f"Imported snapshot into generation {name}: {result['documents']} documents, {result['chunks']} chunks, "
+        f"{result['bytes'] / 1e6:.1f} MB in {result['seconds']:.1f}s"
+    )
+    return result
+
+
+def import_snapshot(fileobj: BinaryIO) -> Dict[str, Any]:
+    """
+    Replace the served corpus with a snapshot read from a stream.
+
+    Raises SnapshotBusyError while a migration or another import runs and
+    SnapshotError if the snapshot is invalid, in which case nothing changes.
+    Stored documents the snapshot does not contain are removed.
+    """
+    with migration_lock(EMBEDDINGS_DIR) as acquired:
+        if not acquired:
+            raise SnapshotBusyError("A migration or snapshot import is running")
+        return _import(fileobj)
+
+
+def bootstrap_from_snapshot(path: Path) -> Optional[Dict[str, Any]]:
+    """
+    Import a snapshot file if the current generation has no documents yet.
+
+    Workers starting together wait for the first one's import and then skip it.
+    """
+    with migration_lock(EMBEDDINGS_DIR, blocking=True):
+        if embedded_document_ids(current_generation().path):
+            return None
+        with open(path, "rb") as f:
+            return _import(f)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export or import a portable corpus snapshot")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", type=Path, help="Snapshot file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "export":
+        export_snapshot(args.path)
+    else:
+        with open(args.path, "rb") as f:
+            print(json.dumps(import_snapshot(f), indent=2))
+
+
+if __name__ == "__main__":
+    main()
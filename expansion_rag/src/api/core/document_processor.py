@@ -8,12 +8,16 @@ import pdfplumber
 import logging
 import time
 
+from .metrics import PDF_PAGES, stage
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Directory to store uploaded documents
 DOCUMENTS_DIR = Path(os.getenv("DOCUMENTS_DIR", "./src/api/data/documents"))
+# Text extracted from PDFs, kept next to the originals so they are parsed only once
+EXTRACTED_DIR = DOCUMENTS_DIR / "extracted"
 
 def process_text_document(
     file_content: str,
@@ -63,31 +67,35 @@ def process_pdf_with_retry(document_path: Path, max_retries: int = 3) -> Optiona
                         if page_num > 1:
                             time.sleep(0.1)
                         
-                        # First try normal text extraction
-                        text = page.extract_text(x_tolerance=3, y_tolerance=3)
-                        
-                        # If no text found, try with more permissive tolerances
-                        if not text or len(text.strip()) == 0:
-                            text = page.extract_text(x_tolerance=5, y_tolerance=8)
+                        with stage("pdf_page"):
+                            # First try normal text extraction
+                            text = page.extract_text(x_tolerance=3, y_tolerance=3)
                             
-                        # If still no text, try to extract tables and convert to text
-                        if not text or len(text.strip()) == 0:
-                            tables = page.extract_tables()
-                            if tables:
-                                table_texts = []
-                                for table in tables:
-                                    table_text = "\n".join([" | ".join([str(cell) if cell else "" for cell in row]) for row in table])
-                                    table_texts.append(table_text)
-                                text = "\n\n".join(table_texts)
+                            # If no text found, try with more permissive tolerances
+                            if not text or len(text.strip()) == 0:
+                                text = page.extract_text(x_tolerance=5, y_tolerance=8)
+                                
+                            # If still no text, try to extract tables and convert to text
+                            if not text or len(text.strip()) == 0:
+                                tables = page.extract_tables()
+                                if tables:
+                                    table_texts = []
+                                    for table in tables:
+                                        table_text = "\n".join([" | ".join([str(cell) if cell else "" for cell in row]) for row in table])
+                                        table_texts.append(table_text)
+                                    text = "\n\n".join(table_texts)
                         
                         if text:
                             # Clean up the text - remove excessive whitespace and normalize line breaks
                             text = " ".join([line.strip() for line in text.splitlines() if line.strip()])
                             text_parts.append(text)
+                            PDF_PAGES.inc(outcome="ok")
                             logger.info(f"Successfully extracted text from page {page_num}/{total_pages}")
                         else:
+                            PDF_PAGES.inc(outcome="empty")
                             logger.warning(f"No text extracted from page {page_num}/{total_pages}")
                     except Exception as page_error:
+                        PDF_PAGES.inc(outcome="error")
                         logger.error(f"Error extracting text from page {page_num}/{total_pages}: {str(page_error)}")
                         continue
                 
@@ -144,6 +152,7 @@ def save_uploaded_file(
             content = process_pdf_with_retry(document_path)
             if content is None:
                 raise ValueError("Failed to process PDF after all retries")
+            save_extracted_text(document_id, content)
         except Exception as e:
             logger.error(f"Error processing PDF {document_path}: {str(e)}")
             content = f"Error processing PDF: {str(e)}"
@@ -164,15 +173,30 @@ def save_uploaded_file(
         "metadata": doc_metadata
     }
 
+def save_extracted_text(document_id: str, content: str) -> None:
+    """Keep the text extracted from a document as a sidecar file."""
+    EXTRACTED_DIR.mkdir(parents=True, exist_ok=True)
+    with open(EXTRACTED_DIR / f"{document_id}.txt", "w", encoding="utf-8") as f:
+        f.write(content)
+
 def get_document_content(document_id: str) -> Optional[str]:
     """Retrieve the content of a stored document."""
+    # Parsed documents are read from their extracted text
+    extracted_path = EXTRACTED_DIR / f"{document_id}.txt"
+    if extracted_path.exists():
+        with open(extracted_path, "r", encoding="utf-8") as f:
+            return f.read()
+    
     # Look for the document in various extensions
     for ext in [".txt", ".md", ".csv", ".pdf"]:
         document_path = DOCUMENTS_DIR / f"{document_id}{ext}"
         if document_path.exists():
             if ext.lower() == ".pdf":
                 try:
-                    return process_pdf_with_retry(document_path)
+                    content = process_pdf_with_retry(document_path)
+                    if content is not None:
+                        save_extracted_text(document_id, content)
+                    return content
                 except Exception as e:
                     logger.error(f"Error reading PDF {document_path}: {str(e)}")
                     return None
@@ -1,52 +1,86 @@
 """Document embedding using OpenAI API."""
 import os
+import logging
 from typing import Dict, List, Optional, Any
 import numpy as np
 import tiktoken
-import openai
-from openai import OpenAI
 import faiss
 import pickle
 import json
+from functools import lru_cache
 from pathlib import Path
-from dotenv import load_dotenv
 from ..core.document_processor import get_document_content
+from .backends import get_embedding_backend
+from .singleflight import SingleFlight
+from .index import add_document_segment, get_corpus_index
+from .generations import EmbeddingConfig, Generation, current_generation as _current_generation, ensure_generation_file
+from .snapshots import atomic_write, read_manifest, write_json_atomic
+from .scheduler import BACKGROUND, QuotaExceededError, priority
+from .metrics import stage
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-# Get OpenAI API key
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
-
-# Initialize the OpenAI client
-client = OpenAI(api_key=api_key)
-
-# Default embedding model
-EMBEDDING_MODEL = "text-embedding-3-small"
-# Default encoding for token counting
-ENCODING = tiktoken.get_encoding("cl100k_base")
+# Embedding model and output dimension of new corpora and migrations (0 keeps the model's full width);
+# an existing corpus keeps the embedding it was built with until it is migrated
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0"))
+# Encoding used for token counting
+ENCODING_NAME = "cl100k_base"
 # Maximum tokens for embedding model
 MAX_TOKENS = 8191
-# Path to store the FAISS index
+# Root directory of the index generations (the original generation lives in the root itself)
 EMBEDDINGS_DIR = Path(os.getenv("EMBEDDINGS_DIR", "./src/api/data/embeddings"))
+# Maximum number of texts sent in one embedding request
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "128"))
+
+# Coalesces identical embedding requests that are in flight at the same time
+_embedding_flight: SingleFlight[List[float]] = SingleFlight("embedding_coalesce")
 
-def get_embedding(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
-    """Get embeddings for a text using OpenAI API."""
+def configured_embedding() -> EmbeddingConfig:
+    """The embedding selected by EMBEDDING_MODEL and EMBEDDING_DIMENSIONS."""
+    return EmbeddingConfig(EMBEDDING_MODEL, EMBEDDING_DIMENSIONS or None)
+
+def current_generation() -> Generation:
+    """The index generation being served, with the embedding its vectors were made with."""
+    return _current_generation(EMBEDDINGS_DIR, configured_embedding())
+
+def get_embedding(text: str, embedding: Optional[EmbeddingConfig] = None) -> List[float]:
+    """Get embeddings for a text, by default with the embedding of the current generation."""
+    embedding = embedding or current_generation().embedding
     text = text.replace("\n", " ")
-    return client.embeddings.create(input=[text], model=model).data[0].embedding
+    return _embedding_flight.do(
+        f"{embedding.model}\x00{embedding.dimensions}\x00{text}",
+        lambda: get_embedding_backend().embed([text], embedding.model, embedding.dimensions)[0]
+    )
+
+def get_embeddings(texts: List[str], embedding: Optional[EmbeddingConfig] = None) -> List[List[float]]:
+    """Get embeddings for many texts in as few API calls as possible."""
+    embedding = embedding or current_generation().embedding
+    cleaned = [text.replace("\n", " ") for text in texts]
+    # Embed each distinct text once
+    unique = list(dict.fromkeys(cleaned))
+    vectors: Dict[str, List[float]] = {}
+    for start in range(0, len(unique), EMBEDDING_BATCH_SIZE):
+        batch = unique[start:start + EMBEDDING_BATCH_SIZE]
+        vectors.update(zip(batch, get_embedding_backend().embed(batch, embedding.model, embedding.dimensions)))
+    return [vectors[text] for text in cleaned]
+
+@lru_cache(maxsize=1)
+def get_encoding() -> tiktoken.Encoding:
+    """Return the token encoding, loaded on first use (it may need to be downloaded)."""
+    return tiktoken.get_encoding(ENCODING_NAME)
 
 def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 100) -> List[str]:
     """Split text into overlapping chunks of tokens."""
-    tokens = ENCODING.encode(text)
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
     chunks = []
     
     for i in range(0, len(tokens), chunk_size - overlap):
         chunk_tokens = tokens[i:i + chunk_size]
         if len(chunk_tokens) < 10:  # Skip very small chunks
             continue
-        chunks.append(ENCODING.decode(chunk_tokens))
+        chunks.append(encoding.decode(chunk_tokens))
     
     return chunks
 
@@ -55,9 +89,15 @@ def create_document_embeddings(
     text: str, 
     metadata: Optional[Dict] = None
 ) -> Dict:
-    """Create embeddings for a document and store in FAISS index."""
-    # Create directory if it doesn't exist
-    EMBEDDINGS_DIR.mkdir(parents=True, exist_ok=True)
+    """
+    Create embeddings for a document and store in FAISS index.
+
+    Embedding calls run at background priority, behind interactive traffic.
+    The document is embedded into the current generation, with its embedding.
+    """
+    generation = current_generation()
+    generation.path.mkdir(parents=True, exist_ok=True)
+    ensure_generation_file(EMBEDDINGS_DIR, generation)
     
     # Always use the document_id for file naming, but store original filename in metadata
     # Split text into chunks
@@ -70,43 +110,51 @@ def create_document_embeddings(
         "metadata": metadata or {}
     }
     
-    # Get embeddings for each chunk
+    # Get embeddings in batches, falling back to single chunks if a batch fails
     embeddings = []
-    for i, chunk in enumerate(chunks):
+    for start in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+        batch = chunks[start:start + EMBEDDING_BATCH_SIZE]
         try:
-            embedding = get_embedding(chunk)
-            embeddings.append(embedding)
-            
+            with stage("embedding_batch"), priority(BACKGROUND):
+                batch_embeddings = get_embeddings(batch, generation.embedding)
+        except QuotaExceededError:
+            raise
+        except Exception as e:
+            logger.error(f"Error embedding chunks {start}-{start + len(batch) - 1}: {e}")
+            batch_embeddings = []
+            for i, chunk in enumerate(batch, start):
+                try:
+                    with priority(BACKGROUND):
+                        batch_embeddings.append(get_embedding(chunk, generation.embedding))
+                except QuotaExceededError:
+                    raise
+                except Exception as chunk_error:
+                    logger.error(f"Error embedding chunk {i}: {chunk_error}")
+                    batch_embeddings.append(None)
+        
+        for i, (chunk, embedding) in enumerate(zip(batch, batch_embeddings), start):
+            if embedding is None:
+                continue
             # Store chunk info
             document_data["chunks"].append({
                 "chunk_id": f"{document_id}_{i}",
                 "text": chunk,
-                "embedding_index": i
+                "embedding_index": len(embeddings)
             })
-        except Exception as e:
-            print(f"Error embedding chunk {i}: {e}")
+            embeddings.append(embedding)
     
     if not embeddings:
         return {"success": False, "error": "No valid embeddings created"}
     
     # Convert to numpy array for FAISS
     embeddings_array = np.array(embeddings, dtype=np.float32)
+    dimension = embeddings_array.shape[1]
+    write_document_index(generation.path, document_data, embeddings_array)
     
-    # Create or load existing index
-    index_path = EMBEDDINGS_DIR / f"{document_id}.index"
-    metadata_path = EMBEDDINGS_DIR / f"{document_id}.json"
-    
-    # Create FAISS index
-    dimension = len(embeddings[0])
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings_array)
-    
-    # Save index and metadata
-    faiss.write_index(index, str(index_path))
-    
-    # Save metadata
-    with open(metadata_path, "w") as f:
-        json.dump(document_data, f)
+    if current_generation() != generation:
+        # A migration cut over while this document was embedded; add it to the new generation too
+        logger.info(f"Index generation changed while embedding {document_id}; embedding it again")
+        return create_document_embeddings(document_id, text, metadata)
     
     return {
         "success": True,
@@ -115,14 +163,62 @@ def create_document_embeddings(
         "dimensions": dimension
     }
 
+def write_document_index(
+    embeddings_dir: Path,
+    document_data: Dict,
+    embeddings_array: np.ndarray,
+    publish: bool = True
+) -> None:
+    """Store a document's FAISS index and chunks and, with publish, make it searchable as a segment."""
+    document_id = document_data["document_id"]
+    index = faiss.IndexFlatL2(embeddings_array.shape[1])
+    index.add(embeddings_array)
+    
+    # Save index and metadata atomically, so readers never see a partial file
+    atomic_write(embeddings_dir / f"{document_id}.index", lambda path: faiss.write_index(index, str(path)))
+    write_json_atomic(embeddings_dir / f"{document_id}.json", document_data)
+    if not publish:
+        return
+    
+    # Make the document searchable in all workers
+    add_document_segment(
+        embeddings_dir,
+        document_id,
+        embeddings_array,
+        [chunk["chunk_id"] for chunk in document_data["chunks"]],
+        [chunk["text"] for chunk in document_data["chunks"]],
+        document_data["metadata"]
+    )
+
+def reembed_document(source: Generation, target: Generation, document_id: str) -> int:
+    """
+    Embed the stored chunks of a document of one generation into another.
+
+    The document is not published; the migration builds the segments of the
+    new generation at once. Returns the number of chunks.
+    """
+    with open(source.path / f"{document_id}.json", "r") as f:
+        document_data = json.load(f)
+    chunks = document_data.get("chunks", [])
+    if not chunks:
+        raise ValueError(f"Document {document_id} has no chunks")
+    
+    with stage("embedding_batch"), priority(BACKGROUND):
+        embeddings = get_embeddings([chunk["text"] for chunk in chunks], target.embedding)
+    for i, chunk in enumerate(chunks):
+        chunk["embedding_index"] = i
+    write_document_index(target.path, document_data, np.array(embeddings, dtype=np.float32), publish=False)
+    return len(chunks)
+
 def search_embeddings(
     document_id: str, 
     query: str, 
     top_k: int = 3
 ) -> List[Dict]:
     """Search document embeddings for similar chunks."""
-    index_path = EMBEDDINGS_DIR / f"{document_id}.index"
-    metadata_path = EMBEDDINGS_DIR / f"{document_id}.json"
+    generation = current_generation()
+    index_path = generation.path / f"{document_id}.index"
+    metadata_path = generation.path / f"{document_id}.json"
     
     if not index_path.exists() or not metadata_path.exists():
         return []
@@ -134,7 +230,7 @@ def search_embeddings(
         document_data = json.load(f)
     
     # Get query embedding
-    query_embedding = get_embedding(query)
+    query_embedding = get_embedding(query, generation.embedding)
     query_embedding_array = np.array([query_embedding], dtype=np.float32)
     
     # Search for similar chunks
@@ -153,53 +249,45 @@ def search_embeddings(
     
     return results 
 
-def search_all_documents(query: str, top_k: int = 3) -> List[Dict]:
-    """Search across all document embeddings for similar chunks."""
-    if not EMBEDDINGS_DIR.exists():
-        return []
-    
-    # Get all metadata files
-    metadata_files = list(EMBEDDINGS_DIR.glob("*.json"))
-    if not metadata_files:
+def search_all_documents(query: str, top_k: int = 3, filters: Optional[Dict[str, Any]] = None) -> List[Dict]:
+    """Search across all document embeddings for similar chunks, optionally restricted by filters."""
+    # Queries are embedded like the generation being searched, also during a cutover
+    generation = current_generation()
+    corpus = get_corpus_index(generation.path)
+    if corpus.size == 0:
         return []
     
     # Get query embedding
-    query_embedding = get_embedding(query)
+    with stage("query_embedding"):
+        query_embedding = get_embedding(query, generation.embedding)
     query_embedding_array = np.array([query_embedding], dtype=np.float32)
     
-    # Search across all documents
-    all_results = []
-    for metadata_file in metadata_files:
-        document_id = metadata_file.stem  # Get document_id from filename
-        
-        # Load index and metadata
-        index_path = metadata_file.with_suffix(".index")
-        if not index_path.exists():
-            continue
-            
-        index = faiss.read_index(str(index_path))
-        
-        with open(metadata_file, "r") as f:
-            document_data = json.load(f)
-        
-        # Search for similar chunks
-        distances, indices = index.search(query_embedding_array, top_k)
-        
-        # Add results with document context
-        for i, idx in enumerate(indices[0]):
-            if idx < len(document_data["chunks"]):
-                chunk = document_data["chunks"][idx]
-                all_results.append({
-                    "document_id": document_id,
-                    "chunk_id": chunk["chunk_id"],
-                    "text": chunk["text"],
-                    "score": float(distances[0][i]),
-                    "metadata": document_data.get("metadata", {})
-                })
+    return corpus.search(query_embedding_array, top_k, filters)[0]
+
+def search_all_documents_batch(
+    queries: List[str],
+    top_k: int = 3,
+    filters: Optional[Dict[str, Any]] = None
+) -> List[List[Dict]]:
+    """Search across all documents for many queries with bulk embedding and one matrix search."""
+    generation = current_generation()
+    corpus = get_corpus_index(generation.path)
+    if corpus.size == 0 or not queries:
+        return [[] for _ in queries]
     
-    # Sort by score and take top_k results
-    all_results.sort(key=lambda x: x["score"])
-    return all_results[:top_k] 
+    with stage("query_embedding"):
+        query_embeddings = np.array(get_embeddings(queries, generation.embedding), dtype=np.float32)
+    return corpus.search(query_embeddings, top_k, filters)
+
+def corpus_version() -> str:
+    """Identify the published corpus: the generation and its manifest version."""
+    generation = current_generation()
+    manifest = read_manifest(generation.path) or {}
+    return f"{generation.name}:{manifest.get('version', 0)}"
+
+def get_chunk(chunk_id: str) -> Optional[Dict]:
+    """Get a chunk of the corpus by id, or None if it is not in the index."""
+    return get_corpus_index(current_generation().path).get_chunk(chunk_id)
 
 def get_all_documents() -> List[Dict]:
     """Get list of all documents in the documents directory."""
@@ -219,12 +307,13 @@ def get_all_documents() -> List[Dict]:
     return documents
 
 def get_all_embedded_documents() -> List[str]:
-    """Get list of document IDs that have embeddings."""
-    if not EMBEDDINGS_DIR.exists():
+    """Get list of document IDs that have embeddings in the current generation."""
+    embeddings_dir = current_generation().path
+    if not embeddings_dir.exists():
         return []
     
     embedded_docs = []
-    for metadata_file in EMBEDDINGS_DIR.glob("*.json"):
+    for metadata_file in embeddings_dir.glob("*.json"):
         if metadata_file.with_suffix(".index").exists():
             embedded_docs.append(metadata_file.stem)
     return embedded_docs
@@ -284,6 +373,14 @@ def process_missing_embeddings() -> Dict[str, Any]:
                 "error": result.get("error")
             })
             
+        except QuotaExceededError as e:
+            # The remaining documents stay missing and are picked up next time
+            results.append({
+                "document_id": doc["document_id"],
+                "success": False,
+                "error": str(e)
+            })
+            break
         except Exception as e:
             results.append({
                 "document_id": doc["document_id"],
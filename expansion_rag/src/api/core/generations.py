@@ -0,0 +1,129 @@
+"""Index generations: complete corpora embedded with one model, switched atomically.
+
+Each generation is a directory with the per-document indexes, segments and
+manifest of the corpus, embedded with one embedding model and output
+dimension. <root>/current_generation.json names the generation being served;
+without it the root directory itself is the (original) generation. A
+migration builds a new generation next to the current one and then replaces
+the pointer, so workers switch on their next query.
+"""
+import json
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from .snapshots import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+GENERATIONS_DIRNAME = "generations"
+CURRENT_NAME = "current_generation.json"
+GENERATION_NAME = "generation.json"
+ROOT_GENERATION = "initial"
+
+# Model of corpora embedded before the embedding model became configurable
+LEGACY_EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+@dataclass(frozen=True)
+class EmbeddingConfig:
+    """Embedding model and output dimension (None for the model's full width)."""
+    model: str
+    dimensions: Optional[int] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"model": self.model, "dimensions": self.dimensions}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "EmbeddingConfig":
+        return cls(model=data["model"], dimensions=data.get("dimensions"))
+
+
+@dataclass(frozen=True)
+class Generation:
+    """A corpus directory and the embedding its vectors were made with."""
+    name: str
+    path: Path
+    embedding: EmbeddingConfig
+
+
+def generation_path(root: Path, name: str) -> Path:
+    return root if name == ROOT_GENERATION else root / GENERATIONS_DIRNAME / name
+
+
+def _read_json(path: Path) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _load_generation(root: Path, name: str, default: EmbeddingConfig) -> Generation:
+    path = generation_path(root, name)
+    info = _read_json(path / GENERATION_NAME)
+    if info is not None:
+        embedding = EmbeddingConfig.from_dict(info["embedding"])
+    elif any(path.glob("*.index")):
+        # Written before generations existed, always with the legacy model
+        embedding = EmbeddingConfig(LEGACY_EMBEDDING_MODEL)
+    else:
+        embedding = default
+    return Generation(name, path, embedding)
+
+
+def create_generation(root: Path, name: str, embedding: EmbeddingConfig) -> Generation:
+    """Create an empty generation directory recording its embedding."""
+    path = generation_path(root, name)
+    path.mkdir(parents=True, exist_ok=True)
+    write_json_atomic(path / GENERATION_NAME, {
+        "name": name,
+        "embedding": embedding.to_dict(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    })
+    return Generation(name, path, embedding)
+
+
+def ensure_generation_file(root: Path, generation: Generation) -> None:
+    """Record the embedding of a generation that has no file yet (the original root directory)."""
+    if not (generation.path / GENERATION_NAME).exists():
+        create_generation(root, generation.name, generation.embedding)
+
+
+def switch_generation(root: Path, name: str) -> None:
+    """Make a generation current; workers switch on their next lookup."""
+    write_json_atomic(root / CURRENT_NAME, {"name": name, "switched_at": datetime.now(timezone.utc).isoformat()})
+    logger.info(f"Switched to index generation {name}")
+
+
+_cache: Dict[str, Tuple[Optional[Tuple], Generation]] = {}
+_cache_lock = threading.Lock()
+
+
+def current_generation(root: Path, default: EmbeddingConfig) -> Generation:
+    """
+    Return the generation being served under root.
+
+    default is the embedding of a new, empty corpus. The pointer file is
+    stat'ed on every call and only read again when it was replaced.
+    """
+    try:
+        stat = (root / CURRENT_NAME).stat()
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        signature = None
+
+    key = str(root)
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    pointer = _read_json(root / CURRENT_NAME) if signature is not None else None
+    generation = _load_generation(root, pointer["name"] if pointer else ROOT_GENERATION, default)
+    with _cache_lock:
+        _cache[key] = (signature, generation)
+    return generation
@@ -0,0 +1,610 @@
+"""Corpus index over the published segments, with segment publishing and background compaction."""
+import contextvars
+import fnmatch
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import faiss
+import numpy as np
+
+from .metrics import CORPUS_CHUNKS, CORPUS_SEGMENTS, record_cache, stage
+from .profiling import record_scan, run_attributed
+from .snapshots import (
+    compaction_lock, discard_segment, load_segment, publish_lock, publish_manifest, read_manifest,
+    remove_legacy_snapshots, write_segment, MANIFEST_NAME, SegmentChunks
+)
+
+logger = logging.getLogger(__name__)
+
+# Number of resolved filters kept per corpus index
+FILTER_CACHE_SIZE = 256
+# Filters whose rows form at most this many contiguous runs are searched in place, on views of the vectors
+FILTER_MAX_RUNS = int(os.getenv("FILTER_MAX_RUNS", "16"))
+# Bytes of copied vectors kept per segment for filters matching rows scattered over more runs
+FILTER_SUBSET_CACHE_BYTES = int(os.getenv("FILTER_SUBSET_CACHE_BYTES", str(64 * 1024 * 1024)))
+# Threads searching segments in parallel (FAISS releases the GIL while scanning)
+SEARCH_THREADS = int(os.getenv("SEARCH_THREADS", str(min(8, os.cpu_count() or 1))))
+# OpenMP threads FAISS uses within one search; 0 keeps the FAISS default
+FAISS_OMP_THREADS = int(os.getenv("FAISS_OMP_THREADS", "0"))
+# Unsealed segments that trigger a compaction
+COMPACTION_TRIGGER = int(os.getenv("COMPACTION_TRIGGER", "8"))
+# Segments with at least this many chunks are sealed and no longer merged
+SEGMENT_SEAL_CHUNKS = int(os.getenv("SEGMENT_SEAL_CHUNKS", "50000"))
+# Seconds between two compaction checks
+COMPACTION_INTERVAL_SECONDS = float(os.getenv("COMPACTION_INTERVAL_SECONDS", "30"))
+
+if FAISS_OMP_THREADS > 0:
+    faiss.omp_set_num_threads(FAISS_OMP_THREADS)
+
+_search_pool = ThreadPoolExecutor(max_workers=max(SEARCH_THREADS, 1), thread_name_prefix="segment-search")
+
+
+def _normalize_file_type(file_type: str) -> str:
+    file_type = file_type.lower()
+    return file_type if file_type.startswith(".") else f".{file_type}"
+
+
+def document_matches(document_id: str, metadata: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    """
+    Check a document against a filter expression.
+
+    Supported keys (all optional, combined with AND): document_ids, filenames
+    (case-insensitive glob patterns), file_types and metadata (exact matches;
+    a list matches any of its values).
+    """
+    document_ids = filters.get("document_ids")
+    if document_ids and document_id not in document_ids:
+        return False
+
+    filename = metadata.get("filename") or ""
+    patterns = filters.get("filenames")
+    if patterns and not any(fnmatch.fnmatch(filename.lower(), p.lower()) for p in patterns):
+        return False
+
+    file_types = filters.get("file_types")
+    if file_types:
+        file_type = metadata.get("file_type") or Path(filename).suffix
+        if not file_type or _normalize_file_type(file_type) not in {_normalize_file_type(t) for t in file_types}:
+            return False
+
+    for key, expected in (filters.get("metadata") or {}).items():
+        value = metadata.get(key)
+        if isinstance(expected, list):
+            if value not in expected:
+                return False
+        elif value != expected:
+            return False
+
+    return True
+
+
+class ResolvedFilter:
+    """Rows of the chunks matching a filter, as ids and contiguous runs, and the copied vectors of scattered rows."""
+    __slots__ = ("ids", "document_count", "runs", "subset")
+
+    def __init__(self, ids: np.ndarray, document_count: int, runs: List[Tuple[int, int]]):
+        self.ids = ids
+        self.document_count = document_count
+        self.runs = runs
+        self.subset: Optional[np.ndarray] = None
+
+
+class Segment:
+    """
+    The vectors of one segment in one matrix, with the chunk behind each row.
+
+    Searching one matrix with a batch of queries replaces loading and scanning
+    every per-document index for every query. The vectors may be a read-only
+    memory map of a published segment.
+    """
+
+    def __init__(self, name: str, vectors: Optional[np.ndarray], chunks: SegmentChunks, documents: Dict[str, Dict]):
+        self.name = name
+        self.vectors = vectors
+        self.chunks = chunks
+        # Catalog: document_id -> metadata and the range of rows holding its chunks
+        self.documents = documents
+        # Filter expression -> matching rows
+        self._filter_cache: Dict[str, ResolvedFilter] = {}
+        self._subset_bytes = 0
+        self._filter_lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return len(self.chunks)
+
+    @property
+    def dimension(self) -> Optional[int]:
+        return None if self.vectors is None else int(self.vectors.shape[1])
+
+    def filter_ids(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Resolve a filter expression to the row ids of the matching chunks, via the catalog."""
+        return self._resolve_filter(filters).ids
+
+    def _resolve_filter(self, filters: Dict[str, Any]) -> ResolvedFilter:
+        key = json.dumps(filters, sort_keys=True, default=str)
+        with self._filter_lock:
+            resolved = self._filter_cache.get(key)
+        record_cache("filter", hit=resolved is not None)
+        if resolved is not None:
+            return resolved
+
+        matching = sorted(
+            (doc["start"], doc["start"] + doc["count"])
+            for document_id, doc in self.documents.items()
+            if document_matches(document_id, doc["metadata"], filters)
+        )
+        # A document's chunks are contiguous rows; adjacent documents form one run
+        runs: List[Tuple[int, int]] = []
+        for start, end in matching:
+            if runs and runs[-1][1] == start:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((start, end))
+        ids = (
+            np.concatenate([np.arange(start, end, dtype=np.int64) for start, end in runs])
+            if runs else np.empty(0, dtype=np.int64)
+        )
+        resolved = ResolvedFilter(ids, len(matching), runs)
+
+        with self._filter_lock:
+            if len(self._filter_cache) >= FILTER_CACHE_SIZE:
+                self._filter_cache.clear()
+                self._subset_bytes = 0
+            self._filter_cache[key] = resolved
+        return resolved
+
+    def _filtered_vectors(self, resolved: ResolvedFilter) -> np.ndarray:
+        """The vectors of scattered filtered rows as one matrix, copied once while the cache budget allows."""
+        if resolved.subset is not None:
+            return resolved.subset
+        subset = np.ascontiguousarray(self.vectors[resolved.ids])
+        with self._filter_lock:
+            if resolved.subset is None and self._subset_bytes + subset.nbytes <= FILTER_SUBSET_CACHE_BYTES:
+                resolved.subset = subset
+                self._subset_bytes += subset.nbytes
+        return subset
+
+    def _search_runs(
+        self,
+        query_vectors: np.ndarray,
+        runs: List[Tuple[int, int]],
+        k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search contiguous row ranges in place and keep the nearest k rows over all of them."""
+        all_distances, all_indices = [], []
+        for start, end in runs:
+            distances, indices = faiss.knn(query_vectors, self.vectors[start:end], min(k, end - start))
+            all_distances.append(distances)
+            all_indices.append(np.where(indices >= 0, indices + start, -1))
+        if len(runs) == 1:
+            return all_distances[0], all_indices[0]
+        distances, indices = np.hstack(all_distances), np.hstack(all_indices)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    def get_chunk(self, document_id: str, chunk_id: str) -> Optional[Dict]:
+        """Look up a chunk within the rows of its document."""
+        document = self.documents.get(document_id)
+        if document is None:
+            return None
+        start = document["start"]
+        try:
+            return self.chunks[self.chunks.chunk_ids.index(chunk_id, start, start + document["count"])]
+        except ValueError:
+            return None
+
+    def search(
+        self,
+        query_vectors: np.ndarray,
+        top_k: int,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> Optional[Tuple[np.ndarray, np.ndarray, int, int]]:
+        """
+        Exact search of the segment.
+
+        Returns the distances and rows of the nearest chunks per query (sorted
+        by distance, -1 for missing rows) and the number of documents and
+        vectors scanned per query, or None if no chunk matches the filters.
+        """
+        if self.vectors is None:
+            return None
+        if filters:
+            resolved = self._resolve_filter(filters)
+            ids = resolved.ids
+            if len(ids) == 0:
+                return None
+            k = min(top_k, len(ids))
+            if len(resolved.runs) <= FILTER_MAX_RUNS:
+                # Row ranges of a memory map are views; nothing is copied per query
+                distances, indices = self._search_runs(query_vectors, resolved.runs, k)
+            else:
+                distances, indices = faiss.knn(query_vectors, self._filtered_vectors(resolved), k)
+                # Map positions in the filtered subset back to segment rows
+                indices = np.where(indices >= 0, ids[np.maximum(indices, 0)], -1)
+            return distances, indices, resolved.document_count, len(ids)
+
+        k = min(top_k, len(self.vectors))
+        distances, indices = faiss.knn(query_vectors, self.vectors, k)
+        return distances, indices, len(self.documents), len(self.vectors)
+
+
+class CorpusIndex:
+    """
+    The segments of the current manifest, searched as one corpus.
+
+    Segments are scanned in parallel on the search thread pool and the
+    nearest chunks of each segment are merged by distance, so results are the
+    same as searching one matrix holding every vector.
+    """
+
+    def __init__(self, segments: Sequence[Segment] = ()):
+        self.segments = [segment for segment in segments if segment.size]
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    @property
+    def dimension(self) -> Optional[int]:
+        return self.segments[0].dimension if self.segments else None
+
+    @classmethod
+    def from_manifest(
+        cls,
+        embeddings_dir: Path,
+        manifest: Dict[str, Any],
+        previous: Optional["CorpusIndex"] = None
+    ) -> "CorpusIndex":
+        """Map the segments of a manifest, reusing those the previous index already mapped."""
+        mapped = {segment.name: segment for segment in previous.segments} if previous is not None else {}
+        segments = []
+        for entry in manifest.get("segments", []):
+            if not entry["chunks"]:
+                continue
+            segment = mapped.get(entry["name"])
+            if segment is None:
+                segment = Segment(entry["name"], *load_segment(embeddings_dir, entry))
+            segments.append(segment)
+        return cls(segments)
+
+    def get_chunk(self, chunk_id: str) -> Optional[Dict]:
+        """Look up a chunk by id ("<document_id>_<n>") through the segment catalogs."""
+        document_id = chunk_id.rsplit("_", 1)[0]
+        for segment in self.segments:
+            chunk = segment.get_chunk(document_id, chunk_id)
+            if chunk is not None:
+                return chunk
+        return None
+
+    def search(
+        self,
+        query_vectors: np.ndarray,
+        top_k: int,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict]]:
+        """
+        Search the corpus with a matrix of query vectors, one result list per query.
+
+        Scores are squared L2 distances (exact search). With filters, only the
+        chunks of matching documents are scored.
+        """
+        if not self.segments or len(query_vectors) == 0:
+            return [[] for _ in range(len(query_vectors))]
+
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+        with stage("index_search"):
+            if len(self.segments) == 1:
+                results = [self.segments[0].search(query_vectors, top_k, filters)]
+            else:
+                futures = [
+                    _search_pool.submit(
+                        contextvars.copy_context().run, run_attributed, segment.search, query_vectors, top_k, filters
+                    )
+                    for segment in self.segments
+                ]
+                results = [future.result() for future in futures]
+            found = [(segment, result) for segment, result in zip(self.segments, results) if result is not None]
+            record_scan(
+                sum(result[2] for _, result in found) * len(query_vectors),
+                sum(result[3] for _, result in found) * len(query_vectors)
+            )
+
+        with stage("chunk_fetch"):
+            merged = []
+            for query in range(len(query_vectors)):
+                # Each segment's hits are sorted by distance; merge them and keep the nearest top_k
+                hits = heapq.merge(*(
+                    [
+                        (float(distance), number, int(idx))
+                        for distance, idx in zip(distances[query], indices[query]) if idx >= 0
+                    ]
+                    for number, (_, (distances, indices, _, _)) in enumerate(found)
+                ))
+                merged.append([
+                    {**found[number][0].chunks[idx], "score": distance}
+                    for distance, number, idx in itertools.islice(hits, top_k)
+                ])
+        return merged
+
+
+def embedded_document_ids(embeddings_dir: Path) -> Set[str]:
+    """Documents with per-document index files."""
+    return {path.stem for path in embeddings_dir.glob("*.json") if path.with_suffix(".index").exists()}
+
+
+def _segments_dimension(segments: List[Dict[str, Any]]) -> Optional[int]:
+    return next((segment["dimension"] for segment in segments if segment.get("dimension")), None)
+
+
+def _read_documents(
+    embeddings_dir: Path,
+    document_ids: Set[str],
+    dimension: Optional[int] = None
+) -> Tuple[np.ndarray, List[str], List[str], Dict[str, Dict]]:
+    """Read the vectors, chunk ids, texts and catalog of some documents from their per-document files."""
+    vectors: List[np.ndarray] = []
+    chunk_ids: List[str] = []
+    texts: List[str] = []
+    documents: Dict[str, Dict] = {}
+
+    for document_id in sorted(document_ids):
+        index_path = embeddings_dir / f"{document_id}.index"
+        try:
+            document_index = faiss.read_index(str(index_path))
+            with open(embeddings_dir / f"{document_id}.json", "r") as f:
+                document_data = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading index {index_path}: {str(e)}")
+            continue
+
+        if dimension is None:
+            dimension = document_index.d
+        if document_index.d != dimension:
+            logger.warning(f"Skipping {index_path}: dimension {document_index.d} != {dimension}")
+            continue
+
+        document_chunks = document_data.get("chunks", [])
+        count = min(document_index.ntotal, len(document_chunks))
+        if count == 0:
+            continue
+
+        documents[document_id] = {"metadata": document_data.get("metadata", {}), "start": len(chunk_ids), "count": count}
+        vectors.append(document_index.reconstruct_n(0, count))
+        for chunk in document_chunks[:count]:
+            chunk_ids.append(chunk["chunk_id"])
+            texts.append(chunk["text"])
+
+    if not vectors:
+        return np.empty((0, dimension or 0), dtype=np.float32), [], [], {}
+    return np.vstack(vectors).astype(np.float32), chunk_ids, texts, documents
+
+
+def sync_segments(embeddings_dir: Path, rebuild: bool = False) -> Dict[str, Any]:
+    """
+    Bring the segments in line with the per-document files and return the current manifest.
+
+    Documents without a segment (e.g. written while no server was running)
+    are added as one new segment. If documents listed in the segments are
+    gone, or with rebuild, every document is written into a fresh segment.
+    A directory still in the single-snapshot layout is rebuilt the same way.
+    Safe to call from several processes: publishing is serialized by a file lock.
+    """
+    with publish_lock(embeddings_dir):
+        manifest = read_manifest(embeddings_dir)
+        segments = manifest["segments"] if manifest is not None else []
+        covered = {document_id for segment in segments for document_id in segment["document_ids"]}
+        on_disk = embedded_document_ids(embeddings_dir)
+        if rebuild or not covered <= on_disk:
+            segments, covered = [], set()
+
+        missing = on_disk - covered
+        if manifest is not None and not missing and segments is manifest["segments"]:
+            return manifest
+
+        with stage("segment_publish"):
+            vectors, chunk_ids, texts, documents = _read_documents(
+                embeddings_dir, missing, _segments_dimension(segments)
+            )
+            if chunk_ids:
+                entry = write_segment(
+                    embeddings_dir, vectors, chunk_ids, texts, documents,
+                    sealed=len(chunk_ids) >= SEGMENT_SEAL_CHUNKS
+                )
+                segments = segments + [entry]
+            manifest = publish_manifest(embeddings_dir, segments)
+        remove_legacy_snapshots(embeddings_dir)
+        return manifest
+
+
+def add_document_segment(
+    embeddings_dir: Path,
+    document_id: str,
+    vectors: np.ndarray,
+    chunk_ids: List[str],
+    texts: List[str],
+    metadata: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Publish a newly embedded document as a small segment of its own.
+
+    Only the document's own vectors are written, so ingestion cost does not
+    grow with the corpus. Returns the current manifest.
+    """
+    documents = {document_id: {"metadata": metadata, "start": 0, "count": len(chunk_ids)}}
+    with stage("segment_publish"):
+        entry = write_segment(embeddings_dir, vectors, chunk_ids, texts, documents)
+        with publish_lock(embeddings_dir):
+            manifest = read_manifest(embeddings_dir)
+            if manifest is not None:
+                segments = manifest["segments"]
+                dimension = _segments_dimension(segments)
+                if dimension is not None and dimension != entry["dimension"]:
+                    discard_segment(embeddings_dir, entry["name"])
+                    logger.warning(
+                        f"Not publishing document {document_id}: dimension {entry['dimension']} != {dimension}"
+                    )
+                    return manifest
+                if not any(document_id in segment["document_ids"] for segment in segments):
+                    return publish_manifest(embeddings_dir, segments + [entry])
+
+    # No manifest yet, or the document replaces chunks held by other segments
+    discard_segment(embeddings_dir, entry["name"])
+    return sync_segments(embeddings_dir, rebuild=manifest is not None)
+
+
+def compact_segments(embeddings_dir: Path) -> Optional[Dict[str, Any]]:
+    """
+    Merge the unsealed segments into one once there are COMPACTION_TRIGGER of them.
+
+    The merged segment is written without holding the publish lock, so
+    ingestion goes on meanwhile, and published only if all the merged
+    segments are still current. Returns the new manifest, or None if nothing
+    was compacted.
+    """
+    with compaction_lock(embeddings_dir) as acquired:
+        if not acquired:
+            return None
+        manifest = read_manifest(embeddings_dir)
+        if manifest is None:
+            return None
+        small = [segment for segment in manifest["segments"] if not segment.get("sealed")]
+        if len(small) < COMPACTION_TRIGGER:
+            return None
+
+        with stage("compaction"):
+            vectors: List[np.ndarray] = []
+            chunk_ids: List[str] = []
+            texts: List[str] = []
+            documents: Dict[str, Dict] = {}
+            for entry in small:
+                if not entry["chunks"]:
+                    continue
+                segment_vectors, chunks, segment_documents = load_segment(embeddings_dir, entry)
+                offset = len(chunk_ids)
+                vectors.append(np.asarray(segment_vectors))
+                chunk_ids.extend(chunks.chunk_ids)
+                texts.extend(chunks.text(row) for row in range(len(chunks)))
+                for document_id, document in segment_documents.items():
+                    documents[document_id] = {**document, "start": document["start"] + offset}
+
+            merged = write_segment(
+                embeddings_dir,
+                np.vstack(vectors) if vectors else np.empty((0, 0), dtype=np.float32),
+                chunk_ids, texts, documents,
+                sealed=len(chunk_ids) >= SEGMENT_SEAL_CHUNKS
+            )
+
+            names = {entry["name"] for entry in small}
+            with publish_lock(embeddings_dir):
+                current = read_manifest(embeddings_dir) or {"segments": []}
+                if not names <= {segment["name"] for segment in current["segments"]}:
+                    # The segments were rebuilt meanwhile
+                    discard_segment(embeddings_dir, merged["name"])
+                    return None
+                manifest = publish_manifest(
+                    embeddings_dir,
+                    [segment for segment in current["segments"] if segment["name"] not in names] + [merged]
+                )
+
+    logger.info(f"Compacted {len(small)} segments into {merged['name']} ({merged['chunks']} chunks)")
+    return manifest
+
+
+class Compactor:
+    """Background thread compacting the segments of the current directory at a fixed interval."""
+
+    def __init__(self, embeddings_dir: Callable[[], Path], interval: float = COMPACTION_INTERVAL_SECONDS):
+        self.embeddings_dir = embeddings_dir
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="segment-compactor", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                compact_segments(self.embeddings_dir())
+            except Exception as e:
+                logger.error(f"Error compacting segments: {e}")
+
+    def start(self) -> "Compactor":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+
+_corpus: Optional[CorpusIndex] = None
+_corpus_signature: Optional[Tuple] = None
+_corpus_lock = threading.Lock()
+
+
+def _manifest_signature(embeddings_dir: Path) -> Optional[Tuple]:
+    """Identity of the manifest file; it is replaced (new inode) on every publish."""
+    try:
+        stat = (embeddings_dir / MANIFEST_NAME).stat()
+    except FileNotFoundError:
+        return None
+    return (str(embeddings_dir), stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def get_corpus_index(embeddings_dir: Path) -> CorpusIndex:
+    """
+    Return the corpus index of the current manifest, switching when a new one is published.
+
+    Searches already running keep the index they started with. Segments the
+    previous index already mapped are reused, so publishing a small segment
+    only maps that segment. While one thread switches to a new version of
+    the same directory, the others keep serving the previous index instead
+    of waiting; after a generation switch they wait for the new index.
+    """
+    global _corpus, _corpus_signature
+
+    if not embeddings_dir.exists():
+        return CorpusIndex()
+
+    signature = _manifest_signature(embeddings_dir)
+    if signature is None:
+        # Nothing published yet (e.g. a directory written by an older version)
+        if not any(embeddings_dir.glob("*.index")):
+            return CorpusIndex()
+        sync_segments(embeddings_dir)
+        signature = _manifest_signature(embeddings_dir)
+
+    current = _corpus
+    if current is not None and signature == _corpus_signature:
+        return current
+
+    # A previous version of the same directory may keep serving; an index of
+    # another directory (generation) has other vectors, so wait for this one
+    same_dir = current is not None and _corpus_signature is not None and _corpus_signature[0] == signature[0]
+    if not _corpus_lock.acquire(blocking=not same_dir):
+        return current
+    try:
+        if _corpus is None or signature != _corpus_signature:
+            manifest = read_manifest(embeddings_dir)
+            if manifest is None:
+                # Still in the single-snapshot layout
+                manifest = sync_segments(embeddings_dir)
+                signature = _manifest_signature(embeddings_dir)
+            previous = _corpus if _corpus_signature is not None and _corpus_signature[0] == signature[0] else None
+            with stage("corpus_load"):
+                _corpus = CorpusIndex.from_manifest(embeddings_dir, manifest, previous)
+            _corpus_signature = signature
+            CORPUS_CHUNKS.set(_corpus.size)
+            CORPUS_SEGMENTS.set(len(_corpus.segments))
+            logger.info(
+                f"Loaded corpus version {manifest['version']}: {len(_corpus.segments)} segments, {_corpus.size} chunks"
+            )
+        return _corpus
+    finally:
+        _corpus_lock.release()
@@ -0,0 +1,260 @@
+"""Lightweight Prometheus-format metrics for the RAG pipeline."""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .profiling import record_request_tokens, record_stage
+from .usage import record_usage, token_cost
+
+# Latency buckets in seconds, from sub-millisecond index searches to long completions
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonically increasing value."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: bucket counts (non-cumulative, last one is +Inf), sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[position] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "rag_stage_duration_seconds",
+    "Duration of pipeline stages.",
+    ["stage"]
+))
+HTTP_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "rag_http_request_duration_seconds",
+    "Duration of HTTP requests by route.",
+    ["method", "route", "status"]
+))
+TOKENS = REGISTRY.register(Counter(
+    "rag_tokens_total",
+    "Tokens used upstream by kind (prompt, completion, embedding) and model.",
+    ["kind", "model"]
+))
+UPSTREAM_COST = REGISTRY.register(Counter(
+    "rag_upstream_cost_usd_total",
+    "Estimated upstream cost in USD by model (MODEL_PRICES).",
+    ["model"]
+))
+ROUTED_CALLS = REGISTRY.register(Counter(
+    "rag_routed_calls_total",
+    "Completion calls by stage, routing rule and chosen model.",
+    ["stage", "rule", "model"]
+))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "rag_cache_requests_total",
+    "Cache lookups by cache and result (hit or miss).",
+    ["cache", "result"]
+))
+UPSTREAM_REQUESTS = REGISTRY.register(Counter(
+    "rag_upstream_requests_total",
+    "Upstream API attempts by kind and outcome.",
+    ["kind", "outcome"]
+))
+PDF_PAGES = REGISTRY.register(Counter(
+    "rag_pdf_pages_total",
+    "PDF pages processed by outcome.",
+    ["outcome"]
+))
+SCHEDULER_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "rag_scheduler_queue_depth",
+    "Upstream calls waiting for quota, by priority.",
+    ["priority"]
+))
+SCHEDULER_WAIT = REGISTRY.register(Histogram(
+    "rag_scheduler_wait_seconds",
+    "Time upstream calls waited for quota, by priority.",
+    ["priority"]
+))
+SCHEDULER_REJECTIONS = REGISTRY.register(Counter(
+    "rag_scheduler_rejections_total",
+    "Upstream calls rejected by admission control, by priority.",
+    ["priority"]
+))
+CORPUS_CHUNKS = REGISTRY.register(Gauge(
+    "rag_corpus_chunks",
+    "Chunks in the loaded corpus index."
+))
+CORPUS_SEGMENTS = REGISTRY.register(Gauge(
+    "rag_corpus_segments",
+    "Segments in the loaded corpus index."
+))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a pipeline stage, also adding it to the request's timing breakdown if one is collected."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage=name)
+        record_stage(name, elapsed)
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """Count a cache lookup."""
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def record_tokens(kind: str, model: Optional[str], count: int) -> None:
+    """Count upstream tokens and their cost."""
+    if count:
+        TOKENS.inc(count, kind=kind, model=model or "unknown")
+        UPSTREAM_COST.inc(token_cost(kind, model, count), model=model or "unknown")
+        record_request_tokens(kind, count)
+        record_usage(kind, model, count)
+
+
+def render_metrics() -> str:
+    """Render all metrics in the Prometheus text exposition format."""
+    return REGISTRY.render()
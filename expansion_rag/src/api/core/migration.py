@@ -0,0 +1,148 @@
+"""Online re-embedding of the corpus into a new index generation.
+
+The stored chunk texts of the current generation are embedded with the new
+model into a new generation while the current one keeps serving queries and
+taking uploads. Documents uploaded meanwhile are picked up in further
+rounds; the last one runs under the publish lock of the current generation,
+so no upload is missed, right before the generation pointer is replaced.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Set
+
+from .embeddings import EMBEDDINGS_DIR, current_generation, reembed_document
+from .generations import EmbeddingConfig, Generation, create_generation, ensure_generation_file, switch_generation
+from .index import embedded_document_ids, sync_segments
+from .scheduler import QuotaExceededError
+from .snapshots import migration_lock, publish_lock, write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+STATUS_NAME = "migration.json"
+
+
+class MigrationError(Exception):
+    """A migration cannot be started."""
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def migration_status() -> Dict[str, Any]:
+    """Status of the last migration, as seen by any worker."""
+    try:
+        with open(EMBEDDINGS_DIR / STATUS_NAME, "r") as f:
+            status = json.load(f)
+    except FileNotFoundError:
+        return {"status": "idle"}
+    if status["status"] == "running":
+        # A running migration holds the lock; if it is free, the process died
+        with migration_lock(EMBEDDINGS_DIR) as acquired:
+            if acquired:
+                status = {**status, "status": "interrupted"}
+    return status
+
+
+def start_migration(target: EmbeddingConfig) -> Dict[str, Any]:
+    """
+    Start re-embedding the corpus with another embedding in a background thread.
+
+    Raises MigrationError if a migration is already running (in any worker)
+    or the corpus already uses the target embedding.
+    """
+    root = EMBEDDINGS_DIR
+    source = current_generation()
+    if source.embedding == target:
+        raise MigrationError(f"The corpus already uses {target.model} ({target.dimensions or 'full'} dimensions)")
+
+    stack = ExitStack()
+    if not stack.enter_context(migration_lock(root)):
+        stack.close()
+        raise MigrationError("A migration is already running")
+
+    ensure_generation_file(root, source)
+    target_generation = create_generation(root, f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}", target)
+    status = {
+        "status": "running",
+        "source": source.name,
+        "generation": target_generation.name,
+        "embedding": target.to_dict(),
+        "documents_total": len(embedded_document_ids(source.path)),
+        "documents_done": 0,
+        "chunks_done": 0,
+        "failed_documents": [],
+        "started_at": _now(),
+        "finished_at": None,
+        "error": None,
+    }
+    write_json_atomic(root / STATUS_NAME, status)
+
+    def run() -> None:
+        with stack:
+            _migrate(root, source, target_generation, status)
+
+    threading.Thread(target=run, name="embedding-migration", daemon=True).start()
+    logger.info(f"Started re-embedding {source.name} into generation {target_generation.name} with {target.model}")
+    return status
+
+
+def _reembed_pending(
+    root: Path,
+    source: Generation,
+    target: Generation,
+    status: Dict[str, Any],
+    attempted: Set[str]
+) -> bool:
+    """Re-embed the documents of source that target does not have yet; returns whether there were any."""
+    pending = sorted(embedded_document_ids(source.path) - embedded_document_ids(target.path) - attempted)
+    if not pending:
+        return False
+    status["documents_total"] = status["documents_done"] + len(status["failed_documents"]) + len(pending)
+    for document_id in pending:
+        while True:
+            try:
+                status["chunks_done"] += reembed_document(source, target, document_id)
+                status["documents_done"] += 1
+                break
+            except QuotaExceededError as e:
+                # Background work: wait for the quota instead of giving up
+                time.sleep(max(e.retry_after, 1.0))
+            except Exception as e:
+                logger.error(f"Error re-embedding document {document_id}: {e}")
+                status["failed_documents"].append(document_id)
+                break
+        attempted.add(document_id)
+        write_json_atomic(root / STATUS_NAME, status)
+    return True
+
+
+def _migrate(root: Path, source: Generation, target: Generation, status: Dict[str, Any]) -> None:
+    attempted: Set[str] = set()
+    try:
+        while _reembed_pending(root, source, target, status, attempted):
+            pass
+        if status["failed_documents"]:
+            raise RuntimeError(f"{len(status['failed_documents'])} documents could not be re-embedded")
+
+        sync_segments(target.path)
+        # Hold off uploads to the old generation while catching up and switching
+        with publish_lock(source.path):
+            if _reembed_pending(root, source, target, status, attempted):
+                if status["failed_documents"]:
+                    raise RuntimeError(f"{len(status['failed_documents'])} documents could not be re-embedded")
+                sync_segments(target.path)
+            switch_generation(root, target.name)
+        status["status"] = "completed"
+    except Exception as e:
+        logger.exception(f"Migration to generation {target.name} failed")
+        status["status"] = "failed"
+        status["error"] = str(e)
+    status["finished_at"] = _now()
+    write_json_atomic(root / STATUS_NAME, status)
@@ -0,0 +1,215 @@
+"""Opt-in per-request timing breakdown and sampling profiler."""
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Optional, Set, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Whether clients may ask for a sampling profile (written to disk per request)
+REQUEST_PROFILING = os.getenv("REQUEST_PROFILING", "false").lower() in ("1", "true", "yes")
+# Where request profiles are written, in folded-stack format
+PROFILES_DIR = Path(os.getenv("PROFILES_DIR", "./src/api/data/profiles"))
+# Time between two stack samples
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+
+# Token kinds sent to and received from the upstream API
+SENT_TOKEN_KINDS = ("prompt", "embedding")
+RECEIVED_TOKEN_KINDS = ("completion",)
+
+
+class RequestTiming:
+    """Stage durations, scan counts and token usage of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.documents_scanned = 0
+        self.vectors_scanned = 0
+        self.tokens: Dict[str, int] = {}
+        self.profile_path: Optional[str] = None
+        # Worker threads currently doing this request's work (sampled by the profiler)
+        self.threads: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        with self._lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            stage["seconds"] += seconds
+            stage["calls"] += 1
+
+    def add_scan(self, documents: int, vectors: int) -> None:
+        with self._lock:
+            self.documents_scanned += documents
+            self.vectors_scanned += vectors
+
+    def add_tokens(self, kind: str, count: int) -> None:
+        with self._lock:
+            self.tokens[kind] = self.tokens.get(kind, 0) + count
+
+    def to_dict(self) -> Dict[str, Any]:
+        end = self.finished if self.finished is not None else time.perf_counter()
+        with self._lock:
+            return {
+                "total_ms": (end - self.started) * 1000,
+                "stages": {
+                    name: {"duration_ms": stage["seconds"] * 1000, "calls": int(stage["calls"])}
+                    for name, stage in self.stages.items()
+                },
+                "documents_scanned": self.documents_scanned,
+                "vectors_scanned": self.vectors_scanned,
+                "tokens_sent": sum(self.tokens.get(kind, 0) for kind in SENT_TOKEN_KINDS),
+                "tokens_received": sum(self.tokens.get(kind, 0) for kind in RECEIVED_TOKEN_KINDS),
+                "tokens": dict(self.tokens),
+                "profile_path": self.profile_path
+            }
+
+
+_current: contextvars.ContextVar[Optional[RequestTiming]] = contextvars.ContextVar("request_timing", default=None)
+
+
+def current_timing() -> Optional[RequestTiming]:
+    """The timing of the request being handled, if it asked for one."""
+    return _current.get()
+
+
+def record_stage(name: str, seconds: float) -> None:
+    timing = _current.get()
+    if timing is not None:
+        timing.add_stage(name, seconds)
+
+
+def record_scan(documents: int, vectors: int) -> None:
+    """Count the documents and vectors scored by a search."""
+    timing = _current.get()
+    if timing is not None:
+        timing.add_scan(documents, vectors)
+
+
+def record_request_tokens(kind: str, count: int) -> None:
+    timing = _current.get()
+    if timing is not None:
+        timing.add_tokens(kind, count)
+
+
+def run_attributed(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run fn, attributing the current thread to the active request for profiling."""
+    timing = _current.get()
+    if timing is None:
+        return fn(*args, **kwargs)
+    ident = threading.get_ident()
+    with timing._lock:
+        timing.threads.add(ident)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        with timing._lock:
+            timing.threads.discard(ident)
+
+
+def _frame_name(frame) -> str:
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}.{frame.f_code.co_name}:{frame.f_lineno}".replace(";", ",")
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of a request's worker threads at a fixed interval.
+
+    The result is written in the folded-stack format ("outer;inner count" per
+    line) read by flamegraph.pl, speedscope and similar tools.
+    """
+
+    def __init__(self, timing: RequestTiming, interval: float = PROFILE_INTERVAL_SECONDS):
+        self.timing = timing
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            with self.timing._lock:
+                threads = list(self.timing.threads)
+            frames = sys._current_frames()
+            for ident in threads:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def start(self) -> "SamplingProfiler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def request_timing(enabled: bool, profile: bool = False) -> Iterator[Optional[RequestTiming]]:
+    """
+    Collect a timing breakdown for the work done inside the block.
+
+    Work moved to threads with asyncio.to_thread is included, since it copies
+    the context. With profile (and REQUEST_PROFILING enabled), the request's
+    worker threads are also sampled and the profile is written to PROFILES_DIR.
+    """
+    if not enabled and not profile:
+        yield None
+        return
+
+    timing = RequestTiming()
+    token = _current.set(timing)
+    profiler = None
+    if profile:
+        if REQUEST_PROFILING:
+            profiler = SamplingProfiler(timing).start()
+        else:
+            logger.warning("Request profile asked for but REQUEST_PROFILING is disabled")
+    try:
+        yield timing
+    finally:
+        timing.finished = time.perf_counter()
+        _current.reset(token)
+        if profiler is not None:
+            profiler.stop()
+            path = PROFILES_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.folded"
+            try:
+                profiler.write(path)
+                timing.profile_path = str(path)
+            except OSError as e:
+                logger.error(f"Error writing request profile {path}: {e}")
+
+
+def timing_options(timing: bool, profile: bool, header: Optional[str]) -> Tuple[bool, bool]:
+    """
+    Combine the request's timing flags with the X-Timing header.
+
+    The header accepts "1"/"true" for a timing breakdown and "profile" for a
+    breakdown plus a sampling profile.
+    """
+    value = (header or "").strip().lower()
+    profile = profile or value == "profile"
+    timing = timing or profile or value in ("1", "true", "yes")
+    return timing, profile
@@ -0,0 +1,245 @@
+"""Token-budgeted prompt assembly with incremental history compaction."""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .embeddings import get_encoding
+from .metrics import record_cache, stage
+
+logger = logging.getLogger(__name__)
+
+# Total number of prompt tokens we are willing to send per completion
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "12000"))
+# Share of the budget that conversation history may use (summary + recent turns)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+# Share of the budget that user supplied meta information may use
+META_TOKEN_BUDGET = int(os.getenv("META_TOKEN_BUDGET", "1000"))
+# Number of turns moved into the running summary at once; keeps the summary
+# stable (and cached) between compaction steps instead of changing every turn
+COMPACTION_BLOCK = int(os.getenv("HISTORY_COMPACTION_BLOCK", "4"))
+# Maximum size of the running summary
+SUMMARY_TOKEN_LIMIT = int(os.getenv("HISTORY_SUMMARY_TOKENS", "500"))
+# Number of running summaries kept in memory
+SUMMARY_CACHE_SIZE = int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "1024"))
+# Context tokens a long query may not crowd out; the query is truncated first
+MIN_CONTEXT_TOKENS = int(os.getenv("PROMPT_MIN_CONTEXT_TOKENS", "1000"))
+# Query tokens always kept when a long query is truncated
+MIN_QUERY_TOKENS = 256
+# The last exchange (question and answer) is always kept verbatim for follow-ups
+LAST_EXCHANGE_TURNS = 2
+
+# Per-message overhead of the chat format (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+Turn = Dict[str, str]
+Summarizer = Callable[[Optional[str], List[Turn]], str]
+
+_summary_cache: "OrderedDict[str, str]" = OrderedDict()
+_summary_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Count tokens of a text with the shared encoding."""
+    return len(get_encoding().encode(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep_end: bool = False) -> str:
+    """Truncate a text to at most max_tokens tokens."""
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    if keep_end:
+        return encoding.decode(tokens[-max_tokens:])
+    return encoding.decode(tokens[:max_tokens])
+
+
+def format_turns(turns: List[Turn]) -> str:
+    """Format conversation turns into a string, including only user questions and assistant responses."""
+    lines = []
+    for turn in turns:
+        role = "Assistant" if turn["role"] == "assistant" else "User"
+        lines.append(f"{role}: {turn['content']}")
+    return "\n".join(lines)
+
+
+def _prefix_digests(turns: List[Turn]) -> List[str]:
+    """Return a digest for every prefix of the conversation (index i covers turns[:i])."""
+    digests = [hashlib.sha256(b"").hexdigest()]
+    for turn in turns:
+        h = hashlib.sha256(digests[-1].encode())
+        h.update(turn["role"].encode())
+        h.update(b"\x00")
+        h.update(turn["content"].encode())
+        digests.append(h.hexdigest())
+    return digests
+
+
+def _cache_get(key: str) -> Optional[str]:
+    with _summary_lock:
+        summary = _summary_cache.get(key)
+        if summary is not None:
+            _summary_cache.move_to_end(key)
+        return summary
+
+
+def _cache_put(key: str, summary: str) -> None:
+    with _summary_lock:
+        _summary_cache[key] = summary
+        _summary_cache.move_to_end(key)
+        while len(_summary_cache) > SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+
+
+def extractive_summary(previous_summary: Optional[str], turns: List[Turn]) -> str:
+    """Fallback summarizer that keeps the most recent part of the compacted text."""
+    text = "\n".join(part for part in (previous_summary, format_turns(turns)) if part)
+    return truncate_to_tokens(text, SUMMARY_TOKEN_LIMIT, keep_end=True)
+
+
+def summarize_prefix(turns: List[Turn], summarize: Optional[Summarizer] = None) -> str:
+    """
+    Return the running summary of the given turns.
+
+    Summaries are cached by a digest of the conversation prefix they cover, so
+    only the turns added since the longest cached prefix are summarized again.
+    """
+    if not turns:
+        return ""
+
+    digests = _prefix_digests(turns)
+    start, summary = 0, None
+    for i in range(len(turns), 0, -1):
+        cached = _cache_get(digests[i])
+        if cached is not None:
+            start, summary = i, cached
+            break
+
+    record_cache("history_summary", hit=start == len(turns))
+    if start == len(turns):
+        return summary
+
+    new_turns = turns[start:]
+    try:
+        with stage("history_summary"):
+            summary = summarize(summary, new_turns) if summarize else extractive_summary(summary, new_turns)
+    except Exception as e:
+        logger.error(f"Error summarizing conversation history: {e}")
+        summary = extractive_summary(summary, new_turns)
+
+    summary = truncate_to_tokens(summary.strip(), SUMMARY_TOKEN_LIMIT, keep_end=True)
+    _cache_put(digests[-1], summary)
+    return summary
+
+
+def compact_history(
+    turns: List[Turn],
+    token_budget: int = HISTORY_TOKEN_BUDGET,
+    summarize: Optional[Summarizer] = None
+) -> Tuple[str, List[Turn]]:
+    """
+    Split a conversation into a running summary and recent verbatim turns.
+
+    The most recent turns are kept verbatim as long as they fit into the
+    budget; everything older is compacted into the summary. The compaction
+    boundary moves in whole blocks of COMPACTION_BLOCK turns, so the cached
+    summary is reused until a block is complete and the recent turns may
+    exceed their share by less than a block. The last exchange, which
+    follow-up questions refer to, always stays verbatim.
+    """
+    turns = [t for t in turns if t.get("role") in ("user", "assistant")]
+    if not turns or token_budget <= 0:
+        return "", []
+
+    # Without a summary, everything may fit as is
+    total = sum(count_tokens(t["content"]) + MESSAGE_OVERHEAD_TOKENS for t in turns)
+    if total <= token_budget:
+        return "", turns
+
+    recent_budget = max(token_budget - SUMMARY_TOKEN_LIMIT, 0)
+    used, keep = 0, 0
+    for turn in reversed(turns):
+        cost = count_tokens(turn["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > recent_budget:
+            break
+        used += cost
+        keep += 1
+
+    # Round the boundary down to whole compaction blocks so the cached summary is reused
+    boundary = len(turns) - max(keep, LAST_EXCHANGE_TURNS)
+    block = max(COMPACTION_BLOCK, 1)
+    boundary = max(boundary // block * block, 0)
+
+    summary = summarize_prefix(turns[:boundary], summarize)
+    return summary, turns[boundary:]
+
+
+def build_messages(
+    system_prompt: str,
+    query: str,
+    chunks: List[Dict],
+    format_context: Callable[[List[Dict]], str],
+    history: Optional[List[Turn]] = None,
+    meta_information: Optional[str] = None,
+    token_budget: int = PROMPT_TOKEN_BUDGET,
+    summarize: Optional[Summarizer] = None
+) -> Tuple[List[Dict[str, str]], List[Dict]]:
+    """
+    Assemble the chat messages for a completion within a token budget.
+
+    System prompt and query are always included, a long query truncated to
+    leave MIN_CONTEXT_TOKENS for context. Meta information and history
+    get their own capped shares, and the remaining budget is filled with
+    retrieved chunks in the order given. Returns the messages and the chunks
+    that were actually included.
+    """
+    if meta_information and meta_information.strip():
+        meta_information = truncate_to_tokens(meta_information.strip(), META_TOKEN_BUDGET)
+        system_prompt += f"\n\nAdditional context from the user:\n{meta_information}"
+
+    if history:
+        summary, recent = compact_history(history, HISTORY_TOKEN_BUDGET, summarize)
+        if summary:
+            system_prompt += f"\n\nSummary of the earlier conversation:\n{summary}"
+        if recent:
+            system_prompt += f"\n\nPrevious conversation:\n{format_turns(recent)}"
+        if summary or recent:
+            system_prompt += "\n\nPlease consider the previous conversation when answering the current question."
+
+    used = (
+        count_tokens(system_prompt) + count_tokens(query)
+        + count_tokens("Context:\n") + 3 * MESSAGE_OVERHEAD_TOKENS
+    )
+    remaining = token_budget - used
+    if remaining < MIN_CONTEXT_TOKENS:
+        query_tokens = count_tokens(query)
+        cut = min(MIN_CONTEXT_TOKENS - remaining, max(query_tokens - MIN_QUERY_TOKENS, 0))
+        if cut > 0:
+            logger.warning(f"Truncating a query of {query_tokens} tokens by {cut} tokens to leave room for context")
+            query = truncate_to_tokens(query, query_tokens - cut)
+            remaining += cut
+
+    # Chunks are rendered together, so check the formatted size as we go
+    selected: List[Dict] = []
+    for chunk in chunks:
+        candidate = selected + [chunk]
+        if count_tokens(format_context(candidate)) > remaining:
+            break
+        selected = candidate
+    if chunks and not selected:
+        logger.warning(f"No retrieved chunk fits into the prompt budget ({remaining} tokens left)")
+
+    context = format_context(selected)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": f"Context:\n{context}"},
+        {"role": "user", "content": query}
+    ]
+    return messages, selected
@@ -1,27 +1,62 @@
 """RAG (Retrieval Augmented Generation) using OpenAI and FAISS."""
 import os
-from typing import Dict, List, Optional, Any
-from openai import OpenAI
-from dotenv import load_dotenv
-import threading
-from concurrent.futures import ThreadPoolExecutor
-from .embeddings import search_embeddings, search_all_documents
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Dict, List, Optional, Any
+from .embeddings import search_embeddings, search_all_documents, search_all_documents_batch
+from .prompt import build_messages, count_tokens, format_turns, SUMMARY_TOKEN_LIMIT
+from .backends import get_completion_backend
+from .singleflight import AsyncSingleFlight, make_key
+from .metrics import record_cache, stage
+from .profiling import current_timing, run_attributed
+from .routing import ROUTING_STATS, route
+from .scheduler import QuotaExceededError
+from .usage import UsageTotals, track_usage
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-# Get OpenAI API key
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
+# Default model for completions (when the request names none and no routing rule matches)
+COMPLETION_MODEL = os.getenv("COMPLETION_MODEL", "gpt-4.1-mini-2025-04-14")
+# Default model for query expansion (can use a smaller/faster model)
+EXPANSION_MODEL = os.getenv("EXPANSION_MODEL", "gpt-4.1-mini-2025-04-14")
+# Model for compacting older conversation turns into a running summary
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4.1-mini-2025-04-14")
 
-# Initialize OpenAI client
-client = OpenAI(api_key=api_key)
+# Coalesces identical answer requests that are in flight at the same time
+_answer_flight: AsyncSingleFlight[Dict[str, Any]] = AsyncSingleFlight("answer_coalesce")
+# Default number of questions answered at the same time by the batch endpoint
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
 
-# Default model for completions
-COMPLETION_MODEL = "gpt-4.1-mini-2025-04-14"
-# Model for query expansion (can use a smaller/faster model)
-EXPANSION_MODEL = "gpt-4.1-mini-2025-04-14"
+SYSTEM_PROMPT = """You are an expert assistant specialized in sustainability reporting, regulations, and technical standards.
+
+CRITICAL INSTRUCTIONS:
+1. ONLY use information directly from the provided context documents
+2. Do NOT use prior knowledge that isn't in the provided documents
+3. If the documents don't contain sufficient information, clearly state this limitation
+4. ALWAYS cite sources by their exact designation and date in parentheses after relevant statements
+5. NEVER make up citations or references
+6. If you're asked about something not covered in the documents, say "I don't have specific information about that in my documents"
+
+IMPORTANT ABOUT DOCUMENTS:
+- The source documents shown after your response MUST match what you actually used to answer
+- If the documents don't contain information on the specific topic, acknowledge this limitation
+- NEVER pretend to know something if it's not in the documents
+- Prioritize official EU regulation documents over guidance documents
+- For regulation questions, cite specific article numbers when available
+
+FORMATTING AND CONTENT:
+- Structure your responses with clear headings and bullet points when appropriate
+- Use plain language to explain complex concepts
+- Provide comprehensive answers that address all aspects of the question
+- Include specific dates, numbers, and metrics from the documents when relevant
+- When appropriate, organize information chronologically or by relevance
+
+CITATION FORMAT:
+- Citation format: (Document-Designation-Date) - e.g., (CSRD-2022/2464-2022-12-14)
+- Include the citation immediately after the information it supports
+- For general information from multiple sources, cite all relevant documents
+- Never invent citations or reference documents not in the provided context"""
 
 def format_context(chunks: List[Dict]) -> str:
     """Format retrieved chunks into a context string."""
@@ -53,12 +88,18 @@ def expand_query(query: str, num_expansions: int = 3) -> List[str]:
             {"role": "user", "content": f"Original query: '{query}'\n\nGenerate {num_expansions} alternative queries."}
         ]
         
-        response = client.chat.completions.create(
-            model=EXPANSION_MODEL,
-            messages=messages,
-            temperature=0.7
-        )
-        expanded_text = response.choices[0].message.content.strip()
+        decision = route("expansion", EXPANSION_MODEL, query)
+        with stage("expansion"):
+            start = time.perf_counter()
+            response = get_completion_backend().complete(
+                messages,
+                model=decision.model,
+                temperature=0.7
+            )
+            ROUTING_STATS.record(
+                decision, time.perf_counter() - start, response.prompt_tokens, response.completion_tokens
+            )
+        expanded_text = response.text.strip()
         
         # Parse the expanded queries from the response
         expanded_queries = []
@@ -78,10 +119,34 @@ def expand_query(query: str, num_expansions: int = 3) -> List[str]:
         
         return expanded_queries[:num_expansions]  # Ensure we return at most num_expansions queries
     
+    except QuotaExceededError:
+        # Shed load instead of continuing without expansions
+        raise
     except Exception as e:
-        print(f"Error in query expansion: {str(e)}")
+        logger.error(f"Error in query expansion: {str(e)}")
         return []  # Return empty list if expansion fails
 
+def summarize_history(previous_summary: Optional[str], turns: List[Dict[str, str]]) -> str:
+    """Fold new conversation turns into the running summary of the conversation."""
+    previous = previous_summary or "(no earlier conversation)"
+    messages = [
+        {"role": "system", "content": (
+            "You maintain a running summary of a conversation between a user and an assistant "
+            "about sustainability reporting and regulations. Update the summary with the new turns. "
+            "Keep the user's goals, the questions asked, the key facts, figures and cited documents "
+            f"from the answers. Be concise and stay below {SUMMARY_TOKEN_LIMIT} tokens. "
+            "Return ONLY the updated summary."
+        )},
+        {"role": "user", "content": f"Current summary:\n{previous}\n\nNew turns:\n{format_turns(turns)}"}
+    ]
+
+    response = get_completion_backend().complete(
+        messages,
+        model=SUMMARY_MODEL,
+        temperature=0.0
+    )
+    return response.text.strip()
+
 def deduplicate_chunks(chunks: List[Dict]) -> List[Dict]:
     """Remove duplicate chunks based on chunk_id."""
     unique_chunks = {}
@@ -92,108 +157,288 @@ def deduplicate_chunks(chunks: List[Dict]) -> List[Dict]:
     
     return list(unique_chunks.values())
 
-def search_with_query(q: str, top_k: int) -> List[Dict]:
+def search_with_query(q: str, top_k: int, filters: Optional[Dict[str, Any]] = None) -> List[Dict]:
     """Helper function to search documents with a query."""
-    return search_all_documents(q, top_k)
+    return search_all_documents(q, top_k, filters)
 
-def generate_answer(
+def normalize_query(query: str) -> str:
+    """Normalize a query for use as a cache key."""
+    return " ".join(query.lower().split())
+
+def rank_chunks(chunks: List[Dict]) -> List[Dict]:
+    """Sort chunks by score and drop duplicate texts."""
+    unique_chunks = []
+    seen_texts = set()
+    for chunk in sorted(chunks, key=lambda x: x["score"]):
+        if chunk["text"] not in seen_texts:
+            unique_chunks.append(chunk)
+            seen_texts.add(chunk["text"])
+    return unique_chunks
+
+def answer_from_chunks(
     query: str,
-    conversation_history: Optional[str] = None,
+    expanded_queries: List[str],
+    chunks: List[Dict],
     top_k: int = 3,
-    model: str = COMPLETION_MODEL,
+    model: Optional[str] = None,
     temperature: float = 0.0,
+    conversation_history: Optional[List[Dict[str, str]]] = None,
     meta_information: Optional[str] = None
 ) -> Dict[str, Any]:
-    """Generate an answer using RAG."""
+    """
+    Generate the answer for a query from already retrieved, ranked chunks.
+
+    Without a model, the routing rules pick one from the query and the size
+    of the assembled prompt, falling back to COMPLETION_MODEL.
+    """
+    # Fit prompt, history, meta information and context into the token budget
+    with stage("prompt_build"):
+        messages, context_chunks = build_messages(
+            SYSTEM_PROMPT,
+            query,
+            chunks[:top_k],
+            format_context,
+            history=conversation_history,
+            meta_information=meta_information,
+            summarize=summarize_history
+        )
+    
+    decision = route(
+        "completion",
+        COMPLETION_MODEL,
+        query,
+        prompt_tokens=sum(count_tokens(message["content"]) for message in messages),
+        history_turns=len(conversation_history or []),
+        requested_model=model
+    )
+    
+    # Generate response
+    with stage("completion"):
+        start = time.perf_counter()
+        response = get_completion_backend().complete(
+            messages,
+            model=decision.model,
+            temperature=temperature
+        )
+        ROUTING_STATS.record(decision, time.perf_counter() - start, response.prompt_tokens, response.completion_tokens)
+    
+    return {
+        "answer": response.text,
+        "model": decision.model,
+        "routing_rule": decision.rule,
+        "chunks": context_chunks,
+        "expanded_queries": expanded_queries,
+        "sources": [chunk.get('source', 'Unknown source') for chunk in context_chunks],
+        "success": True
+    }
+
+def error_result() -> Dict[str, Any]:
+    """Result returned when an answer could not be generated."""
+    return {
+        "answer": "I apologize, but I encountered an error while processing your request.",
+        "chunks": [],
+        "expanded_queries": [],
+        "sources": [],
+        "success": False
+    }
+
+def generate_answer(
+    query: str,
+    conversation_history: Optional[List[Dict[str, str]]] = None,
+    top_k: int = 3,
+    model: Optional[str] = None,
+    temperature: float = 0.0,
+    meta_information: Optional[str] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    expansion_cache: Optional[Dict[str, List[str]]] = None,
+    retrieval_cache: Optional[Dict[str, List[Dict]]] = None,
+    previous_chunks: Optional[List[Dict]] = None
+) -> Dict[str, Any]:
+    """
+    Generate an answer using RAG.
+
+    filters restricts retrieval to matching documents (see
+    index.document_matches). expansion_cache and retrieval_cache are optional
+    per-session caches keyed by normalized query; they are read and updated in
+    place so that repeated questions reuse earlier expansions and search
+    results. previous_chunks, the context of the previous answer, follow the
+    top_k retrieved chunks while the budget allows, so a follow-up question
+    that does not repeat the topic still sees the context it refers to. The
+    result's retrieved_chunks are the context chunks retrieved for this query,
+    the ones to carry over to the next turn.
+    """
     try:
         # First, expand the query to improve retrieval
-        expanded_queries = expand_query(query)
+        query_key = normalize_query(query)
+        if expansion_cache is not None:
+            record_cache("session_expansion", hit=query_key in expansion_cache)
+        if expansion_cache is not None and query_key in expansion_cache:
+            expanded_queries = expansion_cache[query_key]
+        else:
+            expanded_queries = expand_query(query)
+            if expansion_cache is not None and expanded_queries:
+                expansion_cache[query_key] = expanded_queries
         
         # Search for relevant chunks across all documents
         all_chunks = []
         for expanded_query in expanded_queries:
-            chunks = search_all_documents(expanded_query, top_k)
+            cache_key = make_key(top_k, filters, normalize_query(expanded_query))
+            if retrieval_cache is not None:
+                record_cache("session_retrieval", hit=cache_key in retrieval_cache)
+            if retrieval_cache is not None and cache_key in retrieval_cache:
+                chunks = retrieval_cache[cache_key]
+            else:
+                chunks = search_all_documents(expanded_query, top_k, filters)
+                if retrieval_cache is not None:
+                    retrieval_cache[cache_key] = chunks
             all_chunks.extend(chunks)
         
         # Remove duplicates and sort by score
-        unique_chunks = []
-        seen_texts = set()
-        for chunk in sorted(all_chunks, key=lambda x: x["score"]):
-            if chunk["text"] not in seen_texts:
-                unique_chunks.append(chunk)
-                seen_texts.add(chunk["text"])
+        unique_chunks = rank_chunks(all_chunks)[:top_k]
+        # Scores of the previous context belong to the previous query, so it is not ranked with the new results
+        seen_texts = {chunk["text"] for chunk in unique_chunks}
+        carried = [chunk for chunk in previous_chunks or [] if chunk["text"] not in seen_texts]
         
-        # Format context from chunks
-        context = format_context(unique_chunks[:top_k])
-        print(context)
+        result = answer_from_chunks(
+            query,
+            expanded_queries,
+            unique_chunks + carried,
+            top_k=len(unique_chunks) + len(carried),
+            model=model,
+            temperature=temperature,
+            conversation_history=conversation_history,
+            meta_information=meta_information
+        )
+        # The context is a prefix of the chunks passed in, retrieved ones first
+        result["retrieved_chunks"] = result["chunks"][:len(unique_chunks)]
+        return result
         
-        # Build the prompt
-        system_prompt = """You are an expert assistant specialized in sustainability reporting, regulations, and technical standards.
+    except QuotaExceededError:
+        raise
+    except Exception as e:
+        logger.error(f"Error generating answer: {e}")
+        return error_result()
 
-CRITICAL INSTRUCTIONS:
-1. ONLY use information directly from the provided context documents
-2. Do NOT use prior knowledge that isn't in the provided documents
-3. If the documents don't contain sufficient information, clearly state this limitation
-4. ALWAYS cite sources by their exact designation and date in parentheses after relevant statements
-5. NEVER make up citations or references
-6. If you're asked about something not covered in the documents, say "I don't have specific information about that in my documents"
+async def generate_answer_coalesced(
+    query: str,
+    conversation_history: Optional[List[Dict[str, str]]] = None,
+    top_k: int = 3,
+    model: Optional[str] = None,
+    temperature: float = 0.0,
+    meta_information: Optional[str] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    expansion_cache: Optional[Dict[str, List[str]]] = None,
+    retrieval_cache: Optional[Dict[str, List[Dict]]] = None,
+    previous_chunks: Optional[List[Dict]] = None
+) -> Dict[str, Any]:
+    """
+    Run generate_answer in a worker thread, sharing one computation between
+    identical concurrent requests.
 
-IMPORTANT ABOUT DOCUMENTS:
-- The source documents shown after your response MUST match what you actually used to answer
-- If the documents don't contain information on the specific topic, acknowledge this limitation
-- NEVER pretend to know something if it's not in the documents
-- Prioritize official EU regulation documents over guidance documents
-- For regulation questions, cite specific article numbers when available
+    The caches are not part of the key; only the first request's caches are
+    used and updated. Requests that collect a timing breakdown are not
+    coalesced, so that the breakdown describes their own work.
+    """
+    kwargs = dict(
+        query=query,
+        conversation_history=conversation_history,
+        top_k=top_k,
+        model=model,
+        temperature=temperature,
+        meta_information=meta_information,
+        filters=filters,
+        expansion_cache=expansion_cache,
+        retrieval_cache=retrieval_cache,
+        previous_chunks=previous_chunks
+    )
+    if current_timing() is not None:
+        return await asyncio.to_thread(run_attributed, generate_answer, **kwargs)
 
-FORMATTING AND CONTENT:
-- Structure your responses with clear headings and bullet points when appropriate
-- Use plain language to explain complex concepts
-- Provide comprehensive answers that address all aspects of the question
-- Include specific dates, numbers, and metrics from the documents when relevant
-- When appropriate, organize information chronologically or by relevance
+    key = make_key(
+        normalize_query(query),
+        conversation_history or [],
+        top_k,
+        model,
+        temperature,
+        (meta_information or "").strip(),
+        filters,
+        [chunk.get("chunk_id") for chunk in previous_chunks or []]
+    )
+    return await _answer_flight.do(key, lambda: asyncio.to_thread(generate_answer, **kwargs))
 
-CITATION FORMAT:
-- Citation format: (Document-Designation-Date) - e.g., (CSRD-2022/2464-2022-12-14)
-- Include the citation immediately after the information it supports
-- For general information from multiple sources, cite all relevant documents
-- Never invent citations or reference documents not in the provided context"""
+async def generate_answers_batch(
+    queries: List[str],
+    top_k: int = 3,
+    model: Optional[str] = None,
+    temperature: float = 0.0,
+    concurrency: int = BATCH_CONCURRENCY,
+    filters: Optional[Dict[str, Any]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Answer many questions, yielding each result (with its "index") as soon as it completes.
 
-        # Add meta information if available
-        if meta_information and meta_information.strip():
-            system_prompt += f"\n\nAdditional context from the user:\n{meta_information}"
-        
-        # Add conversation history if available
-        if conversation_history:
-            system_prompt += f"\n\nPrevious conversation:\n{conversation_history}\n\nPlease consider the previous conversation when answering the current question."
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "system", "content": f"Context:\n{context}"},
-            {"role": "user", "content": query}
-        ]
-        
-        # Generate response
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature
-        )
-        
-        return {
-            "answer": response.choices[0].message.content,
-            "chunks": unique_chunks[:top_k],
-            "expanded_queries": expanded_queries,
-            "sources": [chunk.get('source', 'Unknown source') for chunk in unique_chunks[:top_k]],
-            "success": True
-        }
-        
+    Expansions run with bounded concurrency, all expanded queries are embedded
+    in bulk and searched with one matrix search, then answers are generated
+    with bounded concurrency. Each result carries the usage of its question;
+    the tokens of the bulk embedding are shared by the number of expanded
+    queries of each question.
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    usages = [UsageTotals() for _ in queries]
+
+    async def run_limited(usage: UsageTotals, fn, *args, **kwargs):
+        async with semaphore:
+            with track_usage(usage):
+                return await asyncio.to_thread(fn, *args, **kwargs)
+
+    expansions = await asyncio.gather(
+        *(run_limited(usages[i], expand_query, query) for i, query in enumerate(queries)), return_exceptions=True
+    )
+    # The stream has started, so a question whose expansion was rejected continues without one
+    for i, expanded_queries in enumerate(expansions):
+        if isinstance(expanded_queries, Exception):
+            logger.error(f"Error in query expansion: {expanded_queries}")
+            expansions[i] = []
+
+    flat_queries = [expanded for expanded_queries in expansions for expanded in expanded_queries]
+    search_usage = UsageTotals()
+    try:
+        with track_usage(search_usage):
+            flat_results = await asyncio.to_thread(search_all_documents_batch, flat_queries, top_k, filters)
     except Exception as e:
-        print(f"Error generating answer: {e}")
-        return {
-            "answer": "I apologize, but I encountered an error while processing your request.",
-            "chunks": [],
-            "expanded_queries": [],
-            "sources": [],
-            "success": False
-        } 
+        logger.error(f"Error searching batch: {e}")
+        for i, query in enumerate(queries):
+            yield {**error_result(), "index": i, "query": query, "usage": usages[i].to_dict()}
+        return
+
+    # Split the flat search results back per question
+    chunks_per_query = []
+    offset = 0
+    for expanded_queries in expansions:
+        results = flat_results[offset:offset + len(expanded_queries)]
+        chunks_per_query.append(rank_chunks([chunk for result in results for chunk in result]))
+        offset += len(expanded_queries)
+    for usage, expanded_queries in zip(usages, expansions):
+        share = len(expanded_queries) / max(len(flat_queries), 1)
+        for model, entry in search_usage.models.items():
+            usage.add("embedding", model, round(entry["embedding"] * share))
+
+    async def answer(i: int) -> Dict[str, Any]:
+        try:
+            result = await run_limited(
+                usages[i],
+                answer_from_chunks,
+                queries[i],
+                expansions[i],
+                chunks_per_query[i],
+                top_k=top_k,
+                model=model,
+                temperature=temperature
+            )
+        except Exception as e:
+            logger.error(f"Error generating answer: {e}")
+            result = error_result()
+        return {**result, "index": i, "query": queries[i], "usage": usages[i].to_dict()}
 
+    for next_result in asyncio.as_completed([answer(i) for i in range(len(queries))]):
+        yield await next_result
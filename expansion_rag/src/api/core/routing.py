@@ -0,0 +1,204 @@
+"""Cost-aware routing of completions to models, by configurable rules.
+
+MODEL_ROUTING holds the rules as JSON (or the path of a JSON file), per
+stage ("expansion", "completion"), tried in order; the first matching rule
+picks the model, otherwise the stage's default model is used:
+
+    {
+      "expansion": [{"name": "short", "max_query_tokens": 32, "model": "gpt-4.1-nano"}],
+      "completion": [
+        {"name": "simple", "max_query_tokens": 24, "max_prompt_tokens": 3000, "max_history_turns": 2,
+         "model": "gpt-4.1-nano"},
+        {"name": "large_context", "min_prompt_tokens": 8000, "model": "gpt-4.1"},
+        {"name": "analytical", "query_pattern": "(?i)compare|difference|unterschied|why|warum", "model": "gpt-4.1"}
+      ]
+    }
+
+Conditions: min_/max_query_tokens, min_/max_prompt_tokens (the assembled
+prompt, completion stage only), min_/max_history_turns and query_pattern (a
+regular expression searched in the query). Requests that name a model are
+not routed. Latency, tokens and cost per rule are kept, with the cost the
+same calls would have had on the default model.
+"""
+import json
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .metrics import ROUTED_CALLS
+from .prompt import count_tokens
+from .usage import token_cost
+
+logger = logging.getLogger(__name__)
+
+# Routing rules as JSON or the path of a JSON file; empty disables routing
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "")
+
+DEFAULT_RULE = "default"
+EXPLICIT_RULE = "explicit"
+
+
+@dataclass
+class RoutingRule:
+    """Sends the calls of a stage that match all given conditions to a model."""
+    name: str
+    model: str
+    min_query_tokens: Optional[int] = None
+    max_query_tokens: Optional[int] = None
+    min_prompt_tokens: Optional[int] = None
+    max_prompt_tokens: Optional[int] = None
+    min_history_turns: Optional[int] = None
+    max_history_turns: Optional[int] = None
+    query_pattern: Optional[str] = None
+
+    def matches(self, query: str, query_tokens: int, prompt_tokens: int, history_turns: int) -> bool:
+        for value, low, high in (
+            (query_tokens, self.min_query_tokens, self.max_query_tokens),
+            (prompt_tokens, self.min_prompt_tokens, self.max_prompt_tokens),
+            (history_turns, self.min_history_turns, self.max_history_turns),
+        ):
+            if low is not None and value < low:
+                return False
+            if high is not None and value > high:
+                return False
+        return self.query_pattern is None or re.search(self.query_pattern, query) is not None
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    """Model chosen for a call, the rule that chose it and the model that would have been used otherwise."""
+    stage: str
+    model: str
+    rule: str
+    default_model: str
+
+
+def parse_rules(config: str) -> Dict[str, List[RoutingRule]]:
+    """Parse routing rules from JSON text or the path of a JSON file."""
+    if not config.strip():
+        return {}
+    text = Path(config).read_text() if not config.lstrip().startswith("{") else config
+    known = {field.name for field in fields(RoutingRule)}
+    rules: Dict[str, List[RoutingRule]] = {}
+    for stage, stage_rules in json.loads(text).items():
+        rules[stage] = []
+        for i, rule in enumerate(stage_rules):
+            unknown = set(rule) - known
+            if unknown:
+                raise ValueError(f"Unknown condition(s) {sorted(unknown)} in {stage} routing rule {i}")
+            if not rule.get("model"):
+                raise ValueError(f"{stage} routing rule {i} names no model")
+            if rule.get("query_pattern") is not None:
+                try:
+                    re.compile(rule["query_pattern"])
+                except re.error as e:
+                    raise ValueError(f"Invalid query_pattern in {stage} routing rule {i}: {e}")
+            rules[stage].append(RoutingRule(**{"name": f"{stage}_{i}", **rule}))
+    return rules
+
+
+@lru_cache(maxsize=1)
+def get_rules() -> Dict[str, List[RoutingRule]]:
+    """Routing rules from MODEL_ROUTING, parsed once (at startup, by warm_up)."""
+    rules = parse_rules(MODEL_ROUTING)
+    if rules:
+        logger.info(f"Model routing enabled: {', '.join(f'{s} ({len(r)} rules)' for s, r in rules.items())}")
+    return rules
+
+
+def route(
+    stage: str,
+    default_model: str,
+    query: str,
+    prompt_tokens: int = 0,
+    history_turns: int = 0,
+    requested_model: Optional[str] = None
+) -> RouteDecision:
+    """Pick the model of a call; a requested model always wins."""
+    if requested_model:
+        return RouteDecision(stage, requested_model, EXPLICIT_RULE, requested_model)
+    rules = get_rules().get(stage)
+    if rules:
+        query_tokens = count_tokens(query)
+        for rule in rules:
+            if rule.matches(query, query_tokens, prompt_tokens, history_turns):
+                return RouteDecision(stage, rule.model, rule.name, default_model)
+    return RouteDecision(stage, default_model, DEFAULT_RULE, default_model)
+
+
+class RoutingStats:
+    """Calls, latency, tokens and cost per stage, rule and model."""
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str, str], Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, decision: RouteDecision, seconds: float, prompt_tokens: int, completion_tokens: int) -> None:
+        ROUTED_CALLS.inc(stage=decision.stage, rule=decision.rule, model=decision.model)
+        cost = (
+            token_cost("prompt", decision.model, prompt_tokens)
+            + token_cost("completion", decision.model, completion_tokens)
+        )
+        default_cost = (
+            token_cost("prompt", decision.default_model, prompt_tokens)
+            + token_cost("completion", decision.default_model, completion_tokens)
+        )
+        key = (decision.stage, decision.rule, decision.model)
+        with self._lock:
+            entry = self._entries.setdefault(key, {
+                "calls": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0,
+                "cost_usd": 0.0, "default_cost_usd": 0.0
+            })
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["cost_usd"] += cost
+            entry["default_cost_usd"] += default_cost
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Per rule: calls, mean latency, tokens, cost and savings against the default model.
+
+        Cost savings price the same tokens at the default model. Latency
+        savings compare with the mean latency of unrouted calls of the stage,
+        so they are only meaningful once both have enough calls.
+        """
+        with self._lock:
+            entries = {key: dict(entry) for key, entry in self._entries.items()}
+
+        default_latency = {
+            stage: entry["seconds"] / entry["calls"]
+            for (stage, rule, _), entry in entries.items() if rule == DEFAULT_RULE and entry["calls"]
+        }
+        rules = []
+        for (stage, rule, model), entry in sorted(entries.items()):
+            mean = entry["seconds"] / entry["calls"]
+            baseline = default_latency.get(stage)
+            rules.append({
+                "stage": stage,
+                "rule": rule,
+                "model": model,
+                "calls": int(entry["calls"]),
+                "mean_latency_ms": mean * 1000,
+                "latency_saved_ms_per_call": (
+                    (baseline - mean) * 1000 if baseline is not None and rule != DEFAULT_RULE else None
+                ),
+                "prompt_tokens": int(entry["prompt_tokens"]),
+                "completion_tokens": int(entry["completion_tokens"]),
+                "cost_usd": entry["cost_usd"],
+                "cost_saved_usd": entry["default_cost_usd"] - entry["cost_usd"],
+            })
+        return {
+            "enabled": bool(MODEL_ROUTING.strip()),
+            "cost_saved_usd": sum(rule["cost_saved_usd"] for rule in rules),
+            "rules": rules,
+        }
+
+
+ROUTING_STATS = RoutingStats()
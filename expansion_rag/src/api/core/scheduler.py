@@ -0,0 +1,190 @@
+"""Admission control for the upstream API quota (requests and tokens per minute).
+
+Every upstream call takes its share of the per-minute budgets before it is
+sent. Waiting calls are served by priority: interactive traffic (chat and QA
+completions, query embeddings) goes before background traffic (ingestion),
+and a part of each budget is reserved for interactive calls so that a large
+upload cannot drain it. Calls that cannot be admitted before their deadline,
+or that find the queue full, are rejected right away with a retry hint.
+"""
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from .metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_REJECTIONS, SCHEDULER_WAIT
+
+# Upstream budgets of the account; 0 disables the limit
+OPENAI_RPM_LIMIT = float(os.getenv("OPENAI_RPM_LIMIT", "0"))
+OPENAI_TPM_LIMIT = float(os.getenv("OPENAI_TPM_LIMIT", "0"))
+# Worker processes sharing the account; each admits its share of the budgets
+API_WORKERS = max(int(os.getenv("API_WORKERS", "1")), 1)
+# Share of each budget that only interactive calls may use
+INTERACTIVE_RESERVE = float(os.getenv("SCHEDULER_INTERACTIVE_RESERVE", "0.2"))
+# Calls allowed to wait for quota at the same time; more are rejected
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "256"))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("upstream_priority", default=INTERACTIVE)
+
+
+class QuotaExceededError(Exception):
+    """The call could not be admitted within the upstream quota."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@contextmanager
+def priority(level: int) -> Iterator[None]:
+    """Run the upstream calls made inside the block at the given priority."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (about four characters per token) used for admission."""
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    """Budget that refills continuously up to its per-minute capacity."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, reserve: float = 0.0) -> float:
+        """Seconds until amount can be taken while leaving reserve untouched."""
+        needed = min(amount, self.capacity) + reserve - self.level
+        return max(needed / self.rate, 0.0) if needed > 0 else 0.0
+
+    def consume(self, amount: float) -> None:
+        # May go negative when actual usage exceeds the estimate; later calls wait longer
+        self.level -= amount
+
+    def give_back(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+class QuotaScheduler:
+    """Priority queue in front of request and token buckets."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_queue: int):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_queue = max_queue
+        self._waiting: List[Tuple[int, int]] = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests is not None or self.tokens is not None
+
+    def _wait_time(self, tokens: int, level: int) -> float:
+        wait = 0.0
+        for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+            if bucket is not None:
+                reserve = bucket.capacity * INTERACTIVE_RESERVE if level != INTERACTIVE else 0.0
+                wait = max(wait, bucket.wait_time(amount, reserve))
+        return wait
+
+    def _reject(self, level: int, message: str, retry_after: float) -> None:
+        SCHEDULER_REJECTIONS.inc(priority=PRIORITY_NAMES[level])
+        raise QuotaExceededError(message, retry_after)
+
+    def acquire(self, tokens: int, deadline: float) -> None:
+        """
+        Wait until the call fits into the budgets, in priority order.
+
+        Raises QuotaExceededError if the queue is full or the call cannot be
+        admitted before the deadline.
+        """
+        if not self.enabled:
+            return
+        level = current_priority()
+        name = PRIORITY_NAMES[level]
+        start = time.monotonic()
+
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                self._reject(level, "Upstream quota queue is full", self._wait_time(tokens, level) or 1.0)
+
+            entry = (level, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            SCHEDULER_QUEUE_DEPTH.inc(priority=name)
+            try:
+                while True:
+                    now = time.monotonic()
+                    for bucket in (self.requests, self.tokens):
+                        if bucket is not None:
+                            bucket.refill(now)
+
+                    wait = self._wait_time(tokens, level)
+                    if self._waiting[0] == entry and wait <= 0:
+                        if self.requests is not None:
+                            self.requests.consume(1)
+                        if self.tokens is not None:
+                            self.tokens.consume(tokens)
+                        break
+
+                    remaining = deadline - now
+                    if wait > remaining:
+                        # Fail fast instead of waiting for a deadline we cannot meet
+                        self._reject(level, "Upstream quota exhausted", wait)
+                    if remaining <= 0:
+                        self._reject(level, "Timed out waiting for upstream quota", 1.0)
+                    # The head waits for the budget to refill, the others until it is admitted
+                    timeout = max(wait, 0.01) if self._waiting[0] == entry else remaining
+                    self._cond.wait(timeout=min(timeout, remaining))
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                SCHEDULER_QUEUE_DEPTH.dec(priority=name)
+                self._cond.notify_all()
+
+        SCHEDULER_WAIT.observe(time.monotonic() - start, priority=name)
+
+    def settle(self, estimated: int, actual: Optional[int]) -> None:
+        """Correct the token budget once the actual usage of a call is known."""
+        if self.tokens is None or actual is None:
+            return
+        with self._cond:
+            self.tokens.consume(actual - estimated)
+            self._cond.notify_all()
+
+    def refund(self, tokens: int) -> None:
+        """Give back the budget of an admitted call that never reached the upstream API."""
+        if not self.enabled:
+            return
+        with self._cond:
+            if self.requests is not None:
+                self.requests.give_back(1)
+            if self.tokens is not None:
+                self.tokens.give_back(tokens)
+            self._cond.notify_all()
+
+
+scheduler = QuotaScheduler(OPENAI_RPM_LIMIT / API_WORKERS, OPENAI_TPM_LIMIT / API_WORKERS, SCHEDULER_MAX_QUEUE)
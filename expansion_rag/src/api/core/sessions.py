@@ -0,0 +1,247 @@
+"""Server-side chat session storage."""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+# Session backend: "memory" or "sqlite"
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+# SQLite database file used by the sqlite backend
+SESSION_DB_PATH = Path(os.getenv("SESSION_DB_PATH", "./src/api/data/sessions.db"))
+# Sessions not touched for this many seconds are evicted
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+# Number of retrieval results cached per session
+SESSION_RETRIEVAL_CACHE_SIZE = int(os.getenv("SESSION_RETRIEVAL_CACHE_SIZE", "32"))
+# Minimum number of seconds between two eviction sweeps
+EVICTION_INTERVAL_SECONDS = 60
+
+
+@dataclass
+class ChatSession:
+    """A chat session with its turns and cached retrieval results."""
+    session_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    turns: List[Dict[str, str]] = field(default_factory=list)
+    # Cached expansions and search results, keyed by normalized query
+    expansions: Dict[str, List[str]] = field(default_factory=dict)
+    retrieved: Dict[str, List[Dict]] = field(default_factory=dict)
+    # Chunks the last answer was based on; candidates for follow-up questions
+    context_chunks: List[Dict] = field(default_factory=list)
+    # Corpus the cached search results and context chunks came from
+    corpus_version: Optional[str] = None
+    # Incremented on every save, to detect concurrent updates
+    revision: int = 0
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    def add_turn(self, role: str, content: str) -> None:
+        """Append a turn to the conversation."""
+        self.turns.append({"role": role, "content": content})
+
+    def use_corpus(self, version: str) -> None:
+        """Drop cached search results and context chunks of an older corpus version."""
+        if self.corpus_version != version:
+            self.retrieved.clear()
+            self.context_chunks = []
+            self.corpus_version = version
+
+    def trim_caches(self) -> None:
+        """Keep only the most recent retrieval cache entries (dicts keep insertion order)."""
+        for cache in (self.expansions, self.retrieved):
+            while len(cache) > SESSION_RETRIEVAL_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
+
+
+class SessionConflictError(Exception):
+    """A session was saved by someone else since it was read."""
+
+
+class SessionLocks:
+    """Per-session locks, so the turns of one session run one at a time in this process."""
+
+    def __init__(self):
+        self._locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def hold(self, session_id: str) -> AsyncIterator[None]:
+        lock, users = self._locks.get(session_id, (None, 0))
+        lock = lock or asyncio.Lock()
+        self._locks[session_id] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[session_id]
+            if users == 1:
+                del self._locks[session_id]
+            else:
+                self._locks[session_id] = (lock, users - 1)
+
+
+session_locks = SessionLocks()
+
+
+class SessionStore(ABC):
+    """Storage backend for chat sessions."""
+
+    def __init__(self, ttl_seconds: int = SESSION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._last_eviction = 0.0
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        """Return a session, or None if it does not exist or has expired."""
+
+    @abstractmethod
+    def save(self, session: ChatSession) -> None:
+        """
+        Create or update a session.
+
+        Raises SessionConflictError if the stored session was saved since
+        this copy was read (by another worker).
+        """
+
+    @abstractmethod
+    def delete(self, session_id: str) -> bool:
+        """Delete a session. Returns whether it existed."""
+
+    @abstractmethod
+    def evict_expired(self) -> int:
+        """Remove expired sessions. Returns the number of evicted sessions."""
+
+    def create(self) -> ChatSession:
+        """Create and store a new empty session."""
+        session = ChatSession()
+        self.save(session)
+        return session
+
+    def is_expired(self, session: ChatSession) -> bool:
+        return time.time() - session.updated_at > self.ttl_seconds
+
+    def _maybe_evict(self) -> None:
+        now = time.time()
+        if now - self._last_eviction >= EVICTION_INTERVAL_SECONDS:
+            self._last_eviction = now
+            self.evict_expired()
+
+
+class InMemorySessionStore(SessionStore):
+    """Process-local session store. Sessions are lost on restart."""
+
+    def __init__(self, ttl_seconds: int = SESSION_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        self._maybe_evict()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if self.is_expired(session):
+                del self._sessions[session_id]
+                return None
+            return session
+
+    def save(self, session: ChatSession) -> None:
+        session.updated_at = time.time()
+        session.trim_caches()
+        session.revision += 1
+        with self._lock:
+            self._sessions[session.session_id] = session
+            # Least recently updated sessions first, so eviction can stop early
+            self._sessions.move_to_end(session.session_id)
+        self._maybe_evict()
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def evict_expired(self) -> int:
+        evicted = 0
+        with self._lock:
+            while self._sessions:
+                session = next(iter(self._sessions.values()))
+                if not self.is_expired(session):
+                    break
+                self._sessions.popitem(last=False)
+                evicted += 1
+        return evicted
+
+
+class SQLiteSessionStore(SessionStore):
+    """Session store persisted in a SQLite database, shared by all workers on a host."""
+
+    def __init__(self, db_path: Path = SESSION_DB_PATH, ttl_seconds: int = SESSION_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        self._maybe_evict()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE session_id = ? AND updated_at >= ?",
+                (session_id, time.time() - self.ttl_seconds)
+            ).fetchone()
+        if row is None:
+            return None
+        return ChatSession(**json.loads(row[0]))
+
+    def save(self, session: ChatSession) -> None:
+        session.updated_at = time.time()
+        session.trim_caches()
+        expected = session.revision
+        session.revision += 1
+        # Only replace the stored session if it is still the revision this copy was read at
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at "
+                "WHERE COALESCE(json_extract(sessions.data, '$.revision'), 0) = ?",
+                (session.session_id, json.dumps(asdict(session)), session.updated_at, expected)
+            )
+        if cursor.rowcount == 0:
+            session.revision = expected
+            raise SessionConflictError(f"Session {session.session_id} was updated concurrently")
+        self._maybe_evict()
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return cursor.rowcount > 0
+
+    def evict_expired(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM sessions WHERE updated_at < ?",
+                (time.time() - self.ttl_seconds,)
+            )
+        return cursor.rowcount
+
+
+@lru_cache(maxsize=1)
+def get_session_store() -> SessionStore:
+    """Return the configured session store."""
+    if SESSION_STORE == "sqlite":
+        return SQLiteSessionStore()
+    if SESSION_STORE == "memory":
+        return InMemorySessionStore()
+    raise ValueError(f"Unknown SESSION_STORE: {SESSION_STORE}")
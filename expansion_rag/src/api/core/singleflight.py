@@ -0,0 +1,86 @@
+"""Single-flight coalescing of identical concurrent calls."""
+import asyncio
+import hashlib
+import json
+import threading
+from typing import Any, Awaitable, Callable, Dict, Generic, Optional, TypeVar
+
+from .metrics import record_cache
+
+T = TypeVar("T")
+
+
+def make_key(*parts: Any) -> str:
+    """Build a stable key from JSON-serializable request parameters."""
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class _Call(Generic[T]):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[T] = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight(Generic[T]):
+    """
+    Coalesce identical concurrent calls across threads.
+
+    The first caller for a key runs the function; callers arriving while it is
+    in flight wait for it and receive the same result (or exception).
+    """
+
+    def __init__(self, name: str):
+        # Name reported in the cache metrics; coalesced calls count as hits
+        self.name = name
+        self._calls: Dict[str, _Call[T]] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+        record_cache(self.name, hit=not is_leader)
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class AsyncSingleFlight(Generic[T]):
+    """
+    Coalesce identical concurrent coroutines on one event loop.
+
+    The shared computation runs as its own task, so a caller that is cancelled
+    (e.g. the client disconnected) does not cancel it for the others.
+    """
+
+    def __init__(self, name: str):
+        # Name reported in the cache metrics; coalesced calls count as hits
+        self.name = name
+        self._tasks: Dict[str, "asyncio.Task[T]"] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._tasks.get(key)
+        record_cache(self.name, hit=task is not None)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task)
@@ -0,0 +1,283 @@
+"""Immutable corpus segments and the versioned manifest shared between worker processes.
+
+The corpus is stored as segments under <embeddings_dir>/segments: directories
+holding the vectors, chunk texts and document catalog of some documents. New
+documents are written as small segments; the compactor merges small segments
+into larger ones. Segments are written to a temporary directory and renamed
+into place, and the manifest listing the current segments is replaced
+atomically, so readers never see a partial state. Vectors and texts are
+memory-mapped, so all workers on a host share one copy through the page cache.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+SEGMENTS_DIRNAME = "segments"
+LOCK_NAME = ".publish.lock"
+COMPACTION_LOCK_NAME = ".compaction.lock"
+MIGRATION_LOCK_NAME = ".migration.lock"
+# Directory of the single merged snapshot that the segments replaced
+LEGACY_SNAPSHOTS_DIRNAME = "snapshots"
+# Segments no longer in the manifest are deleted after this long (workers
+# still mapping them keep their open files)
+SEGMENT_GC_SECONDS = float(os.getenv("SEGMENT_GC_SECONDS", "300"))
+
+
+def _fsync_dir(directory: Path) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: Path, write: Callable[[Path], None]) -> None:
+    """Write a file through a temporary file in the same directory and rename it into place."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        write(tmp_path)
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    _fsync_dir(path.parent)
+
+
+def write_json_atomic(path: Path, data: Any) -> None:
+    def write(tmp_path: Path) -> None:
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+
+    atomic_write(path, write)
+
+
+@contextmanager
+def _file_lock(embeddings_dir: Path, name: str, blocking: bool) -> Iterator[bool]:
+    embeddings_dir.mkdir(parents=True, exist_ok=True)
+    with open(embeddings_dir / name, "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def publish_lock(embeddings_dir: Path, blocking: bool = True):
+    """
+    Exclusive lock between processes changing the manifest of the same directory.
+
+    Yields whether the lock was acquired (always True when blocking).
+    """
+    return _file_lock(embeddings_dir, LOCK_NAME, blocking)
+
+
+def compaction_lock(embeddings_dir: Path, blocking: bool = False):
+    """Lock letting one process at a time compact a directory (or hold compaction off); yields whether it was acquired."""
+    return _file_lock(embeddings_dir, COMPACTION_LOCK_NAME, blocking)
+
+
+def migration_lock(embeddings_dir: Path, blocking: bool = False):
+    """Lock held while a migration or snapshot import replaces the corpus; yields whether it was acquired."""
+    return _file_lock(embeddings_dir, MIGRATION_LOCK_NAME, blocking)
+
+
+def read_manifest(embeddings_dir: Path) -> Optional[Dict[str, Any]]:
+    """
+    Return the current manifest, or None if nothing was published yet.
+
+    A manifest of the earlier single-snapshot layout (without segments)
+    counts as unpublished, so sync_segments rebuilds the segments from the
+    per-document files.
+    """
+    try:
+        with open(embeddings_dir / MANIFEST_NAME, "r") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    return manifest if "segments" in manifest else None
+
+
+def remove_legacy_snapshots(embeddings_dir: Path) -> None:
+    """Delete the snapshots of the single-snapshot layout once segments were published."""
+    legacy_dir = embeddings_dir / LEGACY_SNAPSHOTS_DIRNAME
+    if legacy_dir.exists():
+        shutil.rmtree(legacy_dir, ignore_errors=True)
+        logger.info(f"Removed the legacy corpus snapshots in {legacy_dir}")
+
+
+def publish_manifest(embeddings_dir: Path, segments: List[Dict[str, Any]], **extra: Any) -> Dict[str, Any]:
+    """
+    Make a new list of segments current. Call with publish_lock held.
+
+    Segments of the previous manifest that are no longer listed are retired
+    and deleted once SEGMENT_GC_SECONDS have passed.
+    """
+    previous = read_manifest(embeddings_dir) or {}
+    collect_garbage(embeddings_dir, previous)
+
+    now = time.time()
+    live = {segment["name"] for segment in segments}
+    retired = [
+        entry for entry in previous.get("retired", [])
+        if entry["name"] not in live and entry["at"] >= now - SEGMENT_GC_SECONDS
+    ]
+    retired += [
+        {"name": segment["name"], "at": now}
+        for segment in previous.get("segments", []) if segment["name"] not in live
+    ]
+
+    manifest = {
+        **{k: v for k, v in previous.items() if k not in ("version", "created_at", "chunks", "documents", "segments", "retired")},
+        **extra,
+        "version": previous.get("version", 0) + 1,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "chunks": sum(segment["chunks"] for segment in segments),
+        "documents": sum(len(segment["document_ids"]) for segment in segments),
+        "segments": segments,
+        "retired": retired,
+    }
+    write_json_atomic(embeddings_dir / MANIFEST_NAME, manifest)
+    logger.info(
+        f"Published corpus version {manifest['version']}: {len(segments)} segments, {manifest['chunks']} chunks"
+    )
+    return manifest
+
+
+def write_segment(
+    embeddings_dir: Path,
+    vectors: np.ndarray,
+    chunk_ids: List[str],
+    texts: List[str],
+    documents: Dict[str, Dict],
+    sealed: bool = False
+) -> Dict[str, Any]:
+    """
+    Write an immutable segment and return its manifest entry.
+
+    documents maps document_id to its metadata and the range of rows
+    ("start", "count") holding its chunks within the segment.
+    """
+    segments_dir = embeddings_dir / SEGMENTS_DIRNAME
+    segments_dir.mkdir(parents=True, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:12]}"
+
+    tmp_dir = segments_dir / f".tmp-{name}"
+    tmp_dir.mkdir()
+    try:
+        np.save(tmp_dir / "vectors.npy", np.ascontiguousarray(vectors, dtype=np.float32))
+
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.array([len(data) for data in encoded], dtype=np.int64))
+        np.save(tmp_dir / "offsets.npy", offsets)
+        with open(tmp_dir / "texts.bin", "wb") as f:
+            for data in encoded:
+                f.write(data)
+
+        with open(tmp_dir / "catalog.json", "w") as f:
+            json.dump({"documents": documents, "chunk_ids": chunk_ids}, f)
+
+        for path in tmp_dir.iterdir():
+            with open(path, "rb") as f:
+                os.fsync(f.fileno())
+        os.rename(tmp_dir, segments_dir / name)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    _fsync_dir(segments_dir)
+
+    return {
+        "name": name,
+        "chunks": len(chunk_ids),
+        "document_ids": list(documents),
+        "dimension": int(vectors.shape[1]) if len(chunk_ids) else None,
+        "sealed": sealed,
+    }
+
+
+def collect_garbage(embeddings_dir: Path, manifest: Dict[str, Any]) -> None:
+    """Delete retired segments and abandoned temporary directories older than SEGMENT_GC_SECONDS."""
+    segments_dir = embeddings_dir / SEGMENTS_DIRNAME
+    if not segments_dir.exists():
+        return
+    cutoff = time.time() - SEGMENT_GC_SECONDS
+    for entry in manifest.get("retired", []):
+        if entry["at"] < cutoff:
+            shutil.rmtree(segments_dir / entry["name"], ignore_errors=True)
+    for path in segments_dir.glob(".tmp-*"):
+        if path.stat().st_mtime < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class SegmentChunks:
+    """Read-only view of a segment's chunks; texts are decoded from the mapped file on access."""
+
+    def __init__(self, chunk_ids: List[str], document_ids: List[str], documents: Dict[str, Dict],
+                 texts: np.ndarray, offsets: np.ndarray):
+        self.chunk_ids = chunk_ids
+        self.document_ids = document_ids
+        self.documents = documents
+        self.texts = texts
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def text(self, row: int) -> str:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return self.texts[start:end].tobytes().decode("utf-8")
+
+    def __getitem__(self, row: int) -> Dict[str, Any]:
+        document_id = self.document_ids[row]
+        return {
+            "document_id": document_id,
+            "chunk_id": self.chunk_ids[row],
+            "text": self.text(row),
+            "metadata": self.documents[document_id]["metadata"],
+        }
+
+
+def load_segment(embeddings_dir: Path, entry: Dict[str, Any]) -> Tuple[np.ndarray, SegmentChunks, Dict[str, Dict]]:
+    """Map a segment: vectors, chunks and the document catalog."""
+    segment_dir = embeddings_dir / SEGMENTS_DIRNAME / entry["name"]
+    with open(segment_dir / "catalog.json", "r") as f:
+        catalog = json.load(f)
+    documents = catalog["documents"]
+
+    document_ids: List[str] = [""] * len(catalog["chunk_ids"])
+    for document_id, document in documents.items():
+        document_ids[document["start"]:document["start"] + document["count"]] = [document_id] * document["count"]
+
+    vectors = np.load(segment_dir / "vectors.npy", mmap_mode="r")
+    offsets = np.load(segment_dir / "offsets.npy", mmap_mode="r")
+    texts_path = segment_dir / "texts.bin"
+    texts = (
+        np.memmap(texts_path, dtype=np.uint8, mode="r")
+        if texts_path.stat().st_size else np.empty(0, dtype=np.uint8)
+    )
+    return vectors, SegmentChunks(catalog["chunk_ids"], document_ids, documents, texts, offsets), documents
+
+
+def discard_segment(embeddings_dir: Path, name: str) -> None:
+    """Delete a segment that was written but never published."""
+    shutil.rmtree(embeddings_dir / SEGMENTS_DIRNAME / name, ignore_errors=True)
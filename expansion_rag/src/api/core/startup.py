@@ -0,0 +1,106 @@
+"""Startup warm-up and readiness state."""
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from .. import IMPORT_STARTED
+from .backends import requires_openai_api_key
+from .corpus_snapshot import CORPUS_SNAPSHOT, bootstrap_from_snapshot
+from .embeddings import configured_embedding, current_generation, get_encoding
+from .index import get_corpus_index, sync_segments
+from .routing import get_rules
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """Whether the app has warmed up, and how long each startup step took."""
+
+    def __init__(self):
+        self.ready = False
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self.corpus_chunks = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "status": "ready" if self.ready else ("error" if self.error else "starting"),
+            "error": self.error,
+            "corpus_chunks": self.corpus_chunks,
+            "timings_seconds": dict(self.timings),
+        }
+
+
+readiness = Readiness()
+
+
+def warm_up() -> Readiness:
+    """
+    Load the token encoding and the corpus index of the current generation
+    and run one search, so the first real query does not pay for them.
+    With CORPUS_SNAPSHOT set, an empty corpus is first imported from it.
+
+    Timings are measured from the import of the api package and logged.
+    """
+    timings = readiness.timings
+    timings["import"] = time.perf_counter() - IMPORT_STARTED
+    try:
+        # A broken routing configuration would fail every question; report it here
+        try:
+            get_rules()
+        except Exception as e:
+            raise ValueError(f"Invalid MODEL_ROUTING: {e}") from e
+
+        start = time.perf_counter()
+        get_encoding()
+        timings["encoding"] = time.perf_counter() - start
+
+        # A new replica starts from a corpus snapshot instead of re-embedding
+        if CORPUS_SNAPSHOT:
+            start = time.perf_counter()
+            if bootstrap_from_snapshot(Path(CORPUS_SNAPSHOT)) is not None:
+                timings["snapshot_import"] = time.perf_counter() - start
+
+        generation = current_generation()
+        if generation.embedding != configured_embedding():
+            logger.warning(
+                f"The corpus uses {generation.embedding.model} ({generation.embedding.dimensions or 'full'} dimensions), "
+                f"not the configured {configured_embedding().model}; migrate it to switch"
+            )
+
+        # Pick up per-document files that changed while no server was running
+        start = time.perf_counter()
+        embeddings_dir = generation.path
+        if embeddings_dir.exists():
+            sync_segments(embeddings_dir)
+        corpus = get_corpus_index(embeddings_dir)
+        timings["corpus_index"] = time.perf_counter() - start
+        readiness.corpus_chunks = corpus.size
+
+        # A first search touches the index memory; later queries are fast
+        start = time.perf_counter()
+        if corpus.dimension is not None:
+            corpus.search(np.zeros((1, corpus.dimension), dtype=np.float32), 1)
+        timings["first_search"] = time.perf_counter() - start
+    except Exception as e:
+        readiness.error = f"Warm-up failed: {e}"
+        logger.exception(readiness.error)
+        return readiness
+
+    if requires_openai_api_key() and not os.getenv("OPENAI_API_KEY"):
+        readiness.error = "OPENAI_API_KEY environment variable is not set"
+        logger.error(readiness.error)
+        return readiness
+
+    timings["ready"] = time.perf_counter() - IMPORT_STARTED
+    readiness.ready = True
+    logger.info(
+        f"Ready {timings['ready']:.2f}s after import (import {timings['import']:.2f}s, "
+        f"encoding {timings['encoding']:.2f}s, corpus index {timings['corpus_index']:.2f}s "
+        f"for {corpus.size} chunks, first search {timings['first_search'] * 1000:.1f}ms)"
+    )
+    return readiness
@@ -0,0 +1,91 @@
+"""Token usage and cost accounting, per request and per process."""
+import contextvars
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# List prices in USD per million tokens; a model name matches its longest price prefix
+DEFAULT_MODEL_PRICES: Dict[str, Dict[str, float]] = {
+    "gpt-4.1-nano": {"prompt": 0.10, "completion": 0.40},
+    "gpt-4.1-mini": {"prompt": 0.40, "completion": 1.60},
+    "gpt-4.1": {"prompt": 2.00, "completion": 8.00},
+    "gpt-4o-mini": {"prompt": 0.15, "completion": 0.60},
+    "gpt-4o": {"prompt": 2.50, "completion": 10.00},
+    "text-embedding-3-small": {"embedding": 0.02},
+    "text-embedding-3-large": {"embedding": 0.13},
+    "text-embedding-ada-002": {"embedding": 0.10},
+}
+# JSON object adding or overriding prices, e.g. {"my-model": {"prompt": 1.0, "completion": 2.0}}
+MODEL_PRICES = {**DEFAULT_MODEL_PRICES, **json.loads(os.getenv("MODEL_PRICES", "{}"))}
+
+TOKEN_KINDS = ("prompt", "completion", "embedding")
+
+
+def token_cost(kind: str, model: Optional[str], count: int) -> float:
+    """Cost in USD of count tokens of a kind; 0 for models without a known price."""
+    if not model:
+        return 0.0
+    prefix = max((p for p in MODEL_PRICES if model.startswith(p)), key=len, default=None)
+    if prefix is None:
+        return 0.0
+    return MODEL_PRICES[prefix].get(kind, 0.0) * count / 1_000_000
+
+
+class UsageTotals:
+    """Tokens and cost by model."""
+
+    def __init__(self):
+        self.models: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, model: Optional[str], count: int) -> None:
+        with self._lock:
+            entry = self.models.setdefault(model or "unknown", {**{k: 0 for k in TOKEN_KINDS}, "cost_usd": 0.0})
+            entry[kind] = entry.get(kind, 0) + count
+            entry["cost_usd"] += token_cost(kind, model, count)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            models = {model: dict(entry) for model, entry in self.models.items()}
+        return {
+            "prompt_tokens": sum(int(entry["prompt"]) for entry in models.values()),
+            "completion_tokens": sum(int(entry["completion"]) for entry in models.values()),
+            "embedding_tokens": sum(int(entry["embedding"]) for entry in models.values()),
+            "cost_usd": sum(entry["cost_usd"] for entry in models.values()),
+            "models": models,
+        }
+
+
+# Usage of this process since start
+PROCESS_USAGE = UsageTotals()
+
+_current: contextvars.ContextVar[Optional[UsageTotals]] = contextvars.ContextVar("request_usage", default=None)
+
+
+@contextmanager
+def track_usage(usage: Optional[UsageTotals] = None) -> Iterator[UsageTotals]:
+    """
+    Collect the upstream usage of the work done inside the block, in usage or new totals.
+
+    Work moved to threads with asyncio.to_thread is included. A request that
+    is served from a coalesced computation of another request uses no tokens
+    of its own.
+    """
+    usage = usage if usage is not None else UsageTotals()
+    token = _current.set(usage)
+    try:
+        yield usage
+    finally:
+        _current.reset(token)
+
+
+def record_usage(kind: str, model: Optional[str], count: int) -> None:
+    PROCESS_USAGE.add(kind, model, count)
+    usage = _current.get()
+    if usage is not None:
+        usage.add(kind, model, count)
@@ -1,8 +1,11 @@
 """Pydantic models for RAG API."""
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Union
 from pydantic import BaseModel, Field
 from datetime import datetime
 
+# Characters of chunk text kept in the snippets of lean responses
+SNIPPET_CHARS = 200
+
 
 class DocumentResponse(BaseModel):
     """Response for document processing."""
@@ -20,6 +23,14 @@ class TextDocumentRequest(BaseModel):
     metadata: Optional[Dict[str, Any]] = Field(None, description="Optional metadata")
 
 
+class EmbeddingMigrationRequest(BaseModel):
+    """Target embedding of a corpus migration; omitted fields default to the server configuration."""
+    model: Optional[str] = Field(None, description="Embedding model, e.g. text-embedding-3-large")
+    dimensions: Optional[int] = Field(
+        None, gt=0, description="Output dimension (text-embedding-3 models); omit for the model's full width"
+    )
+
+
 class FileListResponse(BaseModel):
     """Response containing list of files."""
     files: List[str] = Field(..., description="List of file names")
@@ -32,6 +43,16 @@ class Message(BaseModel):
     content: str
 
 
+class DocumentFilter(BaseModel):
+    """Restricts retrieval to matching documents. All given conditions must hold."""
+    document_ids: Optional[List[str]] = Field(None, description="Only these documents")
+    filenames: Optional[List[str]] = Field(None, description="Case-insensitive filename glob patterns, e.g. 'ESRS*'")
+    file_types: Optional[List[str]] = Field(None, description="File extensions, e.g. '.pdf'")
+    metadata: Optional[Dict[str, Any]] = Field(
+        None, description="Document metadata that must match exactly; a list matches any of its values"
+    )
+
+
 class ChunkResponse(BaseModel):
     """Response model for a retrieved text chunk."""
     document_id: str
@@ -41,35 +62,174 @@ class ChunkResponse(BaseModel):
     metadata: Dict[str, Any] = Field(default_factory=dict)
 
 
+class ChunkReference(BaseModel):
+    """A retrieved chunk in lean responses; the full chunk is served by GET /chunks/{chunk_id}."""
+    document_id: str
+    chunk_id: str
+    score: float
+    snippet: str
+
+
+class ChunkDetail(BaseModel):
+    """A chunk looked up by id."""
+    document_id: str
+    chunk_id: str
+    text: str
+    metadata: Dict[str, Any] = Field(default_factory=dict)
+
+
+class StageTiming(BaseModel):
+    """Time spent in one pipeline stage during a request."""
+    duration_ms: float
+    calls: int
+
+
+class TimingBreakdown(BaseModel):
+    """Where the time of a request went. Nested stages (e.g. history_summary inside prompt_build) are counted in both."""
+    total_ms: float
+    stages: Dict[str, StageTiming] = Field(default_factory=dict)
+    documents_scanned: int = 0
+    vectors_scanned: int = 0
+    tokens_sent: int = 0
+    tokens_received: int = 0
+    tokens: Dict[str, int] = Field(default_factory=dict, description="Upstream tokens by kind (prompt, completion, embedding)")
+    profile_path: Optional[str] = Field(None, description="Folded-stack profile written for this request")
+
+
+class ModelUsage(BaseModel):
+    """Upstream tokens and estimated cost of one model."""
+    prompt: int = 0
+    completion: int = 0
+    embedding: int = 0
+    cost_usd: float = 0.0
+
+
+class UsageBreakdown(BaseModel):
+    """Upstream tokens used by a request and their estimated cost (0 when served from a coalesced request)."""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    embedding_tokens: int = 0
+    cost_usd: float = 0.0
+    models: Dict[str, ModelUsage] = Field(default_factory=dict)
+
+
 class ChatRequest(BaseModel):
-    """A chat request with optional conversation history."""
+    """
+    A chat request.
+
+    With a session_id only the new message needs to be sent; the conversation
+    is kept on the server. history is still accepted for stateless clients and
+    seeds a new session.
+    """
     message: str
+    session_id: Optional[str] = None
     history: Optional[List[Message]] = None
     top_k: Optional[int] = 3
-    model: Optional[str] = "gpt-4.1-mini-2025-04-14"
+    # None: chosen by the model routing rules, or COMPLETION_MODEL
+    model: Optional[str] = None
     temperature: Optional[float] = 0.0
     meta_information: Optional[str] = None
+    filters: Optional[DocumentFilter] = None
+    lean: bool = False
+    timing: bool = False
+    profile: bool = False
 
 
 class ChatResponse(BaseModel):
     """A chat response with additional context."""
     message: Message
-    chunks: List[ChunkResponse]
+    chunks: List[Union[ChunkResponse, ChunkReference]]
     expanded_queries: List[str]
     success: bool
+    session_id: Optional[str] = None
+    model: Optional[str] = None
+    usage: Optional[UsageBreakdown] = None
+    timing: Optional[TimingBreakdown] = None
+
+
+class SessionResponse(BaseModel):
+    """A server-side chat session."""
+    session_id: str
+    messages: List[Message] = Field(default_factory=list)
+    created_at: datetime
+    updated_at: datetime
 
 
 class QARequest(BaseModel):
     """Request for question answering."""
     query: str = Field(..., description="The question to answer")
     top_k: Optional[int] = Field(3, description="Number of chunks to retrieve")
-    model: Optional[str] = Field("gpt-4.1-mini-2025-04-14", description="OpenAI model to use for generation")
+    model: Optional[str] = Field(None, description="OpenAI model to use for generation; by default chosen by the model routing rules")
     temperature: Optional[float] = Field(0.0, description="Sampling temperature")
+    filters: Optional[DocumentFilter] = Field(None, description="Restrict retrieval to matching documents")
+    lean: bool = Field(False, description="Return chunk references with snippets instead of full chunks")
+    timing: bool = Field(False, description="Include a timing breakdown in the response")
+    profile: bool = Field(False, description="Also write a sampling profile of this request to disk")
 
 
 class QAResponse(BaseModel):
     """Response for question answering."""
     answer: str
-    chunks: List[ChunkResponse]
+    chunks: List[Union[ChunkResponse, ChunkReference]]
     expanded_queries: Optional[List[str]] = Field(default_factory=list, description="Expanded queries used for retrieval")
-    success: bool 
\ No newline at end of file
+    success: bool
+    model: Optional[str] = Field(None, description="Model that generated the answer")
+    usage: Optional[UsageBreakdown] = None
+    timing: Optional[TimingBreakdown] = None
+
+
+class BatchQARequest(BaseModel):
+    """Request for answering many questions at once."""
+    queries: List[str] = Field(..., min_length=1, max_length=1000, description="The questions to answer")
+    top_k: Optional[int] = Field(3, description="Number of chunks to retrieve per question")
+    model: Optional[str] = Field(None, description="OpenAI model to use for generation; by default chosen by the model routing rules")
+    temperature: Optional[float] = Field(0.0, description="Sampling temperature")
+    concurrency: Optional[int] = Field(None, ge=1, le=64, description="Questions answered at the same time")
+    filters: Optional[DocumentFilter] = Field(None, description="Restrict retrieval to matching documents")
+    lean: bool = Field(False, description="Return chunk references with snippets instead of full chunks")
+
+
+class BatchQAItem(QAResponse):
+    """One answer of a batch, streamed as a line of NDJSON."""
+    index: int = Field(..., description="Position of the question in the request")
+    query: str
+
+
+def filters_to_dict(filters: Optional[DocumentFilter]) -> Optional[Dict[str, Any]]:
+    """Convert a request filter into the plain dict used by the core search."""
+    if filters is None:
+        return None
+    return filters.model_dump(exclude_none=True) or None
+
+
+def make_snippet(text: str, max_chars: int = SNIPPET_CHARS) -> str:
+    """Shorten a chunk text to about max_chars, cutting at a word boundary."""
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > 0 else max_chars] + "…"
+
+
+def to_chunk_responses(chunks: List[Dict], lean: bool = False) -> List[Union[ChunkResponse, ChunkReference]]:
+    """Convert retrieved chunks to response models; lean responses carry references and snippets only."""
+    if lean:
+        return [
+            ChunkReference(
+                document_id=chunk["document_id"],
+                chunk_id=chunk["chunk_id"],
+                score=chunk["score"],
+                snippet=make_snippet(chunk["text"])
+            )
+            for chunk in chunks
+        ]
+    return [
+        ChunkResponse(
+            document_id=chunk["document_id"],
+            chunk_id=chunk["chunk_id"],
+            text=chunk["text"],
+            score=chunk["score"],
+            metadata=chunk.get("metadata", {})
+        )
+        for chunk in chunks
+    ]
@@ -1,40 +1,123 @@
 """Chat routes for RAG system."""
-from typing import List, Optional
-from fastapi import APIRouter, HTTPException
-from ..models import Message, ChatRequest, ChatResponse
-from ..core.rag import generate_answer
+import logging
+from contextlib import nullcontext
+from datetime import datetime
+from typing import Dict, List, Optional
+from fastapi import APIRouter, Header, HTTPException
+from ..models import Message, ChatRequest, ChatResponse, SessionResponse, filters_to_dict, to_chunk_responses
+from ..core.rag import generate_answer_coalesced
+from ..core.embeddings import corpus_version
+from ..core.sessions import ChatSession, SessionConflictError, get_session_store, session_locks
+from ..core.profiling import request_timing, timing_options
+from ..core.scheduler import QuotaExceededError
+from ..core.usage import track_usage
 
 router = APIRouter(prefix="/chat", tags=["chat"])
+logger = logging.getLogger(__name__)
+
+
+def to_session_response(session: ChatSession) -> SessionResponse:
+    """Convert a stored session into its API representation."""
+    return SessionResponse(
+        session_id=session.session_id,
+        messages=[Message(**turn) for turn in session.turns],
+        created_at=datetime.fromtimestamp(session.created_at),
+        updated_at=datetime.fromtimestamp(session.updated_at)
+    )
+
+
+@router.post("/sessions", response_model=SessionResponse)
+async def create_session():
+    """Create a new, empty chat session."""
+    return to_session_response(get_session_store().create())
+
+
+@router.get("/sessions/{session_id}", response_model=SessionResponse)
+async def get_session(session_id: str):
+    """Get the stored turns of a chat session."""
+    session = get_session_store().get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return to_session_response(session)
+
+
+@router.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Delete a chat session."""
+    if not get_session_store().delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"success": True}
 
-def format_conversation_history(messages: List[Message]) -> str:
-    """Format conversation history into a string, including only user questions and assistant responses."""
-    formatted_history = ""
-    for msg in messages:
-        if msg.role in ["user", "assistant"]:
-            role = "Assistant" if msg.role == "assistant" else "User"
-            formatted_history += f"{role}: {msg.content}\n"
-    return formatted_history.strip()
 
 @router.post("/process", response_model=ChatResponse)
-async def process_chat(request: ChatRequest):
-    """Process a chat message with conversation history."""
+async def process_chat(request: ChatRequest, x_timing: Optional[str] = Header(None)):
+    """
+    Process a chat message within a server-side session.
+    
+    With "lean" the response carries chunk references and snippets instead
+    of full chunks (fetch them with GET /chunks/{chunk_id}). With "timing" (or the X-Timing header) the response includes a timing
+    breakdown; "profile" also writes a sampling profile of the request.
+    
+    Turns of one session are processed one at a time.
+    """
+    lock = session_locks.hold(request.session_id) if request.session_id else nullcontext()
+    async with lock:
+        return await _process_turn(request, x_timing)
+
+
+def save_turn(session: ChatSession, message: str, answer: str, context_chunks: List[Dict]) -> ChatSession:
+    """
+    Append a question and its answer to a session and store it.
+
+    If another worker saved a turn of the session meanwhile, this turn is
+    appended to the stored session instead of overwriting it.
+    """
+    store = get_session_store()
+    for _ in range(3):
+        session.add_turn("user", message)
+        session.add_turn("assistant", answer)
+        session.context_chunks = context_chunks
+        try:
+            store.save(session)
+            return session
+        except SessionConflictError:
+            session = store.get(session.session_id)
+            if session is None:
+                raise HTTPException(status_code=404, detail="Session not found or expired")
+    raise HTTPException(status_code=409, detail="Session is being updated concurrently; retry")
+
+
+async def _process_turn(request: ChatRequest, x_timing: Optional[str]) -> ChatResponse:
     try:
-        # Format conversation history if available
-        conversation_history = None
-        print("Received history:", request.history)  # Debug: Print received history
-        if request.history and len(request.history) > 0:
-            conversation_history = format_conversation_history(request.history)
-            print("Formatted history:", conversation_history)  # Debug: Print formatted history
+        store = get_session_store()
+        if request.session_id:
+            session = store.get(request.session_id)
+            if session is None:
+                raise HTTPException(status_code=404, detail="Session not found or expired")
+        else:
+            # Stateless clients send their history; use it to seed a new session
+            session = ChatSession()
+            for msg in request.history or []:
+                if msg.role in ("user", "assistant"):
+                    session.add_turn(msg.role, msg.content)
+        # Cached search results and context are only valid for the corpus they came from
+        session.use_corpus(corpus_version())
         
         # Generate response using RAG
-        response = generate_answer(
-            query=request.message,
-            conversation_history=conversation_history,
-            top_k=request.top_k,
-            model=request.model,
-            temperature=request.temperature,
-            meta_information=request.meta_information
-        )
+        with request_timing(*timing_options(request.timing, request.profile, x_timing)) as timing, \
+                track_usage() as usage:
+            response = await generate_answer_coalesced(
+                query=request.message,
+                conversation_history=session.turns or None,
+                top_k=request.top_k,
+                model=request.model,
+                temperature=request.temperature,
+                meta_information=request.meta_information,
+                filters=filters_to_dict(request.filters),
+                expansion_cache=session.expansions,
+                retrieval_cache=session.retrieved,
+                previous_chunks=session.context_chunks
+            )
         
         # Create the assistant message
         assistant_message = Message(
@@ -42,14 +125,28 @@ async def process_chat(request: ChatRequest):
             content=response["answer"]
         )
         
-        # No need to convert chunks - use them directly
+        if response["success"]:
+            session = save_turn(session, request.message, response["answer"], response["retrieved_chunks"])
+        else:
+            try:
+                store.save(session)
+            except SessionConflictError:
+                # Only cached expansions and search results would have been stored
+                pass
+        
         return ChatResponse(
             message=assistant_message,
-            chunks=response["chunks"],  # Use the full chunk objects
+            chunks=to_chunk_responses(response["chunks"], request.lean),
             expanded_queries=response["expanded_queries"],
-            success=response["success"]
+            success=response["success"],
+            session_id=session.session_id,
+            model=response.get("model"),
+            usage=usage.to_dict(),
+            timing=timing.to_dict() if timing else None
         )
         
+    except (HTTPException, QuotaExceededError):
+        raise
     except Exception as e:
-        print(f"Error in process_chat: {e}")  # Add this to see the actual error
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        logger.exception(f"Error in process_chat: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,65 @@
+"""Chunk lookup routes, for clients of lean responses."""
+import asyncio
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+from fastapi import APIRouter, Header, HTTPException, Response
+
+from ..models import ChunkDetail
+from ..core.embeddings import get_chunk
+
+router = APIRouter(prefix="/chunks", tags=["chunks"])
+
+# Seconds clients may reuse a chunk before revalidating it with its ETag
+CHUNK_CACHE_MAX_AGE = int(os.getenv("CHUNK_CACHE_MAX_AGE", "86400"))
+
+
+def chunk_etag(chunk: Dict) -> str:
+    """
+    Weak ETag over the chunk's content, so a re-embedded document gets new tags.
+
+    Weak, because the compression middleware sends the same chunk gzip-encoded
+    or not, and a strong tag would have to differ between the two.
+    """
+    content = json.dumps(
+        [chunk["document_id"], chunk["chunk_id"], chunk["text"], chunk["metadata"]],
+        sort_keys=True, default=str
+    )
+    return f'W/"{hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]}"'
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # If-None-Match uses weak comparison: the opaque tags must match
+    opaque = etag.removeprefix("W/")
+    return "*" in tags or opaque in (tag.removeprefix("W/") for tag in tags)
+
+
+@router.get("/{chunk_id}", response_model=ChunkDetail)
+async def get_chunk_by_id(chunk_id: str, response: Response, if_none_match: Optional[str] = Header(None)):
+    """
+    Get a chunk by id.
+    
+    Responses carry a weak ETag and may be cached by the client; send the
+    tag back in If-None-Match to get 304 Not Modified instead of the chunk.
+    """
+    # Switching to a newly published corpus maps files, so keep it off the event loop
+    chunk = await asyncio.to_thread(get_chunk, chunk_id)
+    if chunk is None:
+        raise HTTPException(status_code=404, detail="Chunk not found")
+    
+    etag = chunk_etag(chunk)
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={CHUNK_CACHE_MAX_AGE}"}
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    
+    response.headers.update(headers)
+    return ChunkDetail(
+        document_id=chunk["document_id"],
+        chunk_id=chunk["chunk_id"],
+        text=chunk["text"],
+        metadata=chunk["metadata"]
+    )
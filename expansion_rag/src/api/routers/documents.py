@@ -1,23 +1,29 @@
 """Document handling routes."""
-import os
+import asyncio
 import json
 from typing import List
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
-from fastapi.responses import JSONResponse
-from pathlib import Path
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from ..models import DocumentResponse, TextDocumentRequest, FileListResponse
+from ..models import DocumentResponse, TextDocumentRequest, FileListResponse, EmbeddingMigrationRequest
+from ..core.corpus_snapshot import SnapshotBusyError, SnapshotError, import_snapshot, iter_snapshot
 from ..core.document_processor import process_text_document, save_uploaded_file, get_document_content
-from ..core.embeddings import create_document_embeddings, verify_document_embeddings, process_missing_embeddings
+from ..core.embeddings import (
+    configured_embedding, create_document_embeddings, current_generation, verify_document_embeddings,
+    process_missing_embeddings
+)
+from ..core.generations import EmbeddingConfig
+from ..core.migration import MigrationError, migration_status, start_migration
+from ..core.scheduler import QuotaExceededError
 
 router = APIRouter(prefix="/documents", tags=["documents"])
 
 
 @router.get("/files", response_model=FileListResponse)
 async def get_all_files():
-    """Get list of all files in the embeddings directory."""
+    """Get list of all files in the current index generation."""
     try:
-        embeddings_dir = Path(os.getenv("EMBEDDINGS_DIR", "./data/embeddings"))
+        embeddings_dir = current_generation().path
         if not embeddings_dir.exists():
             return FileListResponse(files=[], total_files=0)
         
@@ -26,6 +32,9 @@ async def get_all_files():
         seen_files = set()  # Track unique files by document_id
         
         for metadata_file in embeddings_dir.glob("*.json"):
+            # Skip the manifest and other bookkeeping files
+            if not metadata_file.with_suffix(".index").exists():
+                continue
             try:
                 with open(metadata_file, "r") as f:
                     metadata = json.load(f)
@@ -66,6 +75,70 @@ async def process_missing():
     return process_missing_embeddings()
 
 
+@router.post("/migrate-embeddings")
+async def migrate_embeddings(request: EmbeddingMigrationRequest):
+    """
+    Re-embed the corpus with another embedding model or dimension.
+    
+    The stored chunks are embedded into a new index generation in the
+    background while the current one keeps serving; the new generation
+    replaces it once complete. Defaults to the configured EMBEDDING_MODEL and
+    EMBEDDING_DIMENSIONS. Follow progress with GET /documents/migration-status.
+    """
+    configured = configured_embedding()
+    target = EmbeddingConfig(
+        request.model or configured.model,
+        request.dimensions if request.model or request.dimensions else configured.dimensions
+    )
+    try:
+        return start_migration(target)
+    except MigrationError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.get("/migration-status")
+async def get_migration_status():
+    """Get the progress of the last embedding migration and the embedding currently served."""
+    generation = current_generation()
+    return {
+        **migration_status(),
+        "current_generation": generation.name,
+        "current_embedding": generation.embedding.to_dict()
+    }
+
+
+@router.get("/snapshot")
+async def export_corpus_snapshot():
+    """
+    Download the corpus as a single-file snapshot (tar) to bootstrap another node.
+    
+    Contains the segments, per-document indexes and chunks of the current
+    generation and the stored documents, with a manifest of checksums.
+    """
+    generation = current_generation()
+    return StreamingResponse(
+        iter_snapshot(generation),
+        media_type="application/x-tar",
+        headers={"Content-Disposition": f'attachment; filename="corpus-{generation.name}.tar"'}
+    )
+
+
+@router.post("/snapshot")
+async def import_corpus_snapshot(file: UploadFile = File(...)):
+    """
+    Replace the corpus with an uploaded snapshot.
+    
+    The snapshot is verified against its checksums and served as a new index
+    generation, without re-embedding; documents uploaded before are not kept.
+    """
+    try:
+        return await asyncio.to_thread(import_snapshot, file.file)
+    except SnapshotBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except SnapshotError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @router.post("/upload", response_model=DocumentResponse)
 async def upload_document(file: UploadFile = File(...)):
     """Upload a document file and process it."""
@@ -87,6 +160,8 @@ async def upload_document(file: UploadFile = File(...)):
             size=document_info["size"],
             success=True
         )
+    except QuotaExceededError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing document: {str(e)}")
 
@@ -114,6 +189,8 @@ async def process_text(request: TextDocumentRequest):
             size=document_info["size"],
             success=True
         )
+    except QuotaExceededError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing text: {str(e)}")
 
@@ -1,16 +1,39 @@
 """Question answering routes using RAG."""
-from fastapi import APIRouter, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import ValidationError
 
-from ..models import QARequest, QAResponse, ChunkResponse
-from ..core.rag import generate_answer
+from ..models import QARequest, QAResponse, BatchQARequest, BatchQAItem, filters_to_dict, to_chunk_responses
+from ..core.rag import generate_answer_coalesced, generate_answers_batch, BATCH_CONCURRENCY
 from ..core.embeddings import verify_document_embeddings, process_missing_embeddings
+from ..core.profiling import request_timing, timing_options
+from ..core.scheduler import QuotaExceededError
+from ..core.usage import track_usage
 
 router = APIRouter(prefix="/qa", tags=["question-answering"])
 
 
+def ensure_embeddings() -> None:
+    """Process any documents that are missing embeddings, or raise if that fails."""
+    verification = verify_document_embeddings()
+    if not verification["is_complete"]:
+        # Process missing embeddings
+        processing_result = process_missing_embeddings()
+        
+        # Check if processing was successful
+        if not processing_result["verification"]["is_complete"]:
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "message": "Failed to process all missing embeddings",
+                    "processing_result": processing_result
+                }
+            )
+
+
 @router.post("", response_model=QAResponse)
-async def answer_question(request: QARequest):
+async def answer_question(request: QARequest, x_timing: Optional[str] = Header(None)):
     """
     Answer a question using RAG from all available documents.
     
@@ -20,54 +43,81 @@ async def answer_question(request: QARequest):
     3. Takes a question
     4. Retrieves relevant chunks from all documents using FAISS similarity search
     5. Generates an answer using OpenAI
+    
+    With "lean" the response carries chunk references and snippets instead
+    of full chunks. With "timing" (or the X-Timing header) the response
+    includes a timing breakdown; "profile" also writes a sampling profile of
+    the request.
     """
     try:
         # Verify document embeddings and process any missing ones
-        verification = verify_document_embeddings()
-        if not verification["is_complete"]:
-            # Process missing embeddings
-            processing_result = process_missing_embeddings()
-            
-            # Check if processing was successful
-            if not processing_result["verification"]["is_complete"]:
-                raise HTTPException(
-                    status_code=400,
-                    detail={
-                        "message": "Failed to process all missing embeddings",
-                        "processing_result": processing_result
-                    }
-                )
+        ensure_embeddings()
         
         # Generate answer using RAG
-        result = generate_answer(
-            query=request.query,
-            top_k=request.top_k or 3,
-            model=request.model,
-            temperature=request.temperature or 0.0
-        )
-        
-        # Convert chunks to ChunkResponse model
-        chunks = [
-            ChunkResponse(
-                document_id=chunk["document_id"],
-                chunk_id=chunk["chunk_id"],
-                text=chunk["text"],
-                score=chunk["score"],
-                metadata=chunk.get("metadata", {})
+        with request_timing(*timing_options(request.timing, request.profile, x_timing)) as timing, \
+                track_usage() as usage:
+            result = await generate_answer_coalesced(
+                query=request.query,
+                top_k=request.top_k or 3,
+                model=request.model,
+                temperature=request.temperature or 0.0,
+                filters=filters_to_dict(request.filters)
             )
-            for chunk in result.get("chunks", [])
-        ]
         
         return QAResponse(
             answer=result["answer"],
-            chunks=chunks,
+            chunks=to_chunk_responses(result.get("chunks", []), request.lean),
             expanded_queries=result["expanded_queries"],
-            success=result["success"]
+            success=result["success"],
+            model=result.get("model"),
+            usage=usage.to_dict(),
+            timing=timing.to_dict() if timing else None
         )
     
     except ValidationError as e:
         raise HTTPException(status_code=422, detail=str(e))
-    except HTTPException:
+    except (HTTPException, QuotaExceededError):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating answer: {str(e)}")
+
+
+@router.post("/batch")
+async def answer_questions(request: BatchQARequest):
+    """
+    Answer many questions in one call.
+    
+    All expanded queries are embedded in bulk and searched with one matrix
+    search; answers are generated with bounded concurrency. Results are
+    streamed as newline-delimited JSON (one BatchQAItem per line) in the order
+    they complete; use "index" to match them to the questions.
+    """
+    try:
+        ensure_embeddings()
+    except (HTTPException, QuotaExceededError):
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating answer: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error preparing embeddings: {str(e)}")
+    
+    async def stream_results():
+        async for result in generate_answers_batch(
+            request.queries,
+            top_k=request.top_k or 3,
+            model=request.model,
+            temperature=request.temperature or 0.0,
+            concurrency=request.concurrency or BATCH_CONCURRENCY,
+            filters=filters_to_dict(request.filters)
+        ):
+            item = BatchQAItem(
+                index=result["index"],
+                query=result["query"],
+                answer=result["answer"],
+                chunks=to_chunk_responses(result.get("chunks", []), request.lean),
+                expanded_queries=result["expanded_queries"],
+                success=result["success"],
+                model=result.get("model"),
+                usage=result.get("usage")
+            )
+            yield item.model_dump_json() + "\n"
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
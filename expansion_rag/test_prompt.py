@@ -0,0 +1,33 @@
+"""Tests for token-budgeted prompt assembly."""
+from src.api.core import prompt
+from src.api.core.prompt import MESSAGE_OVERHEAD_TOKENS, SUMMARY_TOKEN_LIMIT, compact_history, count_tokens
+
+
+def test_summary_is_reused_until_a_block_is_complete(monkeypatch):
+    """The summarizer runs once per compaction block, not on every chat turn."""
+    monkeypatch.setattr(prompt, "COMPACTION_BLOCK", 4)
+    prompt._summary_cache.clear()
+
+    calls = []
+
+    def summarize(previous_summary, turns):
+        calls.append(len(turns))
+        return "summary"
+
+    def turn(role, i):
+        return {"role": role, "content": f"{role} turn {i}: " + "word " * 1000}
+
+    # Room for the summary and two and a half recent turns
+    cost = count_tokens(turn("user", 0)["content"]) + MESSAGE_OVERHEAD_TOKENS
+    budget = SUMMARY_TOKEN_LIMIT + 2 * cost + cost // 2
+
+    history = []
+    for i in range(8):
+        summary, recent = compact_history(history, budget, summarize)
+        if history:
+            assert recent[-2:] == history[-2:]
+            assert (len(history) - len(recent)) % 4 == 0
+        history += [turn("user", i), turn("assistant", i)]
+
+    # Histories of 6, 10 and 14 turns complete a block; 8 and 12 reuse the cached summary
+    assert len(calls) == 3